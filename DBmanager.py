@@ -1,32 +1,572 @@
 import sqlite3
 import json
+import base64
+import difflib
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import live_feed
+import metrics
+import score_ranks
+from app_logging import get_logger
+from regions import validate_location
+
+logger = get_logger('db')
 
 DATABASE_PATH = 'database.db'
 
+# Параметры пула соединений
+POOL_MAX_IDLE = 8           # сколько простаивающих соединений держим открытыми
+BUSY_TIMEOUT_MS = 5000      # сколько ждать снятия блокировки вместо "database is locked"
+CACHE_SIZE_KB = 16384       # размер страничного кэша на соединение
+AUTO_VACUUM_INCREMENTAL = 2  # значение PRAGMA auto_vacuum для режима INCREMENTAL
 
-def get_connection():
-    """Получение соединения с базой данных"""
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
+
+_query_names = {}
+
+
+def _query_name(sql):
+    # Имя запроса: функция, из которой он выполнен, и первое слово SQL (get_class_summary.select)
+    code = sys._getframe(2).f_code
+    name = _query_names.get((code, sql))
+    if name is None:
+        verb = sql.split(None, 1)[0].lower() if sql.strip() else ''
+        if verb == 'begin' and ('IMMEDIATE' in sql.upper() or 'EXCLUSIVE' in sql.upper()):
+            verb = 'lock'
+        name = f'{code.co_name}.{verb}'
+        if len(_query_names) < 4096:
+            _query_names[(code, sql)] = name
+    return name
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор с замером времени каждого запроса, ожидания блокировки и ошибок database is locked"""
+
+    def _timed(self, method, name, sql, args):
+        start = time.perf_counter()
+        try:
+            return method(self, sql, *args)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e):
+                metrics.inc('webhistory_db_lock_errors_total', query=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self._query = name
+            # BEGIN IMMEDIATE/EXCLUSIVE ждёт снятия блокировки записи другими соединениями
+            if name.endswith('.lock'):
+                metrics.observe('webhistory_db_lock_wait_seconds', elapsed, query=name)
+            else:
+                metrics.observe('webhistory_db_query_seconds', elapsed, query=name)
+
+    def execute(self, sql, *args):
+        return self._timed(sqlite3.Cursor.execute, _query_name(sql), sql, args)
+
+    def executemany(self, sql, *args):
+        return self._timed(sqlite3.Cursor.executemany, _query_name(sql), sql, args)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            metrics.observe('webhistory_db_fetch_seconds', time.perf_counter() - start,
+                            query=getattr(self, '_query', 'unknown'))
+
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute создаёт курсор в обход cursor(), поэтому переопределяем и его
+    def execute(self, sql, *args):
+        return self.cursor()._timed(sqlite3.Cursor.execute, _query_name(sql), sql, args)
+
+    def executemany(self, sql, *args):
+        return self.cursor()._timed(sqlite3.Cursor.executemany, _query_name(sql), sql, args)
+
+    def close(self):
+        _pool.release(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Стандартный __exit__ делает commit/rollback, затем соединение уходит в пул
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.close()
+
+    def close_physically(self):
+        sqlite3.Connection.close(self)
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite с однократной настройкой PRAGMA"""
+
+    def __init__(self, max_idle=POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._path = None
+        self._stats = {'opened': 0, 'reused': 0, 'closed': 0, 'in_use': 0}
+
+    def _open(self, path):
+        conn = sqlite3.connect(
+            path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            factory=PooledConnection
+        )
         conn.row_factory = sqlite3.Row
+        # Действует только для нового файла БД (до первой таблицы); существующую переводит manage.py migrate
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def acquire(self):
+        """Взять соединение из пула или открыть новое"""
+        with self._lock:
+            # Путь к БД сменился (например, в тестах или бенчмарке) - старые соединения не годятся
+            if self._path != DATABASE_PATH:
+                self._close_idle()
+                self._path = DATABASE_PATH
+            path = self._path
+            conn = self._idle.pop() if self._idle else None
+            self._stats['in_use'] += 1
+            if conn is not None:
+                self._stats['reused'] += 1
+                return conn
+        try:
+            conn = self._open(path)
+        except Exception:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            raise
+        with self._lock:
+            self._stats['opened'] += 1
         return conn
+
+    def release(self, conn):
+        """Вернуть соединение в пул (незавершённая транзакция откатывается)"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.ProgrammingError:
+            # Соединение уже закрыто физически
+            with self._lock:
+                self._stats['in_use'] -= 1
+            return
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if self._path == DATABASE_PATH and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._stats['closed'] += 1
+        conn.close_physically()
+
+    def _close_idle(self):
+        while self._idle:
+            self._idle.pop().close_physically()
+            self._stats['closed'] += 1
+
+    def close_all(self):
+        """Закрыть все простаивающие соединения"""
+        with self._lock:
+            self._close_idle()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), max_idle=self.max_idle)
+
+
+_pool = ConnectionPool()
+
+
+def get_connection():
+    """Получение соединения с базой данных из пула"""
+    try:
+        return _pool.acquire()
     except Exception as e:
-        print(f"Ошибка подключения к базе данных: {str(e)}")
+        logger.error("Ошибка подключения к базе данных", extra={'error': str(e)})
         raise
 
 
-def init_db():
-    """Инициализация базы данных"""
+def close_all_connections():
+    """Закрытие всех соединений пула (при остановке приложения)"""
+    _pool.close_all()
+
+
+def get_connection_stats():
+    """Счётчики пула: открыто, переиспользовано, закрыто, занято, простаивает"""
+    return _pool.stats()
+
+
+class DataGeneration:
+    """Поколение данных: меняется при любой записи в БД.
+
+    Локальный счётчик увеличивают функции записи этого процесса, а PRAGMA data_version
+    отдельного соединения-наблюдателя замечает коммиты любых других соединений и процессов.
+    Тем же соединением читается версия ключей уровней - только если БД менялась с прошлого чтения.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = 0
+        self._watcher = None
+        self._path = None
+        self._keys_checked = None
+        self._keys_version = None
+
+    def bump(self):
+        with self._lock:
+            self._local += 1
+
+    def _data_version(self):
+        if self._path != DATABASE_PATH:
+            if self._watcher is not None:
+                self._watcher.close()
+            self._watcher = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+            self._path = DATABASE_PATH
+            self._keys_checked = None
+        return self._watcher.execute('PRAGMA data_version').fetchone()[0]
+
+    def current(self):
+        with self._lock:
+            return self._local, self._data_version()
+
+    def answer_keys_version(self):
+        with self._lock:
+            data_version = self._data_version()
+            if data_version != self._keys_checked:
+                try:
+                    row = self._watcher.execute('SELECT version FROM AnswerKeyVersion').fetchone()
+                    self._keys_version = row[0] if row else 0
+                except sqlite3.OperationalError:
+                    # Схема ещё без версии ключей (до миграции 9)
+                    self._keys_version = 0
+                self._keys_checked = data_version
+            return self._keys_version
+
+
+_generation = DataGeneration()
+
+
+def bump_generation():
+    """Отметить изменение данных (сбрасывает кэш ответов)"""
+    _generation.bump()
+
+
+def get_generation():
+    """Текущее поколение данных - ключ актуальности кэша"""
+    return _generation.current()
+
+
+def get_answer_keys_version():
+    """Версия ключей уровней (AnswerKeyVersion): меняется только при записи ключа set_answer_key"""
+    return _generation.answer_keys_version()
+
+
+# Нормализованные ключи для поиска: (колонка-ключ, исходная колонка)
+KEY_COLUMNS = (
+    ('first_name_key', 'first_name'),
+    ('last_name_key', 'last_name'),
+    ('class_key', 'class_name'),
+    ('city_key', 'city'),
+    ('school_key', 'school'),
+)
+
+
+# Есть ли уникальный индекс по ученику и уровню (его нельзя построить, если в БД уже есть дубли)
+_unique_student_index = False
+
+# Колонки поискового индекса TestSearch и есть ли сам индекс (нужен FTS5 с токенизатором trigram)
+SEARCH_COLUMNS = ('last_name_key', 'first_name_key', 'class_key', 'school_key', 'city_key')
+_search_index = False
+
+
+def normalize_key(value):
+    """Ключ для сравнения без учёта регистра (в т.ч. кириллицы) и лишних пробелов"""
+    if not value:
+        return ''
+    return ' '.join(str(value).split()).casefold()
+
+
+def backfill_keys(cursor, after_id, batch_size=1000):
+    """Заполнение ключевых колонок у пачки строк с id больше after_id, сохранённых до их появления.
+
+    Возвращает (число строк, id последней строки пачки) - со следующего id начнётся новая пачка.
+    """
+    cursor.execute(
+        'SELECT id, first_name, last_name, class_name, city, school FROM Test '
+        'WHERE id > ? AND first_name_key IS NULL ORDER BY id LIMIT ?', (after_id, batch_size)
+    )
+    rows = cursor.fetchall()
+    cursor.executemany(
+        'UPDATE Test SET first_name_key = ?, last_name_key = ?, class_key = ?, city_key = ?, school_key = ? '
+        'WHERE id = ?',
+        [(normalize_key(row['first_name']), normalize_key(row['last_name']), normalize_key(row['class_name']),
+          normalize_key(row['city']), normalize_key(row['school']), row['id']) for row in rows]
+    )
+    return len(rows), rows[-1]['id'] if rows else after_id
+
+
+def compact_answers(cursor, after_id, batch_size=1000):
+    """Перевод пачки строк (id больше after_id) со старым JSON-форматом ответов в компактный;
+    возвращает (число строк, id последней строки пачки)"""
+    cursor.execute(
+        'SELECT id, level, answers FROM Test WHERE id > ? AND choices IS NULL ORDER BY id LIMIT ?',
+        (after_id, batch_size)
+    )
+    rows = cursor.fetchall()
+    updates = []
+    for row in rows:
+        answers_json, choices, mask = pack_answers(row['level'], json.loads(row['answers']), cursor)
+        updates.append((answers_json, choices, mask, row['id']))
+    cursor.executemany('UPDATE Test SET answers = ?, choices = ?, correct_mask = ? WHERE id = ?', updates)
+    return len(rows), rows[-1]['id'] if rows else after_id
+
+
+# Разрезы сводной статистики: по каким полям (помимо уровня) ведётся счётчик
+STATS_DIMENSIONS = {
+    'level': (),
+    'city': ('city',),
+    'school': ('city', 'school'),
+    'class': ('city', 'school', 'class'),
+}
+# поле разреза -> (колонка-ключ, колонка с отображаемым названием)
+STATS_FIELDS = {
+    'city': ('city_key', 'city'),
+    'school': ('school_key', 'school'),
+    'class': ('class_key', 'class_name'),
+}
+STATS_KEY = 'dimension, city_key, school_key, class_key, level'
+PERCENT_SQL = 'CASE WHEN {p}max_score > 0 THEN {p}score * 100.0 / {p}max_score ELSE 0 END'
+
+
+def _stats_columns(dimension, prefix):
+    """Значения колонок TestStats для разреза; prefix - 'NEW.', 'OLD.' или ''"""
+    fields = STATS_DIMENSIONS[dimension]
+    keys, names = [], []
+    for field, (key_column, name_column) in STATS_FIELDS.items():
+        keys.append(f'{prefix}{key_column}' if field in fields else "''")
+        names.append(f'{prefix}{name_column}' if field in fields else "''")
+    return keys, names
+
+
+def _stats_trigger_sql(prefix, sign):
+    """Тело триггера: прибавить (sign=1) или вычесть (sign=-1) строку во всех разрезах"""
+    statements = []
+    for dimension in STATS_DIMENSIONS:
+        keys, names = _stats_columns(dimension, prefix)
+        percent = PERCENT_SQL.format(p=prefix)
+        if sign > 0:
+            statements.append(f'''
+                INSERT INTO TestStats ({STATS_KEY}, city, school, class_name, count, scored_count, percent_sum)
+                VALUES ('{dimension}', {', '.join(keys)}, {prefix}level, {', '.join(names)},
+                        1, {prefix}max_score > 0, {percent})
+                ON CONFLICT ({STATS_KEY}) DO UPDATE SET
+                    count = count + 1,
+                    scored_count = scored_count + excluded.scored_count,
+                    percent_sum = percent_sum + excluded.percent_sum;
+            ''')
+        else:
+            statements.append(f'''
+                UPDATE TestStats SET
+                    count = count - 1,
+                    scored_count = scored_count - ({prefix}max_score > 0),
+                    percent_sum = percent_sum - {percent}
+                WHERE dimension = '{dimension}' AND city_key = {keys[0]} AND school_key = {keys[1]}
+                  AND class_key = {keys[2]} AND level = {prefix}level;
+            ''')
+    return '\n'.join(statements)
+
+
+def create_stats_table(cursor, schema='main'):
+    """Сводная таблица статистики (без триггеров - для архивов сезонов)"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.TestStats (
+            dimension TEXT NOT NULL,
+            city_key TEXT NOT NULL DEFAULT '',
+            school_key TEXT NOT NULL DEFAULT '',
+            class_key TEXT NOT NULL DEFAULT '',
+            level TEXT NOT NULL,
+            city TEXT DEFAULT '',
+            school TEXT DEFAULT '',
+            class_name TEXT DEFAULT '',
+            count INTEGER NOT NULL DEFAULT 0,
+            scored_count INTEGER NOT NULL DEFAULT 0,
+            percent_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY ({STATS_KEY})
+        ) WITHOUT ROWID
+    ''')
+
+
+def create_stats_schema(cursor):
+    """Сводная таблица статистики и триггеры, поддерживающие её при любых изменениях Test"""
+    create_stats_table(cursor)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_test_stats_insert AFTER INSERT ON Test
+        BEGIN {_stats_trigger_sql('NEW.', 1)} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_test_stats_delete AFTER DELETE ON Test
+        BEGIN {_stats_trigger_sql('OLD.', -1)} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_test_stats_update
+        AFTER UPDATE OF score, max_score, level, city_key, school_key, class_key ON Test
+        BEGIN {_stats_trigger_sql('OLD.', -1)} {_stats_trigger_sql('NEW.', 1)} END
+    ''')
+
+
+def _aggregate_stats_sql(dimension, table='Test'):
+    """Запрос, считающий разрез статистики с нуля по таблице Test (table - например, archive.Test)"""
+    keys, names = _stats_columns(dimension, '')
+    group_keys = [key for key in keys if key != "''"] + ['level']
+    return f'''
+        SELECT '{dimension}' AS dimension, {', '.join(f'{k} AS {c}' for k, c in zip(keys, ('city_key', 'school_key', 'class_key')))},
+               level, {', '.join(f'MIN({n}) AS {c}' if n != "''" else f"'' AS {c}" for n, c in zip(names, ('city', 'school', 'class_name')))},
+               COUNT(*) AS count, SUM(max_score > 0) AS scored_count, SUM({PERCENT_SQL.format(p='')}) AS percent_sum
+        FROM {table}
+        GROUP BY {', '.join(group_keys)}
+    '''
+
+
+def fill_statistics(cursor, schema='main'):
+    """Заполнение сводной статистики с нуля в текущей транзакции; возвращает число строк сводки.
+
+    schema - подключённая БД (например, архив сезона), в которой пересчитывается сводка.
+    """
+    cursor.execute(f'DELETE FROM {schema}.TestStats')
+    for dimension in STATS_DIMENSIONS:
+        cursor.execute(f'''
+            INSERT INTO {schema}.TestStats ({STATS_KEY}, city, school, class_name, count, scored_count, percent_sum)
+            {_aggregate_stats_sql(dimension, f'{schema}.Test')}
+        ''')
+    cursor.execute(f'SELECT COUNT(*) FROM {schema}.TestStats')
+    return cursor.fetchone()[0]
+
+
+def rebuild_statistics():
+    """Пересчёт сводной статистики с нуля"""
     try:
-        conn = get_connection()
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            rows = fill_statistics(cursor)
+            conn.commit()
+            bump_generation()
+            logger.info("Сводная статистика пересчитана", extra={'rows': rows})
+            return rows
+    
+    except Exception as e:
+        logger.error("Ошибка при пересчёте статистики", extra={'error': str(e)})
+        raise
+
+
+def check_statistics():
+    """Сверка сводной статистики с таблицей Test; возвращает список расхождений"""
+    mismatches = []
+    with get_connection() as conn:
         cursor = conn.cursor()
-        
-        # Удаляем старые лишние таблицы если есть
-        cursor.execute('DROP TABLE IF EXISTS Answers')
-        cursor.execute('DROP TABLE IF EXISTS TestResults')
-        cursor.execute('DROP TABLE IF EXISTS Users')
-        
-        cursor.execute('''
+        for dimension in STATS_DIMENSIONS:
+            cursor.execute(f'''
+                SELECT fresh.city_key, fresh.school_key, fresh.class_key, fresh.level,
+                       fresh.count AS expected_count, s.count AS actual_count,
+                       fresh.percent_sum AS expected_sum, s.percent_sum AS actual_sum
+                FROM ({_aggregate_stats_sql(dimension)}) AS fresh
+                LEFT JOIN TestStats s
+                  ON s.dimension = fresh.dimension AND s.city_key = fresh.city_key AND s.school_key = fresh.school_key
+                 AND s.class_key = fresh.class_key AND s.level = fresh.level
+                WHERE s.count IS NULL OR s.count != fresh.count OR ABS(s.percent_sum - fresh.percent_sum) > 1e-6
+            ''')
+            mismatches.extend(dict(row, dimension=dimension) for row in cursor.fetchall())
+            # Строки сводки, для которых в Test уже ничего нет
+            cursor.execute(f'''
+                SELECT s.city_key, s.school_key, s.class_key, s.level, 0 AS expected_count, s.count AS actual_count
+                FROM TestStats s
+                LEFT JOIN ({_aggregate_stats_sql(dimension)}) AS fresh
+                  ON s.city_key = fresh.city_key AND s.school_key = fresh.school_key
+                 AND s.class_key = fresh.class_key AND s.level = fresh.level
+                WHERE s.dimension = ? AND s.count != 0 AND fresh.level IS NULL
+            ''', (dimension,))
+            mismatches.extend(dict(row, dimension=dimension) for row in cursor.fetchall())
+    return mismatches
+
+
+# Миграции схемы. Номер применённой миграции хранится в PRAGMA user_version.
+# Шаги миграции идемпотентны: старые БД (user_version = 0), в которых часть схемы
+# уже создана прежним init_db, проходят все миграции без ошибок
+MIGRATION_LOCK_TIMEOUT = 60  # сколько ждать блокировку, пока другой процесс применяет миграцию, секунд
+BACKFILL_BATCH_SIZE = 1000
+
+
+class Backfill:
+    """Шаг миграции, заполняющий данные пачками по возрастанию id: каждая пачка - отдельная
+    короткая транзакция, чтобы большая БД не держала блокировку записи всё время миграции.
+
+    condition - строки, которые ещё нужно заполнить. deferred - без заполнения данные остаются
+    рабочими (например, ответы в JSON): при старте сервера такой шаг выполняет фоновый поток.
+    Остальные шаги при старте не выполняются: нужен python manage.py migrate.
+    """
+
+    def __init__(self, fill, condition, deferred=False, batch_size=BACKFILL_BATCH_SIZE):
+        self.fill = fill
+        self.condition = condition
+        self.deferred = deferred
+        self.batch_size = batch_size
+
+    def pending(self, cursor):
+        cursor.execute(f'SELECT 1 FROM Test WHERE {self.condition} LIMIT 1')
+        return cursor.fetchone() is not None
+
+    def run(self, conn, begin):
+        """Заполнение пачками до исчерпания; begin() открывает транзакцию пачки (False - прервать).
+
+        Возвращает число строк или None, если заполнение прервано.
+        """
+        cursor = conn.cursor()
+        total = 0
+        last_id = 0
+        while True:
+            if not begin():
+                return None
+            rows, last_id = self.fill(cursor, last_id, self.batch_size)
+            conn.commit()
+            total += rows
+            if rows < self.batch_size:
+                break
+        if total:
+            logger.info("Миграция заполнила данные", extra={'step': self.fill.__name__, 'rows': total})
+        return total
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return any(row['name'] == column for row in cursor.fetchall())
+
+
+def _add_column(cursor, table, column, definition):
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет"""
+    if not _column_exists(cursor, table, column):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _migrate_base_schema(cursor):
+    # Таблицы первых версий приложения
+    cursor.execute('DROP TABLE IF EXISTS Answers')
+    cursor.execute('DROP TABLE IF EXISTS TestResults')
+    cursor.execute('DROP TABLE IF EXISTS Users')
+    cursor.execute('''
         CREATE TABLE IF NOT EXISTS Test (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             first_name TEXT NOT NULL,
@@ -41,295 +581,1413 @@ def init_db():
             time_spent INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
+    ''')
+
+
+def _migrate_location_columns(cursor):
+    # БД, созданные до появления города и школы
+    _add_column(cursor, 'Test', 'school', "TEXT DEFAULT ''")
+    _add_column(cursor, 'Test', 'city', "TEXT DEFAULT ''")
+
+
+def _migrate_key_columns(cursor):
+    for key_column, _ in KEY_COLUMNS:
+        _add_column(cursor, 'Test', key_column, 'TEXT')
+
+
+def _migrate_location_index(cursor):
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_test_location
+        ON Test (city_key, school_key, class_key, last_name_key, first_name_key)
+    ''')
+
+
+def _migrate_student_index(cursor):
+    # Уникальный индекс закрывает гонку двух одновременных отправок одного ученика
+    _add_column(cursor, 'Test', 'repeat_attempts', 'INTEGER DEFAULT 0')
+    try:
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_test_student
+            ON Test (last_name_key, first_name_key, class_key, level)
         ''')
-        
-        # Добавляем колонки если их нет (для существующих БД)
-        try:
-            cursor.execute('ALTER TABLE Test ADD COLUMN school TEXT DEFAULT ""')
-        except:
-            pass
+        cursor.execute('DROP INDEX IF EXISTS idx_test_student')
+    except sqlite3.IntegrityError:
+        logger.warning("В БД есть повторные прохождения, уникальный индекс не создан")
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_test_student
+            ON Test (last_name_key, first_name_key, class_key, level)
+        ''')
+
+
+def _migrate_page_indexes(cursor):
+    # Индексы под постраничную выдачу по курсору (created_at, id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_test_created ON Test (created_at, id)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_test_location_created
+        ON Test (city_key, school_key, created_at, id)
+    ''')
+
+
+def _migrate_statistics(cursor):
+    # Для существующих данных сводка заполняется один раз, при создании таблицы
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'TestStats'")
+    stats_existed = cursor.fetchone() is not None
+    create_stats_schema(cursor)
+    if not stats_existed:
+        rows = fill_statistics(cursor)
+        if rows:
+            logger.info("Сводная статистика пересчитана", extra={'rows': rows})
+
+
+def _migrate_compact_answers(cursor):
+    _add_column(cursor, 'Test', 'choices', 'TEXT')
+    _add_column(cursor, 'Test', 'correct_mask', 'INTEGER DEFAULT 0')
+    # Правильные ответы - один раз на уровень
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS AnswerKey (
+            level TEXT PRIMARY KEY,
+            correct_answers TEXT NOT NULL
+        )
+    ''')
+
+
+def _migrate_search_index(cursor):
+    # Триграммный полнотекстовый индекс по ключам поиска; данные берутся из Test (content='Test'),
+    # триггеры поддерживают индекс при вставке, изменении и удалении строк (в т.ч. при очистке БД)
+    try:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS TestSearch USING fts5(
+                {', '.join(SEARCH_COLUMNS)}, content='Test', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # FTS5 с токенизатором trigram есть в SQLite 3.34+; без него поиск работает перебором
+        logger.warning("Полнотекстовый индекс недоступен, поиск будет медленнее", extra={'error': str(e)})
+        return
+    columns = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join(f'NEW.{column}' for column in SEARCH_COLUMNS)
+    old_values = ', '.join(f'OLD.{column}' for column in SEARCH_COLUMNS)
+    # Словарь фамилий и имён для поиска с опечатками: слов намного меньше, чем попыток
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS SearchTerm (
+            id INTEGER PRIMARY KEY,
+            term TEXT NOT NULL UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS SearchTermIndex USING fts5(
+            term, content='SearchTerm', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    add_terms = '''
+        INSERT OR IGNORE INTO SearchTerm (term)
+        SELECT value FROM (SELECT NEW.last_name_key AS value UNION SELECT NEW.first_name_key) WHERE value != '';
+    '''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_test_search_insert AFTER INSERT ON Test
+        BEGIN
+            INSERT INTO TestSearch (rowid, {columns}) VALUES (NEW.id, {new_values});
+            {add_terms}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_test_search_delete AFTER DELETE ON Test
+        BEGIN INSERT INTO TestSearch (TestSearch, rowid, {columns}) VALUES ('delete', OLD.id, {old_values}); END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_test_search_update AFTER UPDATE OF {columns} ON Test
+        BEGIN
+            INSERT INTO TestSearch (TestSearch, rowid, {columns}) VALUES ('delete', OLD.id, {old_values});
+            INSERT INTO TestSearch (rowid, {columns}) VALUES (NEW.id, {new_values});
+            {add_terms}
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_search_term_insert AFTER INSERT ON SearchTerm
+        BEGIN INSERT INTO SearchTermIndex (rowid, term) VALUES (NEW.id, NEW.term); END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_search_term_delete AFTER DELETE ON SearchTerm
+        BEGIN INSERT INTO SearchTermIndex (SearchTermIndex, rowid, term) VALUES ('delete', OLD.id, OLD.term); END
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO SearchTerm (term)
+        SELECT last_name_key FROM Test WHERE last_name_key != ''
+        UNION SELECT first_name_key FROM Test WHERE first_name_key != ''
+    ''')
+    cursor.execute("INSERT INTO TestSearch (TestSearch) VALUES ('rebuild')")
+
+
+def _migrate_answer_key_version(cursor):
+    # Одна строка-счётчик: её повышает set_answer_key, кэш ключей сверяется с ней,
+    # а не с поколением данных, которое меняет каждая попытка
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS AnswerKeyVersion (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO AnswerKeyVersion (id, version) VALUES (1, 0)')
+
+
+# (номер, описание, шаги); номера идут подряд, новые миграции добавляются в конец
+MIGRATIONS = [
+    (1, 'Базовая схема', [_migrate_base_schema]),
+    (2, 'Город и школа', [_migrate_location_columns]),
+    (3, 'Ключи поиска', [_migrate_key_columns, Backfill(backfill_keys, 'first_name_key IS NULL'),
+                         _migrate_location_index]),
+    (4, 'Уникальный индекс ученика', [_migrate_student_index]),
+    (5, 'Индексы постраничной выдачи', [_migrate_page_indexes]),
+    (6, 'Сводная статистика', [_migrate_statistics]),
+    (7, 'Компактные ответы', [_migrate_compact_answers, Backfill(compact_answers, 'choices IS NULL', deferred=True)]),
+    (8, 'Поисковый индекс', [_migrate_search_index]),
+    (9, 'Версия ключей ответов', [_migrate_answer_key_version]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _begin_exclusive(conn, timeout=MIGRATION_LOCK_TIMEOUT):
+    """BEGIN EXCLUSIVE с ожиданием, пока другой процесс применяет миграцию"""
+    deadline = time.monotonic() + timeout
+    while True:
         try:
-            cursor.execute('ALTER TABLE Test ADD COLUMN city TEXT DEFAULT ""')
-        except:
-            pass
-        
+            conn.execute('BEGIN EXCLUSIVE')
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() > deadline:
+                raise
+            metrics.inc('webhistory_db_retries_total', operation='migration_lock')
+
+
+def get_schema_version(cursor):
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+
+def _begin_migration(conn, number):
+    """Монопольная транзакция для шага миграции number; False (без транзакции), если другой
+    процесс уже применил её, пока этот ждал блокировку"""
+    _begin_exclusive(conn)
+    if get_schema_version(conn.cursor()) >= number:
+        conn.rollback()
+        return False
+    return True
+
+
+class BackfillRequired(RuntimeError):
+    """Миграции нужно заполнить существующие строки - это делает python manage.py migrate"""
+
+
+def _run_step(conn, step, number, backfill):
+    """Шаг миграции: схема - одной транзакцией, Backfill - пачками до исчерпания.
+
+    Без backfill (старт сервера) заполнение не выполняется: отложенное оставляется фоновому
+    потоку, а для обязательного при наличии строк - BackfillRequired.
+    Версия перечитывается в каждой транзакции; False - миграция уже применена другим процессом.
+    """
+    cursor = conn.cursor()
+    if not isinstance(step, Backfill):
+        if not _begin_migration(conn, number):
+            return False
+        step(cursor)
         conn.commit()
-        conn.close()
-        print("База данных успешно инициализирована")
+        return True
+    if not backfill:
+        if not step.deferred and step.pending(cursor):
+            raise BackfillRequired(f'Миграция {number} заполняет существующие строки: выполните python manage.py migrate')
+        return True
+    return step.run(conn, lambda: _begin_migration(conn, number)) is not None
+
+
+def migrate(target=SCHEMA_VERSION, backfill=True):
+    """Применение миграций до версии target; возвращает список применённых номеров.
+
+    Каждая миграция применяется под монопольной блокировкой, а user_version повышается
+    после всех её шагов. Если несколько процессов стартуют одновременно, второй ждёт
+    блокировку и перечитывает версию в каждой транзакции шага: миграцию, которую успел
+    применить другой процесс, он пропускает, а прерванное заполнение пачками продолжается
+    с места остановки. backfill=False - без заполнения существующих строк (см. _run_step).
+    """
+    applied = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        version = get_schema_version(cursor)
+        if version > SCHEMA_VERSION:
+            logger.warning("Схема БД новее приложения", extra={'version': version, 'expected': SCHEMA_VERSION})
+        for number, description, steps in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            start = time.perf_counter()
+            if not all(_run_step(conn, step, number, backfill) for step in steps):
+                version = get_schema_version(cursor)
+                continue
+            _begin_exclusive(conn)
+            if get_schema_version(cursor) == number - 1:
+                cursor.execute(f'PRAGMA user_version = {number}')
+                applied.append(number)
+                logger.info("Миграция применена", extra={
+                    'version': number, 'migration': description,
+                    'duration_ms': round((time.perf_counter() - start) * 1000, 1)
+                })
+            conn.commit()
+            version = get_schema_version(cursor)
+    return applied
+
+
+def _schema_object_exists(cursor, name):
+    cursor.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name,))
+    return cursor.fetchone() is not None
+
+
+def _detect_indexes(cursor):
+    global _unique_student_index, _search_index
+    _unique_student_index = _schema_object_exists(cursor, 'uq_test_student')
+    _search_index = _schema_object_exists(cursor, 'TestSearch')
+
+
+def run_backfills():
+    """Отложенные заполнения (Backfill с deferred) уже применённых миграций; возвращает число строк.
+
+    Пачки идут в обычных транзакциях записи: отправки тестов проходят между ними.
+    """
+    total = 0
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        def begin():
+            cursor.execute('BEGIN IMMEDIATE')
+            return True
+        
+        version = get_schema_version(cursor)
+        for number, _, steps in MIGRATIONS:
+            for step in steps:
+                if number <= version and isinstance(step, Backfill) and step.deferred and step.pending(cursor):
+                    total += step.run(conn, begin)
+    if total:
+        bump_generation()
+    return total
+
+
+def enable_incremental_vacuum():
+    """Перевести существующую БД в режим auto_vacuum=INCREMENTAL; возвращает True, если режим сменился.
+
+    Требует полного VACUUM (перезапись файла под блокировкой записи), поэтому вызывается только
+    из manage.py migrate, а не из сервера.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        started = time.perf_counter()
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        logger.info("БД переведена в режим incremental_vacuum", extra={
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+    return True
+
+
+def _run_backfills_in_background():
+    try:
+        run_backfills()
+    except Exception as e:
+        logger.error("Ошибка при заполнении данных миграции", extra={'error': str(e)})
+
+
+def start_backfills():
+    """Отложенные заполнения в фоновом потоке - старт сервера их не ждёт"""
+    threading.Thread(target=_run_backfills_in_background, name='backfill', daemon=True).start()
+
+
+def init_db(backfill=False):
+    """Инициализация базы данных: миграции схемы (если схема не последней версии).
+
+    При старте сервера (backfill=False) существующие строки не заполняются - см. _run_step;
+    manage.py вызывает init_db(backfill=True) и выполняет миграции полностью.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            current = get_schema_version(cursor) >= SCHEMA_VERSION
+            if current:
+                _detect_indexes(cursor)
+                return
+        
+        applied = migrate(backfill=backfill)
+        bump_generation()
+        with get_connection() as conn:
+            _detect_indexes(conn.cursor())
+        logger.info("База данных успешно инициализирована", extra={'migrations': applied, 'version': SCHEMA_VERSION})
         
     except Exception as e:
-        print(f"Ошибка при инициализации базы данных: {str(e)}")
+        logger.error("Ошибка при инициализации базы данных", extra={'error': str(e)})
         raise
 
 
 def clear_db():
     """Полная очистка базы данных"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('DELETE FROM Test')
-        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'Test'")
+            # Счётчик id не сбрасывается: id попыток не повторяются (архивы сезонов, живая лента)
+            cursor.execute('DELETE FROM Test')
+            cursor.execute('DELETE FROM TestStats')
+            # Поисковый индекс попыток очищают триггеры, словарь имён - здесь
+            if _search_index:
+                cursor.execute('DELETE FROM SearchTerm')
         
-        conn.commit()
-        conn.close()
-        print("База данных успешно очищена")
+            conn.commit()
+            bump_generation()
+            score_ranks.reset()
+            logger.info("База данных успешно очищена")
         
     except Exception as e:
-        print(f"Ошибка при очистке базы данных: {str(e)}")
+        logger.error("Ошибка при очистке базы данных", extra={'error': str(e)})
         raise
 
 
 def check_test_exists(first_name, last_name, class_name, level):
     """Проверка, проходил ли пользователь данный тест"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT id, score, max_score, created_at FROM Test 
-            WHERE LOWER(first_name) = LOWER(?) 
-            AND LOWER(last_name) = LOWER(?) 
-            AND LOWER(class_name) = LOWER(?) 
-            AND level = ?
-        ''', (first_name.strip(), last_name.strip(), class_name.strip(), level))
+            cursor.execute('''
+                SELECT id, score, max_score, created_at FROM Test 
+                WHERE last_name_key = ? 
+                AND first_name_key = ? 
+                AND class_key = ? 
+                AND level = ?
+            ''', (normalize_key(last_name), normalize_key(first_name), normalize_key(class_name), level))
         
-        row = cursor.fetchone()
-        conn.close()
+            row = cursor.fetchone()
         
-        if row:
-            return {
-                'exists': True,
-                'test_id': row['id'],
-                'score': row['score'],
-                'max_score': row['max_score'],
-                'created_at': row['created_at']
-            }
-        return {'exists': False}
+            if row:
+                return {
+                    'exists': True,
+                    'test_id': row['id'],
+                    'score': row['score'],
+                    'max_score': row['max_score'],
+                    'created_at': row['created_at']
+                }
+            return {'exists': False}
         
     except Exception as e:
-        print(f"Ошибка при проверке существования теста: {str(e)}")
+        logger.error("Ошибка при проверке существования теста", extra={'error': str(e)})
         return {'exists': False}
 
 
+# Компактное хранение ответов: строка выбранных вариантов (по символу на вопрос)
+# и битовая маска правильности; правильные ответы хранятся один раз на уровень в AnswerKey.
+# Ответы, которые так не упаковываются, остаются JSON в колонке answers.
+MISSING_CHOICE = '-'
+MAX_PACKED_QUESTIONS = 63
+ANSWER_FIELDS = {'question', 'answer', 'correct_answer', 'correct'}
+
+_answer_keys = {}
+_answer_keys_lock = threading.Lock()
+_answer_keys_path = None
+_answer_keys_version = None
+
+
+def _select_answer_key(level, cursor):
+    cursor.execute('SELECT correct_answers FROM AnswerKey WHERE level = ?', (level,))
+    found = cursor.fetchone()
+    return found[0] if found else None
+
+
+def _insert_answer_key(level, candidate, cursor):
+    """Первая запись ключа уровня; если другой процесс успел раньше, остаётся его ключ"""
+    cursor.execute('INSERT OR IGNORE INTO AnswerKey (level, correct_answers) VALUES (?, ?)', (level, candidate))
+    return _select_answer_key(level, cursor)
+
+
+def get_answer_key(level, candidate=None, cursor=None):
+    """Строка правильных ответов уровня (кэшируется в памяти до смены версии ключей).
+
+    Кэш сбрасывается, когда меняется AnswerKeyVersion: ключ мог поменять пересчёт
+    (manage.py regrade) в другом процессе. Обычные записи попыток кэш не сбрасывают.
+    candidate - ключ, который будет записан, если для уровня ключа ещё нет;
+    cursor - курсор уже открытой транзакции (например, при миграции).
+    """
+    global _answer_keys_path, _answer_keys_version
+    # Версия читается до ключа: изменение после чтения сбросит кэш при следующем вызове
+    version = get_answer_keys_version()
+    with _answer_keys_lock:
+        if _answer_keys_path != DATABASE_PATH or _answer_keys_version != version:
+            _answer_keys.clear()
+            _answer_keys_path = DATABASE_PATH
+            _answer_keys_version = version
+        if level in _answer_keys:
+            return _answer_keys[level]
+    
+    # Запись в AnswerKey - только для уровня без ключа, не при каждой отправке
+    if cursor is not None:
+        key = _select_answer_key(level, cursor)
+        if key is None and candidate:
+            key = _insert_answer_key(level, candidate, cursor)
+    else:
+        with get_connection() as conn:
+            key = _select_answer_key(level, conn.cursor())
+            if key is None and candidate:
+                key = _insert_answer_key(level, candidate, conn.cursor())
+                conn.commit()
+    
+    if key is not None:
+        with _answer_keys_lock:
+            _answer_keys[level] = key
+    return key
+
+
+def set_answer_key(level, key, cursor):
+    """Запись ключа уровня в открытой транзакции (кэш сбрасывается после коммита - forget_answer_keys).
+
+    Повышает AnswerKeyVersion: по ней другие процессы сбрасывают свой кэш ключей.
+    """
+    cursor.execute('''
+        INSERT INTO AnswerKey (level, correct_answers) VALUES (?, ?)
+        ON CONFLICT (level) DO UPDATE SET correct_answers = excluded.correct_answers
+    ''', (level, key))
+    cursor.execute('UPDATE AnswerKeyVersion SET version = version + 1')
+
+
+def forget_answer_keys():
+    """Сброс кэша ключей уровней"""
+    with _answer_keys_lock:
+        _answer_keys.clear()
+
+
+def _packable_char(value):
+    return isinstance(value, str) and len(value) == 1 and value != MISSING_CHOICE and value.isascii()
+
+
+def pack_answers(level, answers, cursor=None, key=None):
+    """Упаковка списка ответов: (answers_json или '', строка вариантов, маска правильности).
+
+    key - ключ уровня, если он уже известен (иначе берётся из AnswerKey).
+    """
+    mask = 0
+    for i, answer in enumerate(answers[:MAX_PACKED_QUESTIONS]):
+        if isinstance(answer, dict) and answer.get('correct'):
+            mask |= 1 << i
+    
+    regular = (
+        0 < len(answers) <= MAX_PACKED_QUESTIONS
+        and all(
+            isinstance(answer, dict)
+            and set(answer) == ANSWER_FIELDS
+            and answer['question'] == i + 1
+            and (answer['answer'] is None or _packable_char(answer['answer']))
+            and _packable_char(answer['correct_answer'])
+            and isinstance(answer['correct'], bool)
+            for i, answer in enumerate(answers)
+        )
+    )
+    if regular:
+        candidate = ''.join(answer['correct_answer'] for answer in answers)
+        if (key or get_answer_key(level, candidate, cursor)) == candidate:
+            choices = ''.join(answer['answer'] or MISSING_CHOICE for answer in answers)
+            return '', choices, mask
+    
+    return json.dumps(answers, ensure_ascii=False), '', mask
+
+
+def unpack_answers(level, answers_json, choices, mask, key=None):
+    """Восстановление списка ответов в прежнем формате API"""
+    if answers_json:
+        return json.loads(answers_json)
+    if not choices:
+        return []
+    key = key or get_answer_key(level)
+    return [
+        {
+            'question': i + 1,
+            'answer': None if choice == MISSING_CHOICE else choice,
+            'correct_answer': key[i],
+            'correct': bool(mask >> i & 1)
+        }
+        for i, choice in enumerate(choices)
+    ]
+
+
+INSERT_TEST_SQL = '''
+    INSERT INTO Test (first_name, last_name, class_name, city, school, answers, score, max_score, level, time_spent,
+                      first_name_key, last_name_key, class_key, city_key, school_key, choices, correct_mask)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def prepare_test_row(first_name, last_name, class_name, city, school, answers, score, level, time=0):
+    """Подготовка параметров для INSERT_TEST_SQL"""
+    # Ответы могут прийти списком или JSON строкой
+    if not isinstance(answers, list):
+        answers = json.loads(answers)
+    
+    # Город - из справочника регионов, школа - номер (ValueError при ошибке)
+    city, school = validate_location(city, school)
+    
+    max_score = len(answers)
+    answers_json, choices, mask = pack_answers(level, answers)
+    
+    return (first_name.strip(), last_name.strip(), class_name.strip(), city, school, answers_json, score, max_score, level, time,
+            normalize_key(first_name), normalize_key(last_name), normalize_key(class_name), normalize_key(city), normalize_key(school),
+            choices, mask)
+
+
+LIVE_FIELDS = ('id', 'first_name', 'last_name', 'class_name', 'class_key', 'city', 'school', 'level',
+               'score', 'max_score', 'time_spent', 'created_at')
+
+
+def attempt_event(fields):
+    """Событие живой ленты: сводка попытки без ответов и правильность по вопросам (0/1)"""
+    event = {name: fields[name] for name in LIVE_FIELDS}
+    event['time_spent'] = event['time_spent'] or 0
+    event['correct'] = [fields['correct_mask'] >> i & 1 for i in range(min(fields['max_score'], MAX_PACKED_QUESTIONS))]
+    return event
+
+
+_saving_attempts = 0
+_saving_attempts_lock = threading.Lock()
+
+
+@contextmanager
+def saving_attempts():
+    """Блок от коммита новых попыток до attempt_saved: пока он идёт, расхождение индекса
+    процентилей с БД объясняется записями этого процесса, а не другого (см. refresh_score_ranks)"""
+    global _saving_attempts
+    with _saving_attempts_lock:
+        _saving_attempts += 1
+    try:
+        yield
+    finally:
+        with _saving_attempts_lock:
+            _saving_attempts -= 1
+
+
+def _saved_attempt_event(saved):
+    """Событие живой ленты по (строка prepare_test_row, id, created_at)"""
+    row, test_id, created_at = saved
+    fields = dict(zip(('first_name', 'last_name', 'class_name', 'city', 'school'), row[:5]),
+                  id=test_id, score=row[6], max_score=row[7], level=row[8], time_spent=row[9],
+                  class_key=row[12], created_at=created_at, correct_mask=row[16])
+    return attempt_event(fields)
+
+
+def attempts_saved(saved):
+    """Учёт новых попыток [(строка prepare_test_row, id, created_at)] после коммита: распределение
+    баллов для процентилей и живая лента панелей учителей - один раз на пачку"""
+    score_ranks.add_many([(row[8], row[13], row[14], row[6], test_id) for row, test_id, _ in saved])
+    live_feed.publish_many([(item, item[0][13], item[0][14]) for item in saved], _saved_attempt_event)
+
+
+def attempt_saved(row, test_id, created_at):
+    """Учёт одной новой попытки (см. attempts_saved)"""
+    attempts_saved([(row, test_id, created_at)])
+
+
+# Как часто фоновый поток сверяет индекс процентилей с БД, секунд
+SCORE_RANKS_REFRESH_SECONDS = float(os.environ.get('SCORE_RANKS_REFRESH_SECONDS', '1'))
+
+_score_ranks_data_version = None
+_score_ranks_stop = threading.Event()
+_score_ranks_thread = None
+
+
+def _score_ranks_state(cursor):
+    """Наибольший id попытки и версия ключей - по ним видно, что баллы меняли в обход индекса"""
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM Test')
+    max_id = cursor.fetchone()[0]
+    cursor.execute('SELECT version FROM AnswerKeyVersion')
+    return max_id, cursor.fetchone()[0]
+
+
+def get_score_distribution():
+    """Число попыток по (уровень, город, школа, балл) с наибольшим id и версией ключей -
+    для индекса процентилей score_ranks (одним снимком БД)"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            cursor.execute('''
+                SELECT level, city_key, school_key, score, COUNT(*) FROM Test
+                GROUP BY level, city_key, school_key, score
+            ''')
+            rows = [tuple(row) for row in cursor.fetchall()]
+            max_id, version = _score_ranks_state(cursor)
+        finally:
+            conn.rollback()
+        return rows, max_id, version
+
+
+def load_score_ranks():
+    """Пересборка индекса процентилей по БД (при старте, после пересчёта баллов и архивирования)"""
+    total = score_ranks.reload(get_score_distribution)
+    logger.info("Распределение баллов загружено", extra={'rows': total, **score_ranks.get_stats()})
+    return total
+
+
+def refresh_score_ranks():
+    """Пересборка индекса процентилей, если попытки или ключи изменил другой процесс
+    (manage.py regrade, import-results, archive).
+
+    Свои попытки процесс учитывает сам (attempts_saved), поэтому проверка нужна только после
+    коммитов других соединений - при смене PRAGMA data_version. Число попыток по уровням
+    из TestStats, наибольший id и версия ключей сравниваются с тем, по чему построен индекс.
+    """
+    global _score_ranks_data_version
+    data_version = get_generation()[1]
+    if data_version == _score_ranks_data_version:
+        return
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            cursor.execute("SELECT level, count FROM TestStats WHERE dimension = 'level' AND count > 0")
+            totals = {row[0]: row[1] for row in cursor.fetchall()}
+            max_id, version = _score_ranks_state(cursor)
+        finally:
+            conn.rollback()
+    if not score_ranks.matches(totals, max_id, version):
+        if _saving_attempts or score_ranks.max_id() > max_id:
+            # Расхождение дали попытки этого процесса, сохранённые во время проверки:
+            # она повторится при следующем вызове
+            return
+        load_score_ranks()
+    _score_ranks_data_version = data_version
+
+
+def _refresh_score_ranks_loop(interval):
+    while not _score_ranks_stop.wait(interval):
+        try:
+            refresh_score_ranks()
+        except Exception as e:
+            logger.error("Ошибка при сверке распределения баллов", extra={'error': str(e)})
+
+
+def start_score_ranks_refresh(interval=SCORE_RANKS_REFRESH_SECONDS):
+    """Фоновая сверка индекса процентилей с БД: пересборка идёт вне обработки запросов"""
+    global _score_ranks_thread
+    if _score_ranks_thread is not None:
+        return
+    _score_ranks_stop.clear()
+    _score_ranks_thread = threading.Thread(
+        target=_refresh_score_ranks_loop, args=(interval,), name='score-ranks', daemon=True
+    )
+    _score_ranks_thread.start()
+
+
+def stop_score_ranks_refresh():
+    global _score_ranks_thread
+    if _score_ranks_thread is None:
+        return
+    _score_ranks_stop.set()
+    _score_ranks_thread.join()
+    _score_ranks_thread = None
+
+
+def get_attempts_since(since_id, city=None, school=None, limit=1000):
+    """Попытки с id больше since_id (от старых к новым) в формате событий живой ленты"""
+    conditions, params = location_filter(city, school)
+    conditions.insert(0, 'id > ?')
+    params.insert(0, since_id)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT {', '.join(LIVE_FIELDS)}, correct_mask FROM Test
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id
+            LIMIT ?
+        ''', params + [limit])
+        return [attempt_event(row) for row in cursor.fetchall()]
+
+
 def save_test_result(first_name, last_name, class_name, city, school, answers, score, level, time=0):
     """Сохранение результатов теста в базу данных"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        # Преобразование списка ответов в JSON строку
-        if isinstance(answers, list):
-            answers_json = json.dumps(answers, ensure_ascii=False)
-        else:
-            answers_json = answers
+            row = prepare_test_row(first_name, last_name, class_name, city, school, answers, score, level, time)
+            cursor.execute(INSERT_TEST_SQL + ' RETURNING id, created_at', row)
+            result = cursor.fetchone()
+            test_id = result['id']
+            with saving_attempts():
+                conn.commit()
+                bump_generation()
+                attempt_saved(row, test_id, result['created_at'])
         
-        max_score = len(json.loads(answers_json) if isinstance(answers_json, str) else answers)
+            return test_id
         
-        cursor.execute('''
-        INSERT INTO Test (first_name, last_name, class_name, city, school, answers, score, max_score, level, time_spent)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (first_name.strip(), last_name.strip(), class_name.strip(), city.strip() if city else '', school.strip() if school else '', answers_json, score, max_score, level, time))
+    except Exception as e:
+        logger.error("Ошибка при сохранении результатов теста в БД", extra={'error': str(e)})
+        raise
+
+
+def submit_test_result(first_name, last_name, class_name, city, school, answers, score, level, time=0):
+    """Атомарное сохранение результата: одна вставка, при повторе возвращается уже сохранённый результат"""
+    try:
+        row = prepare_test_row(first_name, last_name, class_name, city, school, answers, score, level, time)
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        test_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+            if _unique_student_index:
+                # При конфликте запись не меняется, только растёт счётчик повторных попыток:
+                # по нему и отличаем новую запись (0) от уже существующей
+                cursor.execute(INSERT_TEST_SQL + '''
+                    ON CONFLICT (last_name_key, first_name_key, class_key, level)
+                    DO UPDATE SET repeat_attempts = repeat_attempts + 1
+                    RETURNING id, score, max_score, created_at, repeat_attempts
+                ''', row)
+                result = cursor.fetchone()
+                created = result['repeat_attempts'] == 0
+            else:
+                # Без уникального индекса проверка и вставка идут под одной блокировкой записи
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute('''
+                    SELECT id, score, max_score, created_at FROM Test
+                    WHERE last_name_key = ? AND first_name_key = ? AND class_key = ? AND level = ?
+                ''', (row[11], row[10], row[12], level))
+                result = cursor.fetchone()
+                created = result is None
+                if created:
+                    cursor.execute(INSERT_TEST_SQL + ' RETURNING id, score, max_score, created_at', row)
+                    result = cursor.fetchone()
+            with saving_attempts():
+                conn.commit()
+                if created:
+                    bump_generation()
+                    attempt_saved(row, result['id'], result['created_at'])
         
-        return test_id
+            return {
+                'created': created,
+                'test_id': result['id'],
+                'score': result['score'],
+                'max_score': result['max_score'],
+                'created_at': result['created_at']
+            }
         
     except Exception as e:
-        print(f"Ошибка при сохранении результатов теста в БД: {str(e)}")
+        logger.error("Ошибка при сохранении результатов теста в БД", extra={'error': str(e)})
         raise
 
 
+# Архив учебных сезонов: попытки прошлых лет лежат в отдельных файлах archive/season-2024-2025.db
+# рядом с основной БД и подключаются через ATTACH, только когда запрос просит исторические данные
+ARCHIVE_DIR = 'archive'
+ARCHIVE_SCHEMA = 'archive'
+SEASON_START_MONTH = 9  # учебный год начинается 1 сентября
+_SEASON_PATTERN = re.compile(r'(\d{4})-(\d{4})')
+
+
+def season_of(created_at):
+    """Учебный сезон ('2024-2025') по времени попытки в формате created_at"""
+    year, month = int(created_at[:4]), int(created_at[5:7])
+    start = year if month >= SEASON_START_MONTH else year - 1
+    return f'{start}-{start + 1}'
+
+
+def season_bounds(season):
+    """Границы сезона [начало, конец) в формате created_at; ValueError при неверном названии"""
+    match = _SEASON_PATTERN.fullmatch(season or '')
+    if not match or int(match.group(2)) != int(match.group(1)) + 1:
+        raise ValueError(f'Некорректный сезон: {season} (ожидается, например, 2024-2025)')
+    start = int(match.group(1))
+    return f'{start}-{SEASON_START_MONTH:02d}-01 00:00:00', f'{start + 1}-{SEASON_START_MONTH:02d}-01 00:00:00'
+
+
+def get_archive_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), ARCHIVE_DIR)
+
+
+def archive_path(season):
+    season_bounds(season)
+    return os.path.join(get_archive_dir(), f'season-{season}.db')
+
+
+def list_seasons():
+    """Сезоны, для которых есть файл архива, от старых к новым"""
+    try:
+        names = os.listdir(get_archive_dir())
+    except FileNotFoundError:
+        return []
+    seasons = []
+    for name in names:
+        match = re.fullmatch(r'season-(\d{4}-\d{4})\.db', name)
+        if match:
+            seasons.append(match.group(1))
+    return sorted(seasons)
+
+
+@contextmanager
+def attach_season(conn, season, create=False):
+    """Подключение архива сезона к соединению на время блока; возвращает имя схемы для запросов.
+
+    season=None - основная БД ('main'). Без create отсутствующий архив - ValueError.
+    """
+    if not season:
+        yield 'main'
+        return
+    path = archive_path(season)
+    if create:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    elif not os.path.exists(path):
+        raise ValueError(f'Архив сезона {season} не найден')
+    conn.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (path,))
+    try:
+        yield ARCHIVE_SCHEMA
+    finally:
+        # DETACH невозможен внутри транзакции; соединение вернётся в пул без архива
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute(f'DETACH DATABASE {ARCHIVE_SCHEMA}')
+
+
+def get_schema_answer_keys(cursor, schema='main'):
+    """Ключи уровней основной БД или архива одним запросом - для разбора многих строк
+    без обращения к кэшу ключей на каждой строке"""
+    cursor.execute(f'SELECT level, correct_answers FROM {schema}.AnswerKey')
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def row_to_test(row, keys=None):
+    """Преобразование строки таблицы Test в словарь для API (keys - ключи уровней, см. get_schema_answer_keys)"""
+    key = keys.get(row['level']) if keys else None
+    return {
+        'id': row['id'],
+        'first_name': row['first_name'],
+        'last_name': row['last_name'],
+        'class_name': row['class_name'],
+        'city': row['city'] if 'city' in row.keys() else '',
+        'school': row['school'] if 'school' in row.keys() else '',
+        'answers': unpack_answers(row['level'], row['answers'], row['choices'], row['correct_mask'], key),
+        'score': row['score'],
+        'max_score': row['max_score'],
+        'level': row['level'],
+        'time_spent': row['time_spent'],
+        'created_at': row['created_at']
+    }
+
+
 def get_all_tests():
     """Получение всех результатов тестов"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('SELECT * FROM Test ORDER BY created_at DESC')
-        rows = cursor.fetchall()
-        
-        tests = []
-        for row in rows:
-            tests.append({
-                'id': row['id'],
-                'first_name': row['first_name'],
-                'last_name': row['last_name'],
-                'class_name': row['class_name'],
-                'city': row['city'] if 'city' in row.keys() else '',
-                'school': row['school'] if 'school' in row.keys() else '',
-                'answers': json.loads(row['answers']),
-                'score': row['score'],
-                'max_score': row['max_score'],
-                'level': row['level'],
-                'time_spent': row['time_spent'],
-                'created_at': row['created_at']
-            })
+            keys = get_schema_answer_keys(cursor)
+            cursor.execute('SELECT * FROM Test ORDER BY created_at DESC')
+            rows = cursor.fetchall()
         
-        conn.close()
-        return tests
+            return [row_to_test(row, keys) for row in rows]
         
     except Exception as e:
-        print(f"Ошибка при получении результатов тестов: {str(e)}")
+        logger.error("Ошибка при получении результатов тестов", extra={'error': str(e)})
         return []
 
 
 def get_test_by_id(test_id):
     """Получение результата теста по ID"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('SELECT * FROM Test WHERE id = ?', (test_id,))
-        row = cursor.fetchone()
-        
-        if row:
-            test = {
-                'id': row['id'],
-                'first_name': row['first_name'],
-                'last_name': row['last_name'],
-                'class_name': row['class_name'],
-                'city': row['city'] if 'city' in row.keys() else '',
-                'school': row['school'] if 'school' in row.keys() else '',
-                'answers': json.loads(row['answers']),
-                'score': row['score'],
-                'max_score': row['max_score'],
-                'level': row['level'],
-                'time_spent': row['time_spent'],
-                'created_at': row['created_at']
-            }
-            conn.close()
-            return test
+            cursor.execute('SELECT * FROM Test WHERE id = ?', (test_id,))
+            row = cursor.fetchone()
         
-        conn.close()
-        return None
+            return row_to_test(row) if row else None
         
     except Exception as e:
-        print(f"Ошибка при получении результата теста: {str(e)}")
+        logger.error("Ошибка при получении результата теста", extra={'error': str(e)})
         return None
 
 
-def get_statistics():
-    """Получение общей статистики по тестам"""
+def encode_cursor(created_at, test_id):
+    """Непрозрачный курсор страницы по паре (created_at, id)"""
+    raw = json.dumps([created_at, test_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor_value):
+    """Разбор курсора страницы; ValueError, если курсор повреждён"""
     try:
-        conn = get_connection()
+        padded = cursor_value + '=' * (-len(cursor_value) % 4)
+        created_at, test_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return str(created_at), int(test_id)
+    except Exception:
+        raise ValueError('Некорректный курсор страницы')
+
+
+def location_filter(city=None, school=None):
+    """Условия WHERE и параметры для фильтра по городу и школе"""
+    conditions = []
+    params = []
+    if city:
+        conditions.append('city_key = ?')
+        params.append(normalize_key(city))
+    if school:
+        conditions.append('school_key = ?')
+        params.append(normalize_key(school))
+    return conditions, params
+
+
+def iter_tests(city=None, school=None, after=None, limit=None, season=None):
+    """Потоковый обход результатов от новых к старым без загрузки всей таблицы в память.
+
+    after - курсор (см. encode_cursor), с которого продолжается выдача;
+    season - читать архив сезона вместо текущих попыток.
+    """
+    conditions, params = location_filter(city, school)
+    if after:
+        created_at, test_id = decode_cursor(after)
+        conditions.append('(created_at, id) < (?, ?)')
+        params.extend([created_at, test_id])
+    
+    query = 'SELECT * FROM {schema}.Test'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY created_at DESC, id DESC'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    
+    with get_connection() as conn, attach_season(conn, season) as schema:
         cursor = conn.cursor()
+        keys = get_schema_answer_keys(cursor, schema)
+        cursor.execute(query.format(schema=schema), params)
+        try:
+            for row in cursor:
+                yield row_to_test(row, keys)
+        finally:
+            # Выдачу могли прервать на середине: закрываем запрос до DETACH архива
+            cursor.close()
+
+
+def get_tests_page(city=None, school=None, after=None, limit=100, season=None):
+    """Страница результатов и курсор следующей страницы (None - страниц больше нет)"""
+    tests = list(iter_tests(city=city, school=school, after=after, limit=limit + 1, season=season))
+    next_cursor = None
+    if len(tests) > limit:
+        tests = tests[:limit]
+        next_cursor = encode_cursor(tests[-1]['created_at'], tests[-1]['id'])
+    return {'items': tests, 'next_cursor': next_cursor}
+
+
+# Поиск учеников: сколько похожих слов словаря подставлять вместо слова с опечаткой
+SEARCH_MAX_LIMIT = 100
+FUZZY_CANDIDATES = 50
+FUZZY_MAX_TERMS = 5
+FUZZY_MIN_SIMILARITY = 0.7
+TRIGRAM = 3
+
+SEARCH_FIELDS = ('id', 'first_name', 'last_name', 'class_name', 'city', 'school', 'level',
+                 'score', 'max_score', 'time_spent', 'created_at')
+
+
+def _like_prefix(word):
+    return word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _similar_terms(cursor, word):
+    """Слова словаря SearchTerm, похожие на word (опечатка, пропущенная или лишняя буква)"""
+    trigrams = sorted({word[i:i + TRIGRAM] for i in range(len(word) - TRIGRAM + 1)})
+    cursor.execute('''
+        SELECT t.term FROM SearchTermIndex JOIN SearchTerm t ON t.id = SearchTermIndex.rowid
+        WHERE SearchTermIndex MATCH ?
+        ORDER BY SearchTermIndex.rank
+        LIMIT ?
+    ''', (' OR '.join(_fts_phrase(trigram) for trigram in trigrams), FUZZY_CANDIDATES))
+    scored = []
+    for (term,) in cursor.fetchall():
+        # Слово запроса может быть началом фамилии: сравниваем и с началом слова словаря
+        similarity = max(
+            difflib.SequenceMatcher(None, word, term).ratio(),
+            difflib.SequenceMatcher(None, word, term[:len(word)]).ratio()
+        )
+        if similarity >= FUZZY_MIN_SIMILARITY:
+            scored.append((similarity, term))
+    scored.sort(reverse=True)
+    return [term for _, term in scored[:FUZZY_MAX_TERMS]]
+
+
+def _search_page(cursor, match, words, city, school, after, limit):
+    """Страница попыток (от новых к старым), подходящих под выражение FTS match (или перебором, если индекса нет)"""
+    conditions, params = [], []
+    if _search_index and match:
+        source = 'TestSearch s JOIN Test t ON t.id = s.rowid'
+        order = 's.rowid'
+        conditions.append('TestSearch MATCH ?')
+        params.append(match)
+    else:
+        source = 'Test t'
+        order = 't.id'
+        for word in words:
+            if len(word) >= TRIGRAM:
+                conditions.append('(' + ' OR '.join(f'instr(t.{column}, ?) > 0' for column in SEARCH_COLUMNS) + ')')
+                params.extend([word] * len(SEARCH_COLUMNS))
+    if city:
+        conditions.append('t.city_key = ?')
+        params.append(normalize_key(city))
+    if school:
+        conditions.append('t.school_key = ?')
+        params.append(normalize_key(school))
+    # Слова короче триграммы (класс «9а», номер школы) индекс не найдёт - сравниваем начало ключей
+    for word in words:
+        if len(word) < TRIGRAM:
+            conditions.append(
+                "(t.last_name_key LIKE ? ESCAPE '\\' OR t.first_name_key LIKE ? ESCAPE '\\' "
+                "OR t.class_key LIKE ? ESCAPE '\\' OR t.school_key = ?)"
+            )
+            params.extend([_like_prefix(word)] * 3 + [word])
+    if after is not None:
+        conditions.append(f'{order} < ?')
+        params.append(after)
+
+    cursor.execute(f'''
+        SELECT {', '.join(f't.{field}' for field in SEARCH_FIELDS)}
+        FROM {source}
+        WHERE {' AND '.join(conditions) or '1'}
+        ORDER BY {order} DESC
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor.fetchall()
+    items = [{field: row[field] for field in SEARCH_FIELDS} for row in rows[:limit]]
+    return items, items[-1]['id'] if len(rows) > limit else None
+
+
+def search_tests(query, city=None, school=None, after=None, limit=20):
+    """Поиск попыток по фамилии, имени, классу, школе и городу.
+
+    Каждое слово запроса ищется как подстрока ключей (триграммный индекс TestSearch),
+    результаты - от новых к старым, after - id последней строки предыдущей страницы.
+    Если точных совпадений нет, слова с опечатками заменяются похожими словами из
+    словаря фамилий и имён (match = 'fuzzy'). Возвращает items, next_cursor и match.
+    """
+    words = normalize_key(query).split()
+    if not words:
+        return {'items': [], 'next_cursor': None, 'match': 'exact'}
+    long_words = [word for word in words if len(word) >= TRIGRAM]
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        match = ' AND '.join(_fts_phrase(word) for word in long_words)
+        items, next_cursor = _search_page(cursor, match, words, city, school, after, limit)
+        if items or not (_search_index and long_words):
+            return {'items': items, 'next_cursor': next_cursor, 'match': 'exact'}
+        if after is not None:
+            # Следующая страница: решаем заново, были ли точные совпадения вообще
+            if _search_page(cursor, match, words, city, school, None, 1)[0]:
+                return {'items': [], 'next_cursor': None, 'match': 'exact'}
+
+        # Каждое длинное слово - само или одно из похожих слов словаря
+        alternatives = []
+        for word in long_words:
+            terms = [word] + [term for term in _similar_terms(cursor, word) if term != word]
+            alternatives.append('(' + ' OR '.join(_fts_phrase(term) for term in terms) + ')')
+        items, next_cursor = _search_page(cursor, ' AND '.join(alternatives), words, city, school, after, limit)
+        return {'items': items, 'next_cursor': next_cursor, 'match': 'fuzzy'}
+
+
+def get_statistics(season=None):
+    """Получение общей статистики по тестам (season - по архиву сезона)"""
+    try:
+        with get_connection() as conn, attach_season(conn, season) as schema:
+            cursor = conn.cursor()
         
-        stats = {}
+            stats = {}
         
-        cursor.execute('SELECT COUNT(*) as count FROM Test')
-        stats['total_tests'] = cursor.fetchone()['count']
+            # Читаем сводную таблицу (O(число уровней)), а не агрегируем Test
+            cursor.execute(f'''
+                SELECT level, count, scored_count, percent_sum
+                FROM {schema}.TestStats
+                WHERE dimension = 'level' AND count > 0
+                ORDER BY level
+            ''')
+            rows = cursor.fetchall()
         
-        cursor.execute('SELECT AVG(score * 1.0 / max_score * 100) as avg FROM Test')
-        result = cursor.fetchone()['avg']
-        stats['average_score_percent'] = round(result, 2) if result else 0
+            stats['total_tests'] = sum(row['count'] for row in rows)
         
-        cursor.execute('''
-            SELECT level, COUNT(*) as count, 
-                   AVG(score * 1.0 / max_score * 100) as avg_score
-            FROM Test
-            GROUP BY level
-        ''')
-        stats['by_level'] = [dict(row) for row in cursor.fetchall()]
+            scored = sum(row['scored_count'] for row in rows)
+            result = sum(row['percent_sum'] for row in rows) / scored if scored else None
+            stats['average_score_percent'] = round(result, 2) if result else 0
+        
+            stats['by_level'] = [{
+                'level': row['level'],
+                'count': row['count'],
+                'avg_score': row['percent_sum'] / row['scored_count'] if row['scored_count'] else None
+            } for row in rows]
         
-        conn.close()
-        return stats
+            return stats
         
     except Exception as e:
-        print(f"Ошибка при получении статистики: {str(e)}")
+        logger.error("Ошибка при получении статистики", extra={'error': str(e)})
         return {}
 
 
+def get_statistics_breakdown(dimension, city=None, school=None, season=None):
+    """Статистика в разрезе городов, школ или классов (по уровням) из сводной таблицы"""
+    if dimension not in STATS_DIMENSIONS:
+        raise ValueError(f'Неизвестный разрез статистики: {dimension}')
+    try:
+        with get_connection() as conn, attach_season(conn, season) as schema:
+            cursor = conn.cursor()
+        
+            query = f'''
+                SELECT city, school, class_name, level, count, scored_count, percent_sum
+                FROM {schema}.TestStats
+                WHERE dimension = ? AND count > 0
+            '''
+            params = [dimension]
+            conditions, filter_params = location_filter(city, school)
+            for condition in conditions:
+                query += ' AND ' + condition
+            params.extend(filter_params)
+            query += ' ORDER BY city_key, school_key, class_key, level'
+        
+            cursor.execute(query, params)
+        
+            fields = STATS_DIMENSIONS[dimension]
+            breakdown = []
+            for row in cursor.fetchall():
+                item = {STATS_FIELDS[field][1]: row[STATS_FIELDS[field][1]] for field in fields}
+                item.update({
+                    'level': row['level'],
+                    'count': row['count'],
+                    'avg_score': round(row['percent_sum'] / row['scored_count'], 2) if row['scored_count'] else None
+                })
+                breakdown.append(item)
+            return breakdown
+        
+    except Exception as e:
+        logger.error("Ошибка при получении статистики в разрезе", extra={'dimension': dimension, 'error': str(e)})
+        return []
+
+
 def get_students_by_class(city=None, school=None):
     """Получение всех учеников, сгруппированных по классам, с возможностью фильтрации"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
+        
+            query = '''
+                SELECT id, class_name, first_name, last_name, city, school, answers, choices, correct_mask,
+                       score, max_score, level, time_spent, created_at
+                FROM Test
+            '''
+        
+            # Добавляем фильтры
+            conditions, params = location_filter(city, school)
         
-        query = '''
-            SELECT id, class_name, first_name, last_name, city, school, answers, score, max_score, level, time_spent, created_at
-            FROM Test
-        '''
-        params = []
-        
-        # Добавляем фильтры
-        conditions = []
-        if city:
-            conditions.append('LOWER(city) = LOWER(?)')
-            params.append(city)
-        if school:
-            conditions.append('LOWER(school) = LOWER(?)')
-            params.append(school)
-        
-        if conditions:
-            query += ' WHERE ' + ' AND '.join(conditions)
-        
-        query += ' ORDER BY class_name, last_name, first_name'
-        
-        cursor.execute(query, params)
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        # Группировка по классам
-        classes = {}
-        for row in rows:
-            class_name = row['class_name']
-            if class_name not in classes:
-                classes[class_name] = []
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+        
+            # Порядок совпадает с индексом idx_test_location - сортировка без временного B-дерева
+            query += ' ORDER BY class_key, last_name_key, first_name_key'
+        
+            keys = get_schema_answer_keys(cursor)
+            cursor.execute(query, params)
+        
+            rows = cursor.fetchall()
+        
+            # Группировка по классам
+            classes = {}
+            for row in rows:
+                class_name = row['class_name']
+                if class_name not in classes:
+                    classes[class_name] = []
             
-            classes[class_name].append({
-                'id': row['id'],
-                'first_name': row['first_name'],
-                'last_name': row['last_name'],
-                'city': row['city'] if 'city' in row.keys() else '',
-                'school': row['school'] if 'school' in row.keys() else '',
-                'answers': json.loads(row['answers']),
-                'score': row['score'],
-                'max_score': row['max_score'],
-                'level': row['level'],
-                'time_spent': row['time_spent'] if 'time_spent' in row.keys() else 0,
-                'created_at': row['created_at']
-            })
+                classes[class_name].append({
+                    'id': row['id'],
+                    'first_name': row['first_name'],
+                    'last_name': row['last_name'],
+                    'city': row['city'] if 'city' in row.keys() else '',
+                    'school': row['school'] if 'school' in row.keys() else '',
+                    'answers': unpack_answers(row['level'], row['answers'], row['choices'], row['correct_mask'],
+                                              keys.get(row['level'])),
+                    'score': row['score'],
+                    'max_score': row['max_score'],
+                    'level': row['level'],
+                    'time_spent': row['time_spent'] if 'time_spent' in row.keys() else 0,
+                    'created_at': row['created_at']
+                })
+        
+            return classes
+        
+    except Exception as e:
+        logger.error("Ошибка при получении учеников по классам", extra={'error': str(e)})
+        return {}
+
+
+# Границы оценок (в процентах) - те же, что на странице учителя
+SCORE_BANDS = (('excellent', 90), ('good', 70), ('average', 50), ('poor', 0))
+
+
+def _score_band_sql(percent):
+    """SUM-выражения гистограммы оценок по колонке/выражению процента"""
+    parts = []
+    upper = None
+    for band, lower in SCORE_BANDS:
+        condition = f'{percent} >= {lower}' + (f' AND {percent} < {upper}' if upper is not None else '')
+        parts.append(f'SUM(CASE WHEN {condition} THEN 1 ELSE 0 END) AS band_{band}')
+        upper = lower
+    return ', '.join(parts)
+
+
+def get_class_summary(city=None, school=None):
+    """Сводка по классам, посчитанная в БД: без массивов ответов.
+
+    Для каждого класса - лёгкие строки учеников и по каждому уровню: число попыток,
+    средний процент, гистограмма оценок и статистика правильных ответов по вопросам.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+        
+            conditions, params = location_filter(city, school)
+            where = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+            percent = 'CASE WHEN max_score > 0 THEN score * 100.0 / max_score ELSE 0 END'
+        
+            classes = {}
+            class_names = {}
+        
+            cursor.execute(f'''
+                SELECT id, class_key, class_name, first_name, last_name, level, score, max_score, time_spent, created_at
+                FROM Test{where}
+                ORDER BY class_key, last_name_key, first_name_key
+            ''', params)
+            for row in cursor:
+                class_name = class_names.setdefault(row['class_key'], row['class_name'])
+                entry = classes.setdefault(class_name, {'students': [], 'levels': {}})
+                entry['students'].append({
+                    'id': row['id'],
+                    'first_name': row['first_name'],
+                    'last_name': row['last_name'],
+                    'level': row['level'],
+                    'score': row['score'],
+                    'max_score': row['max_score'],
+                    'time_spent': row['time_spent'] or 0,
+                    'created_at': row['created_at']
+                })
+        
+            cursor.execute(f'''
+                SELECT class_key, level, COUNT(*) AS count, SUM(score) AS score_sum, SUM(max_score) AS max_score_sum,
+                       AVG({percent}) AS avg_percent, {_score_band_sql(f'({percent})')}
+                FROM Test{where}
+                GROUP BY class_key, level
+            ''', params)
+            for row in cursor.fetchall():
+                levels = classes[class_names[row['class_key']]]['levels']
+                levels[row['level']] = {
+                    'count': row['count'],
+                    'score_sum': row['score_sum'],
+                    'max_score_sum': row['max_score_sum'],
+                    'avg_percent': round(row['avg_percent'], 2) if row['avg_percent'] is not None else 0,
+                    'histogram': {band: row[f'band_{band}'] for band, _ in SCORE_BANDS},
+                    'questions': {}
+                }
+        
+            # Статистика по вопросам для компактных строк: один проход GROUP BY с суммой
+            # бита маски по каждому номеру вопроса; вопросов не больше, чем в самом длинном ключе
+            cursor.execute('SELECT COALESCE(MAX(length(correct_answers)), 0) FROM AnswerKey')
+            width = min(cursor.fetchone()[0], MAX_PACKED_QUESTIONS)
+            bits = ''.join(f', SUM((correct_mask >> {n}) & 1) AS q{n}' for n in range(width))
+            packed = ' AND '.join(conditions + ["answers = ''"])
+            cursor.execute(f'''
+                SELECT class_key, level, length(choices) AS questions, COUNT(*) AS count{bits}
+                FROM Test WHERE {packed}
+                GROUP BY class_key, level, length(choices)
+            ''', params)
+            counts = {}
+            for row in cursor.fetchall():
+                questions = counts.setdefault((row['class_key'], row['level']), {})
+                for n in range(min(row['questions'], width)):
+                    total, correct = questions.get(n + 1, (0, 0))
+                    questions[n + 1] = (total + row['count'], correct + row[f'q{n}'])
+        
+            # Ответы в JSON (не упакованные) разворачиваются средствами SQLite - только эти строки
+            unpacked = ' AND '.join(f'Test.{condition}' for condition in conditions + ["answers != ''"])
+            cursor.execute(f'''
+                SELECT Test.class_key, Test.level, CAST(answer.key AS INTEGER) + 1 AS question,
+                       COUNT(*) AS total, SUM(json_extract(answer.value, '$.correct') = 1) AS correct
+                FROM Test, json_each(Test.answers) AS answer
+                WHERE {unpacked}
+                GROUP BY Test.class_key, Test.level, question
+            ''', params)
+            for row in cursor.fetchall():
+                questions = counts.setdefault((row['class_key'], row['level']), {})
+                total, correct = questions.get(row['question'], (0, 0))
+                questions[row['question']] = (total + row['total'], correct + row['correct'])
+        
+            for (class_key, level), questions in counts.items():
+                classes[class_names[class_key]]['levels'][level]['questions'] = {
+                    question: {'correct': correct, 'incorrect': total - correct, 'total': total}
+                    for question, (total, correct) in sorted(questions.items())
+                }
         
-        return classes
+            return classes
         
     except Exception as e:
-        print(f"Ошибка при получении учеников по классам: {str(e)}")
+        logger.error("Ошибка при получении сводки по классам", extra={'error': str(e)})
+        return {}
+
+
+def get_answers_by_ids(test_ids):
+    """Ответы для выбранных попыток: {id: [ответы]}"""
+    if not test_ids:
+        return {}
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            placeholders = ', '.join('?' * len(test_ids))
+            keys = get_schema_answer_keys(cursor)
+            cursor.execute(
+                f'SELECT id, level, answers, choices, correct_mask FROM Test WHERE id IN ({placeholders})',
+                list(test_ids)
+            )
+            return {
+                row['id']: unpack_answers(row['level'], row['answers'], row['choices'], row['correct_mask'],
+                                          keys.get(row['level']))
+                for row in cursor.fetchall()
+            }
+        
+    except Exception as e:
+        logger.error("Ошибка при получении ответов", extra={'error': str(e)})
         return {}
 
 
 def get_cities_and_schools():
     """Получение списка всех городов и школ"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        # Получаем все уникальные комбинации город-школа
-        cursor.execute('''
-            SELECT DISTINCT city, school 
-            FROM Test 
-            WHERE city IS NOT NULL AND city != '' 
-            ORDER BY city, school
-        ''')
+            # Получаем все уникальные комбинации город-школа
+            cursor.execute('''
+                SELECT DISTINCT city, school 
+                FROM Test 
+                WHERE city IS NOT NULL AND city != '' 
+                ORDER BY city, school
+            ''')
         
-        rows = cursor.fetchall()
-        conn.close()
+            rows = cursor.fetchall()
         
-        # Группируем школы по городам
-        cities = {}
-        for row in rows:
-            city = row['city']
-            school = row['school']
-            if city not in cities:
-                cities[city] = []
-            if school and school not in cities[city]:
-                cities[city].append(school)
+            # Группируем школы по городам
+            cities = {}
+            for row in rows:
+                city = row['city']
+                school = row['school']
+                if city not in cities:
+                    cities[city] = []
+                if school and school not in cities[city]:
+                    cities[city].append(school)
         
-        return cities
+            return cities
         
     except Exception as e:
-        print(f"Ошибка при получении городов и школ: {str(e)}")
+        logger.error("Ошибка при получении городов и школ", extra={'error': str(e)})
         return {}
\ No newline at end of file
@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+
+import DBmanager
+from DBmanager import MISSING_CHOICE, bump_generation, get_connection, pack_answers, unpack_answers
+from app_logging import get_logger
+
+logger = get_logger('answer_keys')
+
+# Файл с правильными ответами всех уровней: {"4_easy": ["b", "b", "c", "c"], ...}
+ANSWER_KEYS_PATH = 'answer_keys.json'
+REGRADE_BATCH_SIZE = 1000
+
+_registry = {}
+_registry_path = None
+_registry_stamp = None
+_registry_lock = threading.Lock()
+
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_answer_keys(path=None):
+    """Загрузка ключей из файла в реестр; ValueError при некорректном ключе"""
+    global _registry, _registry_path, _registry_stamp
+    path = path or ANSWER_KEYS_PATH
+    stamp = _file_stamp(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    registry = {}
+    for level, answers in data.items():
+        if not answers or not all(
+            isinstance(answer, str) and len(answer) == 1 and answer != MISSING_CHOICE for answer in answers
+        ):
+            raise ValueError(f'Некорректный ключ уровня {level}: ответы должны быть одиночными символами')
+        # Ключ хранится строкой - в том же виде, что и в таблице AnswerKey
+        registry[level] = ''.join(answers)
+
+    # Реестр заменяется целиком: проверка в другом потоке не увидит его пустым
+    _registry = registry
+    _registry_path = path
+    _registry_stamp = stamp
+    return dict(registry)
+
+
+def refresh_answer_keys():
+    """Перечитать файл ключей, если он изменился после загрузки (например, перед manage.py regrade).
+
+    Некорректный файл не заменяет действующие ключи - ошибка пишется в журнал.
+    """
+    global _registry_stamp
+    if _registry_path is None or _file_stamp(_registry_path) == _registry_stamp:
+        return
+    with _registry_lock:
+        stamp = _file_stamp(_registry_path)
+        if stamp == _registry_stamp:
+            return
+        try:
+            load_answer_keys(_registry_path)
+            logger.info("Ключи ответов перечитаны", extra={'path': _registry_path})
+        except (OSError, ValueError) as e:
+            # Повторная попытка - после следующего изменения файла
+            _registry_stamp = stamp
+            logger.error("Ошибка при чтении ключей ответов", extra={'error': str(e)})
+
+
+def get_levels():
+    return sorted(_registry)
+
+
+def get_question_count(level):
+    return len(_registry[level])
+
+
+def grade_with_key(key, answers, strict=True):
+    """Проверка ответов по ключу: (ответы в формате БД, балл, максимальный балл).
+
+    Учитываются только номера вопросов и выбранные варианты; присланные клиентом
+    correct/correct_answer игнорируются. strict=False пропускает ответы на
+    несуществующие вопросы вместо ValueError (для старых записей при пересчёте).
+    """
+    chosen = {}
+    for answer in answers:
+        try:
+            question = int(answer['question'])
+        except (TypeError, KeyError, ValueError):
+            question = None
+        if question is None or not 1 <= question <= len(key):
+            if strict:
+                raise ValueError(f'Некорректный номер вопроса в ответе: {answer}')
+            continue
+        value = answer.get('answer')
+        chosen[question] = str(value) if value is not None else None
+
+    graded = []
+    score = 0
+    for question, correct_answer in enumerate(key, start=1):
+        answer = chosen.get(question)
+        correct = answer == correct_answer
+        score += correct
+        graded.append({
+            'question': question,
+            'answer': answer,
+            'correct_answer': correct_answer,
+            'correct': correct
+        })
+    return graded, score, len(key)
+
+
+def grade(level, answers):
+    """Проверка отправки по ключу уровня из реестра (файл ключей перечитывается при изменении)"""
+    refresh_answer_keys()
+    key = _registry.get(level)
+    if key is None:
+        raise ValueError(f'Неизвестный уровень теста: {level}')
+    return grade_with_key(key, answers)
+
+
+def get_stale_levels():
+    """Уровни, ключ которых в БД отличается от реестра; недостающие ключи записываются"""
+    stale = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT level, correct_answers FROM AnswerKey')
+        stored = {row['level']: row['correct_answers'] for row in cursor.fetchall()}
+        for level, key in _registry.items():
+            if level not in stored:
+                cursor.execute('INSERT OR IGNORE INTO AnswerKey (level, correct_answers) VALUES (?, ?)', (level, key))
+            elif stored[level] != key:
+                stale.append(level)
+        conn.commit()
+    DBmanager.forget_answer_keys()
+    return stale
+
+
+def regrade_level(level, batch_size=REGRADE_BATCH_SIZE):
+    """Пересчёт всех попыток уровня по ключу из реестра одной транзакцией.
+
+    Строки читаются пачками по id, обновления пишутся executemany; сводная статистика
+    поддерживается триггерами. Возвращает (число попыток, число изменённых баллов).
+    """
+    key = _registry[level]
+    processed = changed = 0
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT correct_answers FROM AnswerKey WHERE level = ?', (level,))
+        found = cursor.fetchone()
+        old_key = found[0] if found else key
+        DBmanager.set_answer_key(level, key, cursor)
+
+        last_id = 0
+        while True:
+            cursor.execute('''
+                SELECT id, answers, choices, correct_mask, score FROM Test
+                WHERE level = ? AND id > ? ORDER BY id LIMIT ?
+            ''', (level, last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                answers = unpack_answers(level, row['answers'], row['choices'], row['correct_mask'], key=old_key)
+                graded, score, max_score = grade_with_key(key, answers, strict=False)
+                answers_json, choices, mask = pack_answers(level, graded, key=key)
+                updates.append((answers_json, choices, mask, score, max_score, row['id']))
+                changed += score != row['score']
+            cursor.executemany('''
+                UPDATE Test SET answers = ?, choices = ?, correct_mask = ?, score = ?, max_score = ?
+                WHERE id = ?
+            ''', updates)
+            processed += len(rows)
+            last_id = rows[-1]['id']
+        conn.commit()
+
+    DBmanager.forget_answer_keys()
+    bump_generation()
+    return processed, changed
+
+
+def regrade(levels=None, batch_size=REGRADE_BATCH_SIZE):
+    """Пересчёт уровней с изменившимся ключом (или перечисленных явно).
+
+    Возвращает {уровень: {'attempts', 'changed', 'seconds'}}.
+    """
+    targets = levels if levels is not None else get_stale_levels()
+    results = {}
+    for level in targets:
+        if level not in _registry:
+            raise ValueError(f'Неизвестный уровень теста: {level}')
+        started = time.perf_counter()
+        processed, changed = regrade_level(level, batch_size)
+        elapsed = time.perf_counter() - started
+        results[level] = {'attempts': processed, 'changed': changed, 'seconds': round(elapsed, 3)}
+        logger.info("Баллы уровня пересчитаны", extra={'level': level, **results[level]})
+    return results
@@ -0,0 +1,67 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+# Уровень и файл журнала: LOG_LEVEL=DEBUG|INFO|WARNING|ERROR, LOG_FILE=путь (по умолчанию stdout)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LOG_FILE')
+
+# Поля LogRecord, которые не являются пользовательскими (extra)
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля из extra"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RESERVED:
+                # Поля extra не перекрывают основные (ts, level, logger, message)
+                entry.setdefault(name, value)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def get_logger(name):
+    return logging.getLogger(f'webhistory.{name}')
+
+
+def configure_logging(level=LOG_LEVEL, path=LOG_FILE):
+    """Буферизованный журнал: обработчики запросов только кладут запись в очередь,
+    а запись в поток/файл выполняет отдельный поток QueueListener"""
+    global _listener
+    if _listener is not None:
+        return
+
+    target = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger('webhistory')
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Дописать буфер журнала (вызывается при остановке приложения)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,267 @@
+import json
+import time
+from datetime import datetime
+
+from DBmanager import (
+    ARCHIVE_SCHEMA, AUTO_VACUUM_INCREMENTAL, attach_season, bump_generation, create_stats_table, fill_statistics, get_connection,
+    load_score_ranks, season_bounds, season_of, unpack_answers
+)
+from app_logging import get_logger
+
+logger = get_logger('archive')
+
+ARCHIVE_BATCH_SIZE = 1000
+# Попытка однозначно определяется учеником, уровнем и временем прохождения (id после очистки БД
+# или восстановления из копии может совпасть с id другой попытки в архиве)
+ATTEMPT_COLUMNS = ('last_name_key', 'first_name_key', 'class_key', 'level', 'created_at')
+VACUUM_STEP_PAGES = 1000    # страниц за один шаг incremental_vacuum
+
+
+def _create_archive_schema(cursor):
+    """Таблицы архива по образцу Test основной БД (без AUTOINCREMENT и триггеров), ключи уровней и сводка.
+
+    Возвращает список колонок Test в порядке основной БД.
+    """
+    cursor.execute('PRAGMA main.table_info(Test)')
+    columns = []
+    definitions = []
+    for column in cursor.fetchall():
+        columns.append(column['name'])
+        if column['pk']:
+            definitions.append(f"{column['name']} INTEGER PRIMARY KEY")
+            continue
+        definition = f"{column['name']} {column['type']}"
+        if column['notnull']:
+            definition += ' NOT NULL'
+        if column['dflt_value'] is not None:
+            definition += f" DEFAULT {column['dflt_value']}"
+        definitions.append(definition)
+
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.Test ({", ".join(definitions)})')
+    # Архив создан при более старой схеме - добавляем колонки, появившиеся позже
+    cursor.execute(f'PRAGMA {ARCHIVE_SCHEMA}.table_info(Test)')
+    existing = {row['name'] for row in cursor.fetchall()}
+    for name, definition in zip(columns, definitions):
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {ARCHIVE_SCHEMA}.Test ADD COLUMN {definition}')
+
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_test_created ON Test (created_at, id)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_test_attempt ON Test ({", ".join(ATTEMPT_COLUMNS)})')
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_test_location_created
+        ON Test (city_key, school_key, created_at, id)
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.AnswerKey (
+            level TEXT PRIMARY KEY,
+            correct_answers TEXT NOT NULL
+        )
+    ''')
+    create_stats_table(cursor, ARCHIVE_SCHEMA)
+    return columns
+
+
+def _sync_answer_keys(cursor):
+    """Копирование ключей уровней в архив; возвращает {уровень: ключ основной БД} для уровней,
+    ключ которых в архиве другой (ключ меняли между архивированиями)"""
+    cursor.execute(f'INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.AnswerKey SELECT level, correct_answers FROM main.AnswerKey')
+    cursor.execute(f'''
+        SELECT m.level, m.correct_answers FROM main.AnswerKey m
+        JOIN {ARCHIVE_SCHEMA}.AnswerKey a ON a.level = m.level
+        WHERE a.correct_answers != m.correct_answers
+    ''')
+    return {row['level']: row['correct_answers'] for row in cursor.fetchall()}
+
+
+def _archive_row(row, columns, changed_keys):
+    """Значения строки для архива; ответы уровней со сменившимся ключом сохраняются в JSON"""
+    values = list(row)
+    level = row['level']
+    if row['choices'] and level in changed_keys:
+        answers = unpack_answers(level, row['answers'], row['choices'], row['correct_mask'], changed_keys[level])
+        values[columns.index('answers')] = json.dumps(answers, ensure_ascii=False)
+        values[columns.index('choices')] = ''
+    return values
+
+
+def _archived_attempts(cursor, rows):
+    """Какие попытки пачки уже есть в архиве (перенос прервали после копии) и какие их id
+    заняты в архиве другими попытками"""
+    attempts = [tuple(row[column] for column in ATTEMPT_COLUMNS) for row in rows]
+    placeholders = ', '.join([f'({", ".join("?" * len(ATTEMPT_COLUMNS))})'] * len(attempts))
+    cursor.execute(f'''
+        SELECT {", ".join(ATTEMPT_COLUMNS)} FROM {ARCHIVE_SCHEMA}.Test
+        WHERE ({", ".join(ATTEMPT_COLUMNS)}) IN (VALUES {placeholders})
+    ''', [value for attempt in attempts for value in attempt])
+    archived = {tuple(row) for row in cursor.fetchall()}
+    ids = [row['id'] for row in rows]
+    cursor.execute(f'SELECT id FROM {ARCHIVE_SCHEMA}.Test WHERE id IN ({", ".join("?" * len(ids))})', ids)
+    taken = {row[0] for row in cursor.fetchall()}
+    return archived, taken
+
+
+def _archive_batch(conn, columns, changed_keys, start, end, batch_size):
+    """Перенос одной пачки самых старых попыток [start, end); возвращает число строк в пачке.
+
+    Копия в архив и удаление из основной БД - две транзакции: при WAL коммит в несколько файлов
+    не атомарен, а так после сбоя строка может оказаться в обоих файлах, но не потеряться.
+    Попытка, id которой в архиве занят другой попыткой, получает новый id архива.
+    """
+    cursor = conn.cursor()
+    column_list = ', '.join(columns)
+    id_index = columns.index('id')
+
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute(f'''
+        SELECT {column_list} FROM main.Test
+        WHERE created_at >= ? AND created_at < ?
+        ORDER BY created_at, id
+        LIMIT ?
+    ''', (start, end, batch_size))
+    rows = cursor.fetchall()
+    if not rows:
+        conn.commit()
+        return 0
+    archived, taken = _archived_attempts(cursor, rows)
+    keep_id, new_id = [], []
+    for row in rows:
+        if tuple(row[column] for column in ATTEMPT_COLUMNS) in archived:
+            continue
+        values = _archive_row(row, columns, changed_keys)
+        if row['id'] in taken:
+            values[id_index] = None
+            new_id.append(values)
+        else:
+            keep_id.append(values)
+    # Сначала строки со своими id, затем получающие новые (больше всех занятых):
+    # обычный INSERT прерывает перенос при любом совпадении id вместо перезаписи попытки
+    insert = f'INSERT INTO {ARCHIVE_SCHEMA}.Test ({column_list}) VALUES ({", ".join("?" * len(columns))})'
+    cursor.executemany(insert, keep_id)
+    cursor.executemany(insert, new_id)
+    conn.commit()
+
+    # Удаляются только строки, попытка которых уже записана в архив; сводную статистику
+    # и поисковый индекс основной БД обновляют триггеры
+    ids = [row['id'] for row in rows]
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute(f'''
+        DELETE FROM main.Test AS live
+        WHERE id IN ({", ".join("?" * len(ids))})
+          AND EXISTS (
+              SELECT 1 FROM {ARCHIVE_SCHEMA}.Test AS copy
+              WHERE {" AND ".join(f"copy.{column} = live.{column}" for column in ATTEMPT_COLUMNS)}
+          )
+    ''', ids)
+    deleted = cursor.rowcount
+    conn.commit()
+    if deleted != len(rows):
+        raise RuntimeError(f'В архиве не найдено {len(rows) - deleted} попыток пачки - перенос остановлен')
+    return len(rows)
+
+
+def _archive_range(season, start, end, batch_size):
+    """Перенос попыток [start, end) в архив сезона; возвращает число перенесённых строк"""
+    started = time.perf_counter()
+    total = 0
+    with get_connection() as conn, attach_season(conn, season, create=True):
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        columns = _create_archive_schema(cursor)
+        changed_keys = _sync_answer_keys(cursor)
+        conn.commit()
+
+        while True:
+            moved = _archive_batch(conn, columns, changed_keys, start, end, batch_size)
+            total += moved
+            if moved < batch_size:
+                break
+
+        # Архив после переноса не меняется - сводку пересчитываем один раз, без триггеров
+        cursor.execute('BEGIN IMMEDIATE')
+        fill_statistics(cursor, ARCHIVE_SCHEMA)
+        conn.commit()
+
+    logger.info("Попытки перенесены в архив сезона", extra={
+        'season': season, 'rows': total, 'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+    })
+    return total
+
+
+def _parse_cutoff(before):
+    try:
+        return datetime.strptime(before, '%Y-%m-%d').strftime('%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        raise ValueError(f'Некорректная дата: {before} (ожидается ГГГГ-ММ-ДД)')
+
+
+def _season_ranges(cutoff):
+    """Сезоны и границы [начало, конец) для всех попыток старше cutoff"""
+    with get_connection() as conn:
+        oldest = conn.execute('SELECT MIN(created_at) FROM Test WHERE created_at < ?', (cutoff,)).fetchone()[0]
+    if oldest is None:
+        return []
+    ranges = []
+    season = season_of(oldest)
+    while True:
+        start, end = season_bounds(season)
+        if start >= cutoff:
+            break
+        ranges.append((season, start, min(end, cutoff)))
+        season = season_of(end)
+    return ranges
+
+
+def archive_tests(before=None, season=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Перенос попыток в архивы сезонов: всех старше даты before ('ГГГГ-ММ-ДД') или всего сезона season.
+
+    Каждая попытка попадает в файл своего сезона; после переноса основная БД сжимается.
+    Не запускать одновременно с regrade. Возвращает {сезон: перенесено строк}.
+    """
+    if (before is None) == (season is None):
+        raise ValueError('Укажите дату before или сезон season')
+    if season:
+        ranges = [(season, *season_bounds(season))]
+    else:
+        ranges = _season_ranges(_parse_cutoff(before))
+
+    moved = {}
+    for name, start, end in ranges:
+        rows = _archive_range(name, start, end, batch_size)
+        if rows:
+            moved[name] = rows
+    if moved:
+        bump_generation()
+        # Процентили считаются среди попыток текущего сезона
+        load_score_ranks()
+        vacuum()
+    return moved
+
+
+def vacuum(step_pages=VACUUM_STEP_PAGES):
+    """Возврат освободившихся страниц основной БД файловой системе; возвращает число свободных страниц.
+
+    Страницы освобождаются короткими шагами incremental_vacuum, между которыми проходят записи.
+    Полный VACUUM здесь не выполняется: БД в другом режиме auto_vacuum переводит manage.py migrate.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA freelist_count')
+        free = cursor.fetchone()[0]
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            logger.warning("Основная БД не в режиме incremental_vacuum, страницы не освобождены "
+                           "(выполните manage.py migrate)", extra={'pages': free})
+        else:
+            remaining = free
+            while remaining:
+                cursor.execute(f'PRAGMA incremental_vacuum({step_pages})')
+                cursor.fetchall()
+                cursor.execute('PRAGMA freelist_count')
+                left = cursor.fetchone()[0]
+                if left >= remaining:
+                    break
+                remaining = left
+        # Перенести страницы из WAL в файл БД и усечь журнал
+        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        cursor.fetchall()
+    return free
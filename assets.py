@@ -0,0 +1,212 @@
+import hashlib
+import io
+import json
+import os
+
+from markupsafe import Markup, escape
+
+# Исходные изображения лежат в static/, варианты и манифест - в static/build/
+SOURCE_DIR = 'static'
+OUTPUT_DIR = os.path.join('static', 'build')
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, 'manifest.json')
+ASSETS_URL = '/assets'
+
+BACKGROUND_WIDTHS = (640, 1280)
+# Логотип показывается шириной 120px: варианты для плотности экрана 1x, 2x, 3x
+LOGO_WIDTHS = (120, 240, 360)
+
+# Что собирать: ширины и форматы (последний формат - запасной для старых браузеров)
+ASSETS = {
+    **{f'h{i}.jpg': {'widths': BACKGROUND_WIDTHS, 'formats': ('avif', 'webp', 'jpeg')} for i in range(1, 8)},
+    'logo.png': {'widths': LOGO_WIDTHS, 'formats': ('avif', 'webp', 'png')},
+}
+
+QUALITY = {'avif': 55, 'webp': 75, 'jpeg': 80}
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg', 'png': 'png'}
+
+_manifest = None
+_manifest_mtime = None
+
+
+def _digest(data, size=8):
+    return hashlib.blake2b(data, digest_size=size).hexdigest()
+
+
+def _settings_hash(name, formats):
+    """Хэш настроек сборки изображения: при их изменении варианты пересобираются"""
+    settings = {
+        'widths': ASSETS[name]['widths'],
+        'formats': formats,
+        'quality': {fmt: QUALITY.get(fmt) for fmt in formats},
+    }
+    return _digest(json.dumps(settings, sort_keys=True).encode('utf-8'))
+
+
+def _source_hash(name):
+    with open(os.path.join(SOURCE_DIR, name), 'rb') as f:
+        return _digest(f.read())
+
+
+def read_manifest():
+    try:
+        with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def get_manifest():
+    """Манифест; перечитывается, если файл изменился (например, после build-assets)"""
+    global _manifest, _manifest_mtime
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if _manifest is None or mtime != _manifest_mtime:
+        _manifest = read_manifest()
+        _manifest_mtime = mtime
+    return _manifest
+
+
+def check_assets():
+    """Изображения, варианты которых устарели или отсутствуют"""
+    manifest = read_manifest()
+    stale = []
+    for name in ASSETS:
+        entry = manifest.get(name)
+        if (
+            entry is None
+            or entry['source_hash'] != _source_hash(name)
+            or entry['settings_hash'] != _settings_hash(name, tuple(entry['variants']))
+            or not all(
+                os.path.exists(os.path.join(OUTPUT_DIR, variant['file']))
+                for variants in entry['variants'].values() for variant in variants
+            )
+        ):
+            stale.append(name)
+    return stale
+
+
+def _available_formats(formats):
+    """Форматы, которые умеет кодировать установленный Pillow (AVIF есть не во всех сборках)"""
+    try:
+        from PIL import features
+    except ImportError:
+        raise RuntimeError('Для сборки изображений нужен пакет Pillow (pip install Pillow)')
+    return tuple(fmt for fmt in formats if fmt not in ('avif', 'webp') or features.check(fmt))
+
+
+def _encode(image, fmt):
+    buffer = io.BytesIO()
+    if fmt == 'jpeg':
+        image.convert('RGB').save(buffer, 'JPEG', quality=QUALITY['jpeg'], optimize=True, progressive=True)
+    elif fmt == 'png':
+        image.save(buffer, 'PNG', optimize=True)
+    elif fmt == 'webp':
+        image.save(buffer, 'WEBP', quality=QUALITY['webp'], method=6)
+    else:
+        image.save(buffer, 'AVIF', quality=QUALITY['avif'])
+    return buffer.getvalue()
+
+
+def _build_image(name, formats):
+    from PIL import Image
+
+    stem = os.path.splitext(name)[0]
+    with Image.open(os.path.join(SOURCE_DIR, name)) as source:
+        source.load()
+        width, height = source.size
+        # Ширины больше исходной не нужны; исходная ширина остаётся, если все заданные больше
+        widths = sorted({min(target, width) for target in ASSETS[name]['widths']})
+
+        variants = {fmt: [] for fmt in formats}
+        for target in widths:
+            resized = source if target == width else source.resize(
+                (target, round(height * target / width)), Image.LANCZOS
+            )
+            for fmt in formats:
+                data = _encode(resized, fmt)
+                filename = f'{stem}-{target}w-{_digest(data, 5)}.{EXTENSIONS[fmt]}'
+                with open(os.path.join(OUTPUT_DIR, filename), 'wb') as f:
+                    f.write(data)
+                variants[fmt].append({'width': target, 'file': filename, 'bytes': len(data)})
+
+    return {
+        'source_hash': _source_hash(name),
+        'settings_hash': _settings_hash(name, formats),
+        'width': width,
+        'height': height,
+        'variants': variants,
+    }
+
+
+def build_assets(force=False):
+    """Сборка вариантов изображений и манифеста; возвращает список пересобранных изображений"""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest = read_manifest()
+    stale = set(ASSETS) if force else set(check_assets())
+    rebuilt = []
+    for name, config in ASSETS.items():
+        if name in stale:
+            manifest[name] = _build_image(name, _available_formats(config['formats']))
+            rebuilt.append(name)
+    manifest = {name: manifest[name] for name in ASSETS if name in manifest}
+
+    # Удаляем варианты, на которые манифест больше не ссылается
+    used = {variant['file'] for entry in manifest.values() for variants in entry['variants'].values() for variant in variants}
+    for filename in os.listdir(OUTPUT_DIR):
+        if filename != os.path.basename(MANIFEST_PATH) and filename not in used:
+            os.remove(os.path.join(OUTPUT_DIR, filename))
+
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return rebuilt
+
+
+def _url(filename):
+    return f'{ASSETS_URL}/{filename}'
+
+
+def asset_url(name, width=None, fmt=None):
+    """Адрес варианта изображения (запасной формат, ближайшая ширина не меньше width); без сборки - исходный файл"""
+    entry = get_manifest().get(name)
+    if entry is None:
+        return f'/{SOURCE_DIR}/{name}'
+    variants = entry['variants'][fmt or list(entry['variants'])[-1]]
+    if width is not None:
+        for variant in variants:
+            if variant['width'] >= width:
+                return _url(variant['file'])
+    return _url(variants[-1]['file'])
+
+
+def asset_image_set(name, width=None):
+    """CSS image-set() по форматам для фона; без сборки - обычный url()"""
+    entry = get_manifest().get(name)
+    if entry is None:
+        return Markup(f"url('/{SOURCE_DIR}/{name}')")
+    candidates = ', '.join(
+        f"url('{asset_url(name, width, fmt)}') type('{MIME_TYPES[fmt]}')" for fmt in entry['variants']
+    )
+    return Markup(f'image-set({candidates})')
+
+
+def asset_picture(name, alt, sizes):
+    """<picture> с srcset по ширинам для каждого формата; без сборки - обычный <img>"""
+    entry = get_manifest().get(name)
+    if entry is None:
+        return Markup(f'<img src="/{SOURCE_DIR}/{name}" alt="{escape(alt)}">')
+    formats = list(entry['variants'])
+    parts = ['<picture>']
+    for fmt in formats[:-1]:
+        srcset = ', '.join(f"{_url(variant['file'])} {variant['width']}w" for variant in entry['variants'][fmt])
+        parts.append(f'<source type="{MIME_TYPES[fmt]}" srcset="{srcset}" sizes="{sizes}">')
+    fallback = entry['variants'][formats[-1]]
+    srcset = ', '.join(f"{_url(variant['file'])} {variant['width']}w" for variant in fallback)
+    parts.append(
+        f'<img src="{_url(fallback[0]["file"])}" srcset="{srcset}" sizes="{sizes}" '
+        f'width="{entry["width"]}" height="{entry["height"]}" alt="{escape(alt)}">'
+    )
+    parts.append('</picture>')
+    return Markup(''.join(parts))
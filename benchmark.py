@@ -0,0 +1,377 @@
+"""Нагрузочный тест «волна экзамена»: python benchmark.py [параметры]
+
+Заполняет отдельную БД синтетическими попытками, затем параллельные ученики проходят
+путь клиента (check-test, затем submit-test), а учителя смотрят сводку и статистику.
+Результат - пропускная способность, задержки по шагам, ошибки блокировки и размер БД.
+С --baseline результат сравнивается с сохранённым, и при регрессии код выхода 1.
+Прогон повторяется --repeat раз в отдельных процессах, в отчёт попадают медианы.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Журнал каждого сохранения теста в нагрузочном тесте только мешает
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import DBmanager
+import answer_keys
+import metrics
+import regions
+import teacher_auth
+from DBmanager import INSERT_TEST_SQL, get_connection, prepare_test_row
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'webhistory-benchmark.db')
+SEED_BATCH_SIZE = 1000
+# Допустимое ухудшение относительно базового прогона (0.2 = на 20%)
+DEFAULT_THRESHOLD = 0.2
+# Рост задержки меньше этого - шум тестового клиента в одном процессе, регрессией не считается, секунд
+LATENCY_NOISE_FLOOR = 0.005
+# Сколько раз повторять прогон: сравниваются медианы, а не один случайный прогон
+DEFAULT_REPEAT = 3
+# Квантили задержек, по которым проверяется регрессия: хвосты (p95, p99) при десятках потоков
+# в одном процессе зависят от планирования GIL, их покрывает проверка пропускной способности
+GATED_QUANTILES = ('p50',)
+
+MALE_FIRST_NAMES = [
+    'Александр', 'Максим', 'Артём', 'Михаил', 'Иван', 'Дмитрий', 'Кирилл', 'Матвей', 'Егор', 'Тимофей',
+    'Никита', 'Илья', 'Алексей', 'Роман', 'Сергей', 'Фёдор', 'Ярослав', 'Даниил', 'Андрей', 'Семён',
+]
+FEMALE_FIRST_NAMES = [
+    'Анастасия', 'Мария', 'Анна', 'Виктория', 'Полина', 'Елизавета', 'Дарья', 'Алиса', 'Ксения', 'Софья',
+    'Варвара', 'Екатерина', 'Вероника', 'Александра', 'Ульяна', 'Арина', 'Милана', 'Ева', 'Алёна', 'Юлия',
+]
+# Фамилии в мужской форме; женская получается окончанием -а (Иванов - Иванова)
+LAST_NAMES = [
+    'Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов', 'Новиков', 'Фёдоров',
+    'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов', 'Козлов', 'Степанов', 'Николаев',
+    'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров', 'Зайцев', 'Соловьёв', 'Борисов', 'Яковлев', 'Григорьев',
+]
+CLASS_LETTERS = 'АБВГ'
+CHOICES = 'abcd'
+# Уровень 3 - старшая школа (9-11 классы), 4 - средняя (5-8 классы)
+GRADES = {'3': range(9, 12), '4': range(5, 9)}
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class StudentFactory:
+    """Синтетические ученики: имя, класс, город из справочника, номер школы, уровень и ответы"""
+
+    def __init__(self, rng, cities=20, schools=15):
+        self.rng = rng
+        all_cities = [city for region in regions.REGIONS.values() for city in region['cities']]
+        self.cities = rng.sample(all_cities, min(cities, len(all_cities)))
+        self.schools = [str(number) for number in rng.sample(range(1, 300), schools)]
+        self.levels = answer_keys.get_levels()
+
+    def student(self):
+        rng = self.rng
+        last_name = rng.choice(LAST_NAMES)
+        if rng.random() < 0.5:
+            first_name = rng.choice(MALE_FIRST_NAMES)
+        else:
+            first_name = rng.choice(FEMALE_FIRST_NAMES)
+            last_name += 'а'
+        level = rng.choice(self.levels)
+        return {
+            'firstName': first_name,
+            'lastName': last_name,
+            'className': f'{rng.choice(GRADES[level[0]])}{rng.choice(CLASS_LETTERS)}',
+            'city': rng.choice(self.cities),
+            'school': rng.choice(self.schools),
+            'testLevel': level,
+        }
+
+    def answers(self, level):
+        return [
+            {'question': number, 'answer': self.rng.choice(CHOICES) if self.rng.random() < 0.95 else None}
+            for number in range(1, answer_keys.get_question_count(level) + 1)
+        ]
+
+
+def seed_database(factory, attempts, batch_size=SEED_BATCH_SIZE):
+    """Заполнение БД попытками пачками executemany; повторы (ученик + уровень) пропускаются"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, attempts, batch_size):
+            rows = []
+            for _ in range(min(batch_size, attempts - start)):
+                student = factory.student()
+                graded, score, _ = answer_keys.grade(student['testLevel'], factory.answers(student['testLevel']))
+                rows.append(prepare_test_row(
+                    student['firstName'], student['lastName'], student['className'], student['city'],
+                    student['school'], graded, score, student['testLevel'], factory.rng.randint(120, 1200)
+                ))
+            cursor.executemany(INSERT_TEST_SQL + ' ON CONFLICT DO NOTHING', rows)
+            conn.commit()
+        # total_changes учитывает и изменения триггеров статистики, поэтому считаем строки
+        cursor.execute('SELECT COUNT(*) FROM Test')
+        inserted = cursor.fetchone()[0]
+    DBmanager.bump_generation()
+    return inserted
+
+
+class LoadRun:
+    """Прогон волны: задержки по шагам, исходы ответов и ошибки"""
+
+    def __init__(self, app, factory, teacher_key, teacher_every):
+        self.app = app
+        self.factory = factory
+        self.teacher_key = teacher_key
+        self.teacher_every = teacher_every
+        self.latencies = {}
+        self.outcomes = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _client(self):
+        # У каждого потока свой тестовый клиент Flask
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def _call(self, step, method, url, **kwargs):
+        start = time.perf_counter()
+        response = getattr(self._client(), method)(url, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.setdefault(step, []).append(elapsed)
+            outcome = f'{step}:{response.status_code}'
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            if response.status_code >= 500:
+                self.errors += 1
+        return response
+
+    def student_flow(self, student):
+        """Путь ученика как в шаблонах теста: проверка, затем отправка ответов"""
+        identity = {key: student[key] for key in ('firstName', 'lastName', 'className', 'testLevel')}
+        check = self._call('check-test', 'post', '/api/check-test', json=identity)
+        if check.status_code != 200 or check.get_json().get('status') != 'ok':
+            return
+        self._call('submit-test', 'post', '/api/submit-test', json=dict(
+            student,
+            answers=self.factory.answers(student['testLevel']),
+            time=self.factory.rng.randint(120, 1200)
+        ))
+
+    def teacher_flow(self, student):
+        """Учитель открывает сводку по городу ученика и статистику по школам"""
+        self._call('verify-key', 'post', '/api/verify-key', json={
+            'key': self.teacher_key, 'city': student['city'], 'mode': 'summary'
+        })
+        self._call('statistics', 'get', '/api/statistics', query_string={'by': 'school', 'city': student['city']})
+
+    def task(self, index, student):
+        self.student_flow(student)
+        if self.teacher_every and index % self.teacher_every == 0:
+            self.teacher_flow(student)
+
+    def run(self, students, workers):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(self.task, index, student) for index, student in enumerate(students)]:
+                future.result()
+        return time.perf_counter() - start
+
+
+def _database_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+def run_benchmark(db_path=DEFAULT_DB_PATH, attempts=20000, students=2000, workers=32, teacher_every=25, seed=1):
+    """Заполнение БД и прогон волны; возвращает отчёт (словарь)"""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    DBmanager.DATABASE_PATH = db_path
+
+    rng = random.Random(seed)
+    answer_keys.load_answer_keys()
+    DBmanager.init_db(backfill=True)
+    factory = StudentFactory(rng)
+
+    start = time.perf_counter()
+    seeded = seed_database(factory, attempts)
+    seed_seconds = time.perf_counter() - start
+
+    # Приложение импортируется после выбора БД: main при импорте вызывает init_db
+    import main
+
+    teacher_key = teacher_auth.get_teacher_key()
+    if teacher_key is None:
+        raise RuntimeError(f'Нет ключа учителя ({teacher_auth.KEY_FILE_PATH}) для запросов учителя')
+
+    wave = [factory.student() for _ in range(students)]
+    load = LoadRun(main.app, factory, teacher_key, teacher_every)
+    lock_errors_before = metrics.registry.total('webhistory_db_lock_errors_total')
+    elapsed = load.run(wave, workers)
+    requests_total = sum(len(values) for values in load.latencies.values())
+
+    return {
+        'config': {
+            'attempts': attempts, 'students': students, 'workers': workers,
+            'teacher_every': teacher_every, 'seed': seed,
+            'write_behind': main.write_behind.is_running(),
+        },
+        'seed': {'inserted': seeded, 'seconds': round(seed_seconds, 3)},
+        'elapsed_seconds': round(elapsed, 3),
+        'requests': requests_total,
+        'throughput_rps': round(requests_total / elapsed, 1),
+        'students_per_second': round(students / elapsed, 1),
+        'latency': {
+            step: {
+                'count': len(values),
+                'p50': round(_percentile(values, 0.5), 6),
+                'p95': round(_percentile(values, 0.95), 6),
+                'p99': round(_percentile(values, 0.99), 6),
+            }
+            for step, values in sorted(load.latencies.items())
+        },
+        'outcomes': dict(sorted(load.outcomes.items())),
+        'server_errors': load.errors,
+        'lock_errors': metrics.registry.total('webhistory_db_lock_errors_total') - lock_errors_before,
+        'db_size_bytes': _database_size(db_path),
+    }
+
+
+def run_isolated(argv):
+    """Один прогон в отдельном процессе: у каждого повтора свои пул соединений, кэши и БД"""
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), *argv, '--repeat', '1', '--output', path],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        os.remove(path)
+
+
+def median_report(reports):
+    """Сводный отчёт повторов: медианы пропускной способности и задержек, худшие счётчики ошибок"""
+    report = dict(reports[0])
+    report['config'] = dict(report['config'], repeat=len(reports))
+    for field in ('elapsed_seconds', 'throughput_rps', 'students_per_second'):
+        report[field] = round(statistics.median(run[field] for run in reports), 3)
+    report['latency'] = {
+        step: dict(values, **{
+            quantile: round(statistics.median(run['latency'][step][quantile] for run in reports
+                                              if step in run['latency']), 6)
+            for quantile in ('p50', 'p95', 'p99')
+        })
+        for step, values in reports[0]['latency'].items()
+    }
+    for counter in ('server_errors', 'lock_errors'):
+        report[counter] = max(run[counter] for run in reports)
+    # Значения каждого повтора: сравнение с базовым прогоном идёт по их разбросу
+    report['runs'] = [
+        {
+            'throughput_rps': run['throughput_rps'],
+            'latency': {step: {quantile: run['latency'][step][quantile] for quantile in GATED_QUANTILES}
+                        for step in run['latency']},
+        }
+        for run in reports
+    ]
+    return report
+
+
+def _spread(report, value):
+    """(минимум, максимум) значения по повторам отчёта; у отчёта одного прогона - само значение"""
+    values = []
+    for run in report.get('runs') or [report]:
+        try:
+            values.append(value(run))
+        except KeyError:
+            continue
+    return (min(values), max(values)) if values else None
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """Регрессии относительно базового прогона: список строк с описанием.
+
+    Сравниваются разбросы повторов: регрессия - когда даже лучший повтор хуже худшего
+    повтора базового прогона больше чем на threshold. Задержка к тому же должна вырасти
+    больше чем на LATENCY_NOISE_FLOOR.
+    """
+    problems = []
+    best = _spread(report, lambda run: run['throughput_rps'])[1]
+    limit = _spread(baseline, lambda run: run['throughput_rps'])[0] * (1 - threshold)
+    if best < limit:
+        problems.append(f"пропускная способность: {best} < {limit:.1f} запросов/с")
+    for step in baseline['latency']:
+        for quantile in GATED_QUANTILES:
+            current = _spread(report, lambda run: run['latency'][step][quantile])
+            base = _spread(baseline, lambda run: run['latency'][step][quantile])
+            if current is None or base is None:
+                continue
+            limit = max(base[1] * (1 + threshold), base[1] + LATENCY_NOISE_FLOOR)
+            if current[0] > limit:
+                problems.append(f'{step} {quantile}: {current[0] * 1000:.2f} мс > {limit * 1000:.2f} мс')
+    for counter in ('server_errors', 'lock_errors'):
+        if report[counter] > baseline[counter]:
+            problems.append(f'{counter}: {report[counter]} > {baseline[counter]}')
+    return problems
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест «волна экзамена»')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help='Файл БД для прогона (пересоздаётся)')
+    parser.add_argument('--attempts', type=int, default=20000, help='Сколько попыток записать заранее')
+    parser.add_argument('--students', type=int, default=2000, help='Сколько учеников в волне')
+    parser.add_argument('--workers', type=int, default=32, help='Сколько учеников отправляют ответы одновременно')
+    parser.add_argument('--teacher-every', type=int, default=25,
+                        help='Запросы учителя после каждого N-го ученика (0 - без учителя)')
+    parser.add_argument('--seed', type=int, default=1, help='Начальное значение генератора данных')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Сколько раз повторить прогон (в отчёте - медианы)')
+    parser.add_argument('--output', help='Куда записать отчёт JSON (например, новый базовый прогон)')
+    parser.add_argument('--baseline', help='Базовый прогон JSON для сравнения')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Допустимое ухудшение относительно базового прогона (доля)')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.repeat > 1:
+        run_argv = ['--db', args.db, '--attempts', str(args.attempts), '--students', str(args.students),
+                    '--workers', str(args.workers), '--teacher-every', str(args.teacher_every), '--seed', str(args.seed)]
+        report = median_report([run_isolated(run_argv) for _ in range(args.repeat)])
+    else:
+        report = run_benchmark(args.db, args.attempts, args.students, args.workers, args.teacher_every, args.seed)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        problems = compare(report, baseline, args.threshold)
+        if problems:
+            print('Регрессия относительно базового прогона:', file=sys.stderr)
+            for problem in problems:
+                print(f'  {problem}', file=sys.stderr)
+            return 1
+        print('Регрессий относительно базового прогона нет', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+import csv
+import functools
+import io
+import json
+import re
+import time
+from datetime import datetime
+
+import answer_keys
+from DBmanager import MISSING_CHOICE, attempts_saved, bump_generation, get_connection, prepare_test_row, saving_attempts
+from app_logging import get_logger
+
+logger = get_logger('import')
+
+IMPORT_BATCH_SIZE = 2000  # строк в одной транзакции (и в одном запросе проверки повторов)
+
+# Вставка с датой прохождения: у бумажных тестов она известна и может быть в прошлом
+IMPORT_TEST_SQL = '''
+    INSERT INTO Test (first_name, last_name, class_name, city, school, answers, score, max_score, level, time_spent,
+                      first_name_key, last_name_key, class_key, city_key, school_key, choices, correct_mask, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+'''
+
+# Названия колонок: как в /api/submit-test и как в таблице Test (регистр и '_' не важны)
+FIELD_ALIASES = {
+    'firstname': 'first_name',
+    'lastname': 'last_name',
+    'classname': 'class_name',
+    'class': 'class_name',
+    'city': 'city',
+    'school': 'school',
+    'testlevel': 'level',
+    'level': 'level',
+    'answers': 'answers',
+    'time': 'time_spent',
+    'timespent': 'time_spent',
+    'createdat': 'created_at',
+    'date': 'created_at',
+}
+REQUIRED_FIELDS = ('first_name', 'last_name', 'class_name', 'level', 'answers')
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%d.%m.%Y')
+
+
+@functools.lru_cache(maxsize=256)
+def _field_name(name):
+    return FIELD_ALIASES.get(re.sub(r'[\s_]', '', str(name)).lower())
+
+
+def parse_answers(value):
+    """Ответы в формате /api/submit-test: список {question, answer}, список вариантов
+    или строка из таблицы ("bacd", "b;a;c;-")"""
+    if isinstance(value, str):
+        value = value.strip()
+        value = re.split(r'[\s,;|]+', value) if re.search(r'[\s,;|]', value) else list(value)
+    if not isinstance(value, list):
+        raise ValueError('Поле answers должно быть списком или строкой вариантов')
+    answers = []
+    for i, answer in enumerate(value):
+        if isinstance(answer, dict):
+            answers.append(answer)
+            continue
+        choice = str(answer).strip() if answer is not None else ''
+        answers.append({'question': i + 1, 'answer': None if choice in ('', MISSING_CHOICE) else choice})
+    return answers
+
+
+def _parse_date(value):
+    if value in (None, ''):
+        return None
+    return _parse_date_text(str(value).strip())
+
+
+# В бумажной пачке дат немного, а strptime медленный - разбор каждой даты кэшируется
+@functools.lru_cache(maxsize=1024)
+def _parse_date_text(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    raise ValueError(f'Некорректная дата: {value}')
+
+
+def normalize_record(record):
+    """Проверка строки импорта и подготовка к вставке: (строка IMPORT_TEST_SQL, ключ повтора).
+
+    Баллы считаются по ключу уровня, как при отправке теста; ValueError при ошибке.
+    """
+    fields = {}
+    for name, value in record.items():
+        field = _field_name(name)
+        if field:
+            fields[field] = value
+    for field in REQUIRED_FIELDS:
+        if fields.get(field) in (None, ''):
+            raise ValueError(f'Отсутствует поле: {field}')
+
+    answers, score, _ = answer_keys.grade(str(fields['level']).strip(), parse_answers(fields['answers']))
+    try:
+        time_spent = int(fields.get('time_spent') or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"Некорректное время: {fields.get('time_spent')}")
+    row = prepare_test_row(
+        str(fields['first_name']), str(fields['last_name']), str(fields['class_name']),
+        str(fields.get('city') or ''), str(fields.get('school') or ''),
+        answers, score, str(fields['level']).strip(), time_spent
+    )
+    # (фамилия, имя, класс, уровень) в нормализованном виде - см. prepare_test_row
+    identity = (row[11], row[10], row[12], row[8])
+    if not all(identity):
+        raise ValueError('Пустые имя, фамилия или класс')
+    return row + (_parse_date(fields.get('created_at')),), identity
+
+
+def iter_ndjson(lines):
+    """(номер строки, запись, ошибка разбора) для каждой непустой строки NDJSON"""
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, None, 'Некорректный JSON'
+            continue
+        if not isinstance(record, dict):
+            yield number, None, 'Строка должна быть JSON-объектом'
+            continue
+        yield number, record, None
+
+
+def iter_csv(lines):
+    """(номер строки, запись, ошибка разбора) для CSV с заголовком; разделитель - ',', ';' или табуляция"""
+    lines = iter(lines)
+    header = next(lines, '')
+    delimiter = max((',', ';', '\t'), key=header.count)
+    reader = csv.DictReader(_chain(header, lines), delimiter=delimiter)
+    for record in reader:
+        if not any(value for value in record.values() if isinstance(value, str)):
+            continue
+        yield reader.line_num, record, None
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def _existing_identities(cursor, identities):
+    """Какие из (фамилия, имя, класс, уровень) уже есть в Test - одним запросом на пачку"""
+    placeholders = ', '.join(['(?, ?, ?, ?)'] * len(identities))
+    cursor.execute(f'''
+        SELECT last_name_key, first_name_key, class_key, level FROM Test
+        WHERE (last_name_key, first_name_key, class_key, level) IN (VALUES {placeholders})
+    ''', [value for identity in identities for value in identity])
+    return {tuple(row) for row in cursor.fetchall()}
+
+
+def _insert_batch(batch, report):
+    """Вставка пачки одной транзакцией: проверка повторов по БД и executemany"""
+    with saving_attempts(), get_connection() as conn:
+        cursor = conn.cursor()
+        # Проверка и вставка под одной блокировкой записи: параллельная отправка не проскочит между ними
+        cursor.execute('BEGIN IMMEDIATE')
+        existing = _existing_identities(cursor, [identity for _, _, identity in batch])
+        rows = []
+        for number, row, identity in batch:
+            if identity in existing:
+                report.duplicate(number, 'Попытка уже есть в базе')
+            else:
+                rows.append(row)
+        if not rows:
+            conn.commit()
+            return
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM Test')
+        max_before = cursor.fetchone()[0]
+        cursor.executemany(IMPORT_TEST_SQL, rows)
+        cursor.execute('''
+            SELECT id, created_at, last_name_key, first_name_key, class_key, level FROM Test WHERE id > ?
+        ''', (max_before,))
+        saved = {tuple(found)[2:]: (found['id'], found['created_at']) for found in cursor.fetchall()}
+        conn.commit()
+        bump_generation()
+
+        report.inserted += len(rows)
+        attempts_saved([(row[:-1], *saved[(row[11], row[10], row[12], row[8])]) for row in rows])
+
+
+class ImportReport:
+    """Итог импорта: счётчики и построчный список ошибок и повторов"""
+
+    def __init__(self):
+        self.received = 0
+        self.inserted = 0
+        self.errors = []
+        self.duplicates = []
+
+    def error(self, line, message):
+        self.errors.append({'line': line, 'error': message})
+
+    def duplicate(self, line, message):
+        self.duplicates.append({'line': line, 'error': message})
+
+    def as_dict(self):
+        return {
+            'received': self.received,
+            'inserted': self.inserted,
+            'duplicates': len(self.duplicates),
+            'errors': len(self.errors),
+            'rows': sorted(self.errors + self.duplicates, key=lambda item: item['line'])
+        }
+
+
+def import_results(records, batch_size=IMPORT_BATCH_SIZE):
+    """Импорт записей (номер строки, запись, ошибка разбора) пачками; возвращает отчёт (словарь).
+
+    Повтор ученика и уровня в файле или в БД не вставляется и попадает в отчёт.
+    """
+    started = time.perf_counter()
+    report = ImportReport()
+    seen = set()
+    batch = []
+    for number, record, parse_error in records:
+        report.received += 1
+        if parse_error:
+            report.error(number, parse_error)
+            continue
+        try:
+            row, identity = normalize_record(record)
+        except (TypeError, ValueError) as e:
+            report.error(number, str(e))
+            continue
+        if identity in seen:
+            report.duplicate(number, 'Повтор ученика и уровня в файле')
+            continue
+        seen.add(identity)
+        batch.append((number, row, identity))
+        if len(batch) >= batch_size:
+            _insert_batch(batch, report)
+            batch = []
+    if batch:
+        _insert_batch(batch, report)
+
+    result = report.as_dict()
+    logger.info("Импорт результатов завершён", extra={
+        'received': result['received'], 'inserted': result['inserted'], 'duplicates': result['duplicates'],
+        'errors': result['errors'], 'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+    })
+    return result
+
+
+def detect_format(name):
+    """csv или ndjson по расширению файла / типу содержимого; None - не определён"""
+    name = (name or '').lower()
+    if name.endswith(('.csv', '.tsv')) or 'csv' in name:
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in name or 'jsonl' in name:
+        return 'ndjson'
+    return None
+
+
+def import_stream(stream, fmt, batch_size=IMPORT_BATCH_SIZE):
+    """Импорт из бинарного потока (файл, тело запроса) без чтения целиком в память"""
+    if not isinstance(stream, io.BufferedIOBase):
+        stream = io.BufferedReader(stream)
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    records = iter_csv(lines) if fmt == 'csv' else iter_ndjson(lines)
+    return import_results(records, batch_size)
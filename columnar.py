@@ -0,0 +1,49 @@
+import json
+
+# Колонки с повторяющимися строками: в ответе - номера в словаре значений
+DICTIONARY_COLUMNS = ('class_name', 'city', 'school', 'level')
+# Поля ответа на вопрос: список ответов попытки передаётся массивами без имён полей
+ANSWER_FIELDS = ('question', 'answer', 'correct_answer', 'correct')
+
+
+def encode_rows(rows):
+    """Список словарей одного вида -> колонки: {'count', 'columns', 'dictionaries', 'nested'}.
+
+    Колонка из DICTIONARY_COLUMNS - номера строк в dictionaries[колонка];
+    answers - для каждой строки список массивов значений полей nested['answers'].
+    """
+    names = list(rows[0]) if rows else []
+    columns = {}
+    dictionaries = {}
+    nested = {}
+    for name in names:
+        values = [row[name] for row in rows]
+        if name in DICTIONARY_COLUMNS:
+            codes = {}
+            values = [codes.setdefault(value, len(codes)) for value in values]
+            dictionaries[name] = list(codes)
+        elif name == 'answers':
+            values = [[[answer.get(field) for field in ANSWER_FIELDS] for answer in answers] for answers in values]
+            nested[name] = list(ANSWER_FIELDS)
+        columns[name] = values
+    return {'count': len(rows), 'columns': columns, 'dictionaries': dictionaries, 'nested': nested}
+
+
+def encode_classes(classes):
+    """{класс: [ученики]} -> колонки учеников одной таблицей (класс - колонка class_name)"""
+    return encode_rows([
+        dict(student, class_name=class_name) for class_name, students in classes.items() for student in students
+    ])
+
+
+def encode_class_summary(classes):
+    """Сводка get_class_summary: ученики всех классов - колонками, статистика уровней - по классам"""
+    return {
+        'students': encode_classes({name: entry['students'] for name, entry in classes.items()}),
+        'levels': {name: entry['levels'] for name, entry in classes.items()}
+    }
+
+
+def dumps(payload):
+    """Сериализация без пробелов и экранирования кириллицы: меньше байт и быстрее jsonify"""
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,167 @@
+import json
+
+import numpy as np
+
+from DBmanager import MAX_PACKED_QUESTIONS, MISSING_CHOICE, get_connection, location_filter, unpack_answers
+
+# Квантили времени выполнения теста, которые попадают в отчёт
+TIME_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def load_item_matrix(level, city=None, school=None):
+    """Загрузка попыток уровня в матрицы NumPy.
+
+    Возвращает словарь: correct (попытки x вопросы, 0/1), choices (коды выбранных вариантов,
+    -1 - нет ответа), options (варианты по коду), answered (был ли вопрос в попытке), time_spent.
+    Компактные строки (choices + correct_mask) разбираются целиком средствами NumPy,
+    JSON читается только для строк, которые не удалось упаковать; строки длиннее
+    MAX_PACKED_QUESTIONS (маска не помещается в uint64) разворачиваются так же, как JSON.
+    """
+    conditions, params = location_filter(city, school)
+    conditions.insert(0, 'level = ?')
+    params.insert(0, level)
+
+    packed_choices, packed_masks, packed_times = [], [], []
+    row_index, col_index, correct_flags, answers, json_times = [], [], [], [], []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f'SELECT answers, choices, correct_mask, time_spent FROM Test WHERE {" AND ".join(conditions)}',
+            params
+        )
+        for row in cursor:
+            if not row['answers'] and len(row['choices'] or '') <= MAX_PACKED_QUESTIONS:
+                packed_choices.append(row['choices'] or '')
+                packed_masks.append(row['correct_mask'] or 0)
+                packed_times.append(row['time_spent'] or 0)
+                continue
+            if row['answers']:
+                attempt_answers = json.loads(row['answers'])
+            else:
+                attempt_answers = unpack_answers(level, '', row['choices'], row['correct_mask'])
+            attempt = len(json_times)
+            json_times.append(row['time_spent'] or 0)
+            for question, answer in enumerate(attempt_answers):
+                row_index.append(attempt)
+                col_index.append(question)
+                correct_flags.append(bool(answer.get('correct')))
+                answers.append(answer.get('answer') or '')
+
+    packed = len(packed_choices)
+    attempts = packed + len(json_times)
+    lengths = np.fromiter((len(choices) for choices in packed_choices), dtype=np.int64, count=packed)
+    packed_width = int(lengths.max()) if packed else 0
+    questions = max(packed_width, max(col_index) + 1 if col_index else 0)
+    columns = np.arange(questions)
+
+    correct = np.zeros((attempts, questions), dtype=np.int8)
+    answered = np.zeros((attempts, questions), dtype=bool)
+    choices = np.full((attempts, questions), -1, dtype=np.int16)
+
+    # Компактные строки: варианты - байты одной строки, правильность - биты маски.
+    # Сдвиг только на ширину упакованных строк (не больше 63): сдвиг uint64 на 64 и больше не определён
+    if packed:
+        padded = ''.join(choices.ljust(questions, MISSING_CHOICE) for choices in packed_choices)
+        letters = np.frombuffer(padded.encode('ascii'), dtype=np.uint8).reshape(packed, questions)
+        masks = np.asarray(packed_masks, dtype=np.uint64)
+        shifts = np.arange(packed_width, dtype=np.uint64)
+        correct[:packed, :packed_width] = (masks[:, None] >> shifts) & np.uint64(1)
+        answered[:packed] = columns < lengths[:, None]
+    else:
+        letters = np.zeros((0, questions), dtype=np.uint8)
+    chosen = letters != ord(MISSING_CHOICE)
+
+    # Строки в JSON: разреженное заполнение по индексам
+    rows = np.asarray(row_index, dtype=np.int64) + packed
+    cols = np.asarray(col_index, dtype=np.int64)
+    correct[rows, cols] = np.asarray(correct_flags, dtype=np.int8)
+    answered[rows, cols] = True
+
+    # Варианты ответов обеих частей кодируются одним общим np.unique
+    packed_options = [chr(code) for code in np.unique(letters[chosen])]
+    options, codes = np.unique(np.asarray(packed_options + answers, dtype=str), return_inverse=True)
+    offset = 0
+    if options.size and options[0] == '':
+        # Пустая строка - это пропущенный ответ, а не вариант
+        offset = 1
+        options = options[1:]
+    codes = codes.reshape(-1) - offset
+    if packed_options:
+        lookup = np.full(256, -1, dtype=np.int16)
+        lookup[[ord(option) for option in packed_options]] = codes[:len(packed_options)]
+        choices[:packed] = np.where(chosen, lookup[letters], -1)
+    choices[rows, cols] = codes[len(packed_options):]
+
+    return {
+        'correct': correct,
+        'answered': answered,
+        'choices': choices,
+        'options': [str(option) for option in options],
+        'time_spent': np.asarray(packed_times + json_times, dtype=np.float64),
+    }
+
+
+def _point_biserial(correct):
+    """Дискриминативность: корреляция ответа на вопрос с баллом за остальные вопросы"""
+    items = correct.astype(np.float64)
+    rest = items.sum(axis=1, keepdims=True) - items
+    items_centered = items - items.mean(axis=0)
+    rest_centered = rest - rest.mean(axis=0)
+    covariance = (items_centered * rest_centered).mean(axis=0)
+    denominator = items.std(axis=0) * rest.std(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, covariance / denominator, np.nan)
+
+
+def analyze_items(matrix):
+    """Покомпонентный анализ вопросов за один векторизованный проход"""
+    correct = matrix['correct']
+    answered = matrix['answered']
+    choices = matrix['choices']
+    options = matrix['options']
+    attempts, questions = correct.shape
+
+    if attempts == 0:
+        return {'attempts': 0, 'questions': [], 'score': None, 'time_spent_quantiles': {}}
+
+    difficulty = correct.mean(axis=0)
+    discrimination = _point_biserial(correct)
+
+    # Частоты вариантов: bincount по паре (вопрос, вариант) сразу для всей матрицы
+    option_count = len(options)
+    valid = choices >= 0
+    flat = (np.nonzero(valid)[1] * option_count + choices[valid]).astype(np.int64)
+    frequencies = np.bincount(flat, minlength=questions * option_count).reshape(questions, option_count)
+    missing = (~answered).sum(axis=0) + (answered & ~valid).sum(axis=0)
+
+    totals = correct.sum(axis=1)
+    quantiles = np.quantile(matrix['time_spent'], TIME_QUANTILES)
+
+    return {
+        'attempts': int(attempts),
+        'questions': [
+            {
+                'question': question + 1,
+                'difficulty': round(float(difficulty[question]), 4),
+                'discrimination': None if np.isnan(discrimination[question])
+                else round(float(discrimination[question]), 4),
+                'choices': {option: int(frequencies[question, code]) for code, option in enumerate(options)},
+                'missing': int(missing[question]),
+            }
+            for question in range(questions)
+        ],
+        'score': {
+            'mean': round(float(totals.mean()), 4),
+            'std': round(float(totals.std()), 4),
+        },
+        'time_spent_quantiles': {
+            f'p{int(q * 100)}': round(float(value), 2) for q, value in zip(TIME_QUANTILES, quantiles)
+        },
+    }
+
+
+def get_item_analysis(level, city=None, school=None):
+    """Анализ вопросов уровня (с фильтром по городу и школе)"""
+    result = analyze_items(load_item_matrix(level, city=city, school=school))
+    result['level'] = level
+    return result
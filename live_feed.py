@@ -0,0 +1,100 @@
+import queue
+import threading
+
+# Очередь подписчика: если панель не успевает читать, она получает resync и перезагружает сводку
+SUBSCRIBER_QUEUE_SIZE = 1000
+HEARTBEAT_SECONDS = 15  # комментарий SSE для прокси и обнаружения закрытых соединений
+
+
+class Subscription:
+    """Подписка панели учителя на новые попытки (фильтр - ключи города и школы, '' - любые)"""
+
+    def __init__(self, city_key='', school_key='', max_size=SUBSCRIBER_QUEUE_SIZE):
+        self.city_key = city_key
+        self.school_key = school_key
+        self.events = queue.Queue(max_size)
+        self.overflowed = False
+
+    def get(self, timeout=HEARTBEAT_SECONDS):
+        """Следующее событие или None, если за timeout событий не было"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveFeed:
+    """Раздача событий о сохранённых попытках подпискам этого процесса.
+
+    Подписки сгруппированы по фильтру, поэтому публикация проверяет четыре группы
+    (без фильтра, город, город и школа, школа), а не всех подписчиков.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = {}
+        self.stats = {'published': 0, 'delivered': 0, 'dropped': 0}
+
+    def subscribe(self, city_key='', school_key=''):
+        subscription = Subscription(city_key, school_key)
+        with self._lock:
+            self._groups.setdefault((city_key, school_key), set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        key = (subscription.city_key, subscription.school_key)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None:
+                group.discard(subscription)
+                if not group:
+                    del self._groups[key]
+
+    def publish_many(self, items, make_event):
+        """Пачка попыток одной блокировкой: items - [(данные, город, школа)], make_event(данные) -> событие.
+
+        События строятся, только если есть подходящие подписки (при импорте их обычно нет);
+        переполненной подписке, которая уже ждёт resync, события не кладутся.
+        """
+        with self._lock:
+            self.stats['published'] += len(items)
+            if not self._groups:
+                return
+            for data, city_key, school_key in items:
+                event = None
+                for key in {('', ''), (city_key, ''), (city_key, school_key), ('', school_key)}:
+                    for subscription in self._groups.get(key, ()):
+                        if subscription.overflowed:
+                            self.stats['dropped'] += 1
+                            continue
+                        if event is None:
+                            event = make_event(data)
+                        try:
+                            subscription.events.put_nowait(event)
+                            self.stats['delivered'] += 1
+                        except queue.Full:
+                            subscription.overflowed = True
+                            self.stats['dropped'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, subscribers=sum(len(group) for group in self._groups.values()))
+
+
+_feed = LiveFeed()
+
+
+def subscribe(city_key='', school_key=''):
+    return _feed.subscribe(city_key, school_key)
+
+
+def unsubscribe(subscription):
+    _feed.unsubscribe(subscription)
+
+
+def publish_many(items, make_event):
+    _feed.publish_many(items, make_event)
+
+
+def get_stats():
+    return _feed.get_stats()
@@ -1,61 +1,491 @@
-from flask import Flask, render_template, request, jsonify
+import atexit
+import json
+import time
+from flask import Flask, request, redirect, send_from_directory, make_response, jsonify, Response, stream_with_context, g
+from werkzeug.exceptions import RequestEntityTooLarge
+from app_logging import configure_logging, shutdown_logging, get_logger
 from DBmanager import *
+import write_behind
+from response_cache import cached_json, clear_cache, get_cache_info, json_variants, send_json
+from item_analysis import get_item_analysis
+import answer_keys
+import page_cache
+import regions
+import assets
+import teacher_auth
+import metrics
+import archive
+import live_feed
+import score_ranks
+import bulk_import
+import columnar
+
+# Журнал пишется в отдельном потоке; atexit вызывает обработчики в обратном порядке,
+# поэтому остановка журнала, зарегистрированная первой, выполняется последней
+configure_logging()
+atexit.register(shutdown_logging)
+logger = get_logger('app')
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 
-# Путь к файлу с ключом
-KEY_FILE_PATH = 'key.txt'
+# Инициализация базы данных при старте; отложенное заполнение данных миграций - в фоне
+init_db()
+start_backfills()
+
+# Распределение баллов для процентилей в ответе на отправку теста
+load_score_ranks()
+
+# Ключи ответов загружаются один раз; баллы считает сервер
+answer_keys.load_answer_keys()
+_stale_levels = answer_keys.get_stale_levels()
+if _stale_levels:
+    logger.warning("Ключи уровней изменились: выполните python manage.py regrade", extra={'levels': _stale_levels})
+
+# Закрываем соединения пула при остановке приложения
+atexit.register(close_all_connections)
+
+# Изменения попыток другими процессами (manage.py) учитываются в процентилях фоновым потоком.
+# atexit вызывает обработчики в обратном порядке: поток останавливается до закрытия пула
+start_score_ranks_refresh()
+atexit.register(stop_score_ranks_refresh)
 
+# Отложенная запись с групповой фиксацией (WRITE_BEHIND=1).
+# atexit вызывает обработчики в обратном порядке: очередь дописывается до закрытия пула
+if write_behind.WRITE_BEHIND_ENABLED and write_behind.start():
+    atexit.register(write_behind.stop)
 
-def get_teacher_key():
-    """Получение ключа учителя из файла"""
+
+# Постраничная выдача результатов
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+
+def parse_page_args(args):
+    """Разбор limit/after; ValueError при некорректных значениях"""
+    limit = args.get('limit')
+    after = args.get('after') or None
+    if limit in (None, ''):
+        limit = DEFAULT_PAGE_LIMIT
     try:
-        with open(KEY_FILE_PATH, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except Exception as e:
-        print(f"Ошибка при чтении ключа: {str(e)}")
-        return None
+        limit = int(limit)
+    except (TypeError, ValueError):
+        # Текст исключения int() клиенту не отдаём
+        raise ValueError('limit должен быть целым числом')
+    if limit < 1:
+        raise ValueError('limit должен быть положительным')
+    if after:
+        decode_cursor(after)
+    return min(limit, MAX_PAGE_LIMIT), after
+
+
+def parse_season_arg(args):
+    """Сезон архива из ?season=; ValueError, если архива такого сезона нет"""
+    season = args.get('season') or None
+    if season and season not in list_seasons():
+        raise ValueError(f'Архив сезона {season} не найден')
+    return season
+
+
+def ndjson_response(rows):
+    """Потоковый ответ: по одной JSON-строке на запись, без сборки всего списка в памяти"""
+    def generate():
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def columnar_response(payload):
+    """Ответ format=columnar без кэша: компактный JSON, сжатый, если клиент принимает gzip или br"""
+    return send_json(*json_variants(payload, columnar.dumps, compress=True))
+
+
+def save_submission(**fields):
+    """Сохранение отправки напрямую или через очередь отложенной записи"""
+    if write_behind.is_running():
+        return write_behind.submit_test_result(**fields)
+    return submit_test_result(**fields)
+
+
+# Страницы без данных запроса отдаются из page_cache (собраны при старте, сжаты заранее)
+PAGES = (
+    'index.html',
+    'HighSchoolStudent/easy.html',
+    'HighSchoolStudent/medium.html',
+    'HighSchoolStudent/hard.html',
+    'MiddleSchoolStudent/easy.html',
+    'MiddleSchoolStudent/medium.html',
+    'MiddleSchoolStudent/hard.html',
+)
+
+
+@app.context_processor
+def inject_catalog_urls():
+    """Адреса общих данных, которые страницы загружают отдельно"""
+    return {'regions_catalog_url': regions.CATALOG_URL}
+
+
+@app.context_processor
+def inject_asset_helpers():
+    """Адреса собранных вариантов изображений (python manage.py build-assets)"""
+    return {
+        'asset_url': assets.asset_url,
+        'asset_image_set': assets.asset_image_set,
+        'asset_picture': assets.asset_picture,
+    }
+
+
+# Варианты изображений должны соответствовать исходникам; страницы пересобираются при смене манифеста
+_stale_assets = assets.check_assets()
+if _stale_assets:
+    logger.warning("Варианты изображений устарели: выполните python manage.py build-assets", extra={'assets': _stale_assets})
+page_cache.watch(assets.MANIFEST_PATH)
+
+with app.app_context():
+    page_cache.precompile(PAGES)
+
+# Справочник регионов: тело сжато один раз, адрес содержит хэш содержимого
+REGIONS_VARIANTS = page_cache.compress_variants(regions.CATALOG_BODY)
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Число запросов и время обработки по маршруту (шаблон маршрута, а не конкретный адрес)"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe('webhistory_http_request_duration_seconds', elapsed, route=route, method=request.method)
+        metrics.inc('webhistory_http_requests_total', route=route, method=request.method, status=response.status_code)
+        logger.debug("Запрос обработан", extra={
+            'route': route, 'method': request.method, 'status': response.status_code, 'duration_ms': round(elapsed * 1000, 3)
+        })
+    return response
+
+
+def collect_gauges():
+    """Текущие значения пула, кэша ответов, очереди отложенной записи и живой ленты для /metrics"""
+    pool = get_connection_stats()
+    cache = get_cache_info()
+    writer = write_behind.get_stats()
+    return [
+        ('webhistory_db_pool_connections', 'gauge', pool['in_use'], {'state': 'in_use'}),
+        ('webhistory_db_pool_connections', 'gauge', pool['idle'], {'state': 'idle'}),
+        ('webhistory_response_cache_entries', 'gauge', cache['entries'], {}),
+        ('webhistory_response_cache_bytes', 'gauge', cache['bytes'], {}),
+        ('webhistory_write_behind_queued', 'gauge', writer['queued'], {}),
+        ('webhistory_live_subscribers', 'gauge', live_feed.get_stats()['subscribers'], {}),
+    ]
 
-# Инициализация базы данных при старте
-init_db()
+
+metrics.registry.register_collector(collect_gauges)
 
 
 @app.route('/')
 def index():
     """Главная страница с результатами учеников"""
-    return render_template('index.html')
+    return page_cache.serve_page('index.html')
+
+
+def check_teacher_access(data):
+    """Проверка доступа учителя по токену сессии или ключу в теле запроса; возвращает ответ с ошибкой или None"""
+    if not data or not (data.get('token') or 'key' in data):
+        return jsonify({'status': 'error', 'message': 'Ключ не предоставлен'}), 400
+    
+    # Токен сессии: только проверка подписи и срока, без обращения к ключу на диске
+    if data.get('token'):
+        if teacher_auth.check_token(data['token']) is None:
+            return jsonify({'status': 'error', 'message': 'Сессия истекла, войдите заново'}), 401
+        return None
+    
+    valid = teacher_auth.check_key(data['key'])
+    if valid is None:
+        return jsonify({'status': 'error', 'message': 'Ошибка сервера при чтении ключа'}), 500
+    
+    if not valid:
+        return jsonify({'status': 'error', 'message': 'Неверный ключ доступа'}), 403
+    
+    return None
+
+
+def with_session_token(response, data):
+    """Выдача токена сессии (заголовок X-Session-Token) после входа по ключу"""
+    response = make_response(response)
+    if not data.get('token') and response.status_code in (200, 304):
+        response.headers['X-Session-Token'] = teacher_auth.issue_token()
+        response.headers['X-Session-Expires-In'] = str(teacher_auth.TOKEN_MAX_AGE)
+    return response
 
 
 @app.route('/api/verify-key', methods=['POST'])
 def verify_key():
-    """Проверка ключа учителя и получение результатов"""
+    """Проверка ключа учителя и получение результатов.
+
+    Вместо ключа можно передать token, выданный при входе (заголовок X-Session-Token).
+    mode=summary - сводка по классам без ответов (ответы подгружаются через /api/student-answers).
+    format=columnar - ученики колонками со словарями повторяющихся строк (см. columnar.py), со сжатием.
+    """
     try:
         data = request.get_json()
         
-        if not data or 'key' not in data:
-            return jsonify({'status': 'error', 'message': 'Ключ не предоставлен'}), 400
-        
-        teacher_key = get_teacher_key()
-        if teacher_key is None:
-            return jsonify({'status': 'error', 'message': 'Ошибка сервера при чтении ключа'}), 500
-        
-        if data['key'].strip() != teacher_key:
-            return jsonify({'status': 'error', 'message': 'Неверный ключ доступа'}), 403
+        error = check_teacher_access(data)
+        if error:
+            return error
         
         # Получаем фильтры
         city = data.get('city', '')
         school = data.get('school', '')
         
+        # Постраничный или потоковый режим: курсор по (created_at, id)
+        if data.get('format') == 'ndjson' or 'limit' in data or 'after' in data:
+            try:
+                limit, after = parse_page_args(data)
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+            
+            if data.get('format') == 'ndjson':
+                return with_session_token(
+                    ndjson_response(iter_tests(city=city or None, school=school or None, after=after)), data
+                )
+            
+            page = get_tests_page(city=city or None, school=school or None, after=after, limit=limit)
+            if data.get('format') == 'columnar':
+                return with_session_token(columnar_response({
+                    'status': 'success',
+                    'format': 'columnar',
+                    'data': columnar.encode_rows(page['items']),
+                    'next_cursor': page['next_cursor']
+                }), data)
+            classes = {}
+            for test in page['items']:
+                classes.setdefault(test['class_name'], []).append(test)
+            return with_session_token(jsonify({
+                'status': 'success',
+                'data': classes,
+                'next_cursor': page['next_cursor']
+            }), data)
+        
+        # Выборки по фильтру кэшируются общими для всех сессий (до следующей записи в БД)
+        if data.get('format') == 'columnar':
+            summary = data.get('mode') == 'summary'
+            return with_session_token(cached_json(
+                ('class-summary' if summary else 'students-by-class', 'columnar', normalize_key(city), normalize_key(school)),
+                lambda: {
+                    'status': 'success',
+                    'format': 'columnar',
+                    'data': columnar.encode_class_summary(get_class_summary(city=city or None, school=school or None))
+                    if summary else columnar.encode_classes(get_students_by_class(city=city or None, school=school or None))
+                },
+                dumps=columnar.dumps,
+                compress=True
+            ), data)
+        
+        if data.get('mode') == 'summary':
+            return with_session_token(cached_json(
+                ('class-summary', normalize_key(city), normalize_key(school)),
+                lambda: {
+                    'status': 'success',
+                    'data': get_class_summary(city=city or None, school=school or None)
+                }
+            ), data)
+        
         # Ключ верный - возвращаем данные учеников по классам с фильтрацией
-        students_by_class = get_students_by_class(city=city if city else None, school=school if school else None)
+        return with_session_token(cached_json(
+            ('students-by-class', normalize_key(city), normalize_key(school)),
+            lambda: {
+                'status': 'success',
+                'data': get_students_by_class(city=city if city else None, school=school if school else None)
+            }
+        ), data)
+        
+    except Exception as e:
+        logger.error("Ошибка при проверке ключа", extra={'error': str(e)})
+        return jsonify({'status': 'error', 'message': 'Ошибка сервера'}), 500
+
+
+# Живая лента панели учителя: больше пропущенных попыток - панель перезагружает сводку целиком
+LIVE_REPLAY_LIMIT = 1000
+SSE_RETRY_MS = 3000
+
+
+def parse_since_id(value):
+    """since_id / Last-Event-ID: None - без догоняющей выдачи; ValueError при некорректном значении"""
+    if value in (None, ''):
+        return None
+    since_id = int(value)
+    if since_id < 0:
+        raise ValueError
+    return since_id
+
+
+def sse_message(event, data, event_id=None):
+    """Сообщение Server-Sent Events; id становится Last-Event-ID при переподключении"""
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False))
+    return '\n'.join(lines) + '\n\n'
+
+
+@app.route('/api/live', methods=['GET'])
+def live_updates():
+    """Поток новых попыток (text/event-stream) для панели учителя.
+
+    ?token= - токен сессии (EventSource не передаёт заголовки), ?city=&school= - фильтр;
+    ?since_id= или заголовок Last-Event-ID - сначала отправляются пропущенные попытки.
+    Событие attempt - одна попытка, resync - пропущено слишком много, нужна полная сводка.
+    """
+    error = check_teacher_access({'token': request.args.get('token')})
+    if error:
+        return error
+    
+    city = request.args.get('city') or None
+    school = request.args.get('school') or None
+    try:
+        since_id = parse_since_id(request.headers.get('Last-Event-ID') or request.args.get('since_id'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Некорректный since_id'}), 400
+    
+    def generate():
+        # Подписка до чтения пропущенных попыток: попытка, сохранённая между ними, не потеряется
+        subscription = live_feed.subscribe(normalize_key(city), normalize_key(school))
+        try:
+            yield f'retry: {SSE_RETRY_MS}\n\n'
+            replayed = set()
+            if since_id is not None:
+                missed = get_attempts_since(since_id, city=city, school=school, limit=LIVE_REPLAY_LIMIT + 1)
+                if len(missed) > LIVE_REPLAY_LIMIT:
+                    yield sse_message('resync', {'reason': 'too_many_missed'})
+                    return
+                for attempt in missed:
+                    replayed.add(attempt['id'])
+                    yield sse_message('attempt', attempt, attempt['id'])
+            while not subscription.overflowed:
+                attempt = subscription.get()
+                if attempt is None:
+                    yield ': ping\n\n'
+                elif attempt['id'] not in replayed:
+                    yield sse_message('attempt', attempt, attempt['id'])
+            yield sse_message('resync', {'reason': 'overflow'})
+        finally:
+            live_feed.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/live/delta', methods=['GET'])
+def live_delta():
+    """Попытки после since_id (от старых к новым) - догоняющая выдача после переподключения.
+
+    ?token=, ?city=&school=, ?limit= как в /api/tests; has_more - есть ещё попытки после last_id.
+    """
+    try:
+        error = check_teacher_access({'token': request.args.get('token')})
+        if error:
+            return error
         
+        try:
+            since_id = parse_since_id(request.args.get('since_id'))
+            if since_id is None:
+                raise ValueError
+            limit, _ = parse_page_args(request.args)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Некорректные since_id или limit'}), 400
+        
+        attempts = get_attempts_since(since_id, city=request.args.get('city') or None,
+                                      school=request.args.get('school') or None, limit=limit + 1)
+        has_more = len(attempts) > limit
+        attempts = attempts[:limit]
         return jsonify({
             'status': 'success',
-            'data': students_by_class
+            'data': attempts,
+            'last_id': attempts[-1]['id'] if attempts else since_id,
+            'has_more': has_more
         }), 200
+    except Exception as e:
+        logger.error("Ошибка при получении новых попыток", extra={'error': str(e)})
+        return jsonify({'status': 'error', 'message': 'Ошибка сервера'}), 500
+
+
+# Сколько попыток можно запросить в /api/student-answers за раз
+MAX_ANSWER_IDS = 200
+
+
+@app.route('/api/student-answers', methods=['POST'])
+def student_answers():
+    """Ответы выбранных попыток (по id) - подгружаются при раскрытии строки ученика"""
+    try:
+        data = request.get_json()
+        
+        error = check_teacher_access(data)
+        if error:
+            return error
         
+        ids = data.get('ids')
+        if not isinstance(ids, list) or not ids:
+            return jsonify({'status': 'error', 'message': 'Не переданы id попыток'}), 400
+        if len(ids) > MAX_ANSWER_IDS:
+            return jsonify({'status': 'error', 'message': f'Не более {MAX_ANSWER_IDS} попыток за запрос'}), 400
+        try:
+            ids = [int(test_id) for test_id in ids]
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'Некорректный id попытки'}), 400
+        
+        answers = get_answers_by_ids(ids)
+        return jsonify({
+            'status': 'success',
+            'data': {str(test_id): test_answers for test_id, test_answers in answers.items()}
+        }), 200
+        
+    except Exception as e:
+        logger.error("Ошибка при получении ответов", extra={'error': str(e)})
+        return jsonify({'status': 'error', 'message': 'Ошибка сервера'}), 500
+
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_QUERY = 100
+
+
+@app.route('/api/search-students', methods=['POST'])
+def search_students():
+    """Поиск учеников по фамилии, имени, классу, школе и городу (постранично, без ответов)"""
+    try:
+        data = request.get_json()
+
+        error = check_teacher_access(data)
+        if error:
+            return error
+
+        query = str(data.get('q') or '').strip()
+        if not query:
+            return jsonify({'status': 'error', 'message': 'Пустой поисковый запрос'}), 400
+        if len(query) > MAX_SEARCH_QUERY:
+            return jsonify({'status': 'error', 'message': f'Запрос длиннее {MAX_SEARCH_QUERY} символов'}), 400
+        try:
+            limit = min(int(data.get('limit') or DEFAULT_SEARCH_LIMIT), SEARCH_MAX_LIMIT)
+            after = int(data['after']) if data.get('after') is not None else None
+            if limit < 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'Некорректные limit или after'}), 400
+
+        result = search_tests(query, city=data.get('city') or None, school=data.get('school') or None,
+                              after=after, limit=limit)
+        return with_session_token(jsonify({
+            'status': 'success',
+            'data': result['items'],
+            'next_cursor': result['next_cursor'],
+            'match': result['match']
+        }), data)
+
     except Exception as e:
-        print(f"Ошибка при проверке ключа: {str(e)}")
+        logger.error("Ошибка при поиске учеников", extra={'error': str(e)})
         return jsonify({'status': 'error', 'message': 'Ошибка сервера'}), 500
 
 
@@ -63,39 +493,75 @@ def verify_key():
 def get_cities_schools():
     """Получение списка городов и школ"""
     try:
-        cities = get_cities_and_schools()
-        return jsonify({
+        return cached_json(('cities-schools',), lambda: {
             'status': 'success',
-            'data': cities
-        }), 200
+            'data': get_cities_and_schools()
+        })
     except Exception as e:
-        print(f"Ошибка при получении городов и школ: {str(e)}")
+        logger.error("Ошибка при получении городов и школ", extra={'error': str(e)})
         return jsonify({'status': 'error', 'message': 'Ошибка сервера'}), 500
 
 
+@app.route('/api/regions/<version>.json', methods=['GET'])
+def regions_catalog(version):
+    """Справочник регионов и городов; по версионному адресу кэшируется навсегда"""
+    if version != regions.CATALOG_VERSION:
+        return redirect(regions.CATALOG_URL)
+    return page_cache.send_variants(
+        REGIONS_VARIANTS, regions.CATALOG_VERSION, 'application/json', 'public, max-age=31536000, immutable'
+    )
+
+
+@app.route('/api/regions', methods=['GET'])
+def regions_catalog_latest():
+    """Текущая версия справочника регионов"""
+    return redirect(regions.CATALOG_URL)
+
+
+@app.route('/api/regions/search', methods=['GET'])
+def regions_search():
+    """Поиск города по началу названия (или любого слова в названии)"""
+    try:
+        limit = min(int(request.args.get('limit', regions.SEARCH_LIMIT)), 100)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Некорректный limit'}), 400
+    return jsonify({
+        'status': 'success',
+        'data': regions.search_cities(request.args.get('q', ''), limit)
+    }), 200
+
+
+@app.route('/assets/<path:filename>', methods=['GET'])
+def asset_file(filename):
+    """Собранные варианты изображений: имя содержит хэш, поэтому кэшируются навсегда"""
+    response = send_from_directory(assets.OUTPUT_DIR, filename, max_age=31536000)
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route('/test/high-school-student/easy')
 def high_school_easy():
-    return render_template('HighSchoolStudent/easy.html')
+    return page_cache.serve_page('HighSchoolStudent/easy.html')
 
 @app.route('/test/high-school-student/medium')
 def high_school_medium():
-    return render_template('HighSchoolStudent/medium.html')
+    return page_cache.serve_page('HighSchoolStudent/medium.html')
 
 @app.route('/test/high-school-student/hard')
 def high_school_hard():
-    return render_template('HighSchoolStudent/hard.html')
+    return page_cache.serve_page('HighSchoolStudent/hard.html')
 
 @app.route('/test/middle-school-student/easy')
 def middle_school_easy():
-    return render_template('MiddleSchoolStudent/easy.html')
+    return page_cache.serve_page('MiddleSchoolStudent/easy.html')
 
 @app.route('/test/middle-school-student/medium')
 def middle_school_medium():
-    return render_template('MiddleSchoolStudent/medium.html')
+    return page_cache.serve_page('MiddleSchoolStudent/medium.html')
 
 @app.route('/test/middle-school-student/hard')
 def middle_school_hard():
-    return render_template('MiddleSchoolStudent/hard.html')
+    return page_cache.serve_page('MiddleSchoolStudent/hard.html')
 
 
 @app.route('/api/check-test', methods=['POST'])
@@ -131,7 +597,7 @@ def check_test():
         return jsonify({'status': 'ok', 'message': 'Тест можно пройти'}), 200
         
     except Exception as e:
-        print(f"Ошибка при проверке теста: {str(e)}")
+        logger.error("Ошибка при проверке теста", extra={'error': str(e)})
         return jsonify({'status': 'error', 'message': 'Ошибка сервера'}), 500
 
 
@@ -144,50 +610,67 @@ def submit_test():
         if not data:
             return jsonify({'status': 'error', 'message': 'Нет данных'}), 400
         
-        required_fields = ['firstName', 'lastName', 'className', 'answers', 'testLevel', 'score']
+        required_fields = ['firstName', 'lastName', 'className', 'answers', 'testLevel']
         for field in required_fields:
             if field not in data:
                 return jsonify({'status': 'error', 'message': f'Отсутствует поле: {field}'}), 400
         
-        # Проверяем, не проходил ли уже этот тест
-        existing = check_test_exists(
-            first_name=data['firstName'],
-            last_name=data['lastName'],
-            class_name=data['className'],
-            level=data['testLevel']
-        )
-        
-        if existing['exists']:
-            return jsonify({
-                'status': 'exists',
-                'message': f'Вы уже проходили этот тест! Ваш результат: {existing["score"]} из {existing["max_score"]}'
-            }), 409
+        # Баллы считаются по ключу уровня на сервере; присланный score не используется
+        if not isinstance(data['answers'], list):
+            return jsonify({'status': 'error', 'message': 'Поле answers должно быть списком'}), 400
+        try:
+            answers, score, max_score = answer_keys.grade(data['testLevel'], data['answers'])
+            regions.validate_location(data.get('city', ''), data.get('school', ''))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         
-        # Сохранение данных в БД
-        test_id = save_test_result(
+        # Сохранение данных в БД; повторное прохождение определяется той же вставкой
+        result = save_submission(
             first_name=data['firstName'],
             last_name=data['lastName'],
             class_name=data['className'],
             city=data.get('city', ''),
             school=data.get('school', ''),
-            answers=data['answers'],
-            score=data['score'],
+            answers=answers,
+            score=score,
             level=data['testLevel'],
             time=data.get('time', 0)
         )
         
-        print(f"Тест успешно сохранен! ID: {test_id}")
-        print(f"Ученик: {data['firstName']} {data['lastName']}, Класс: {data['className']}, Город: {data.get('city', '')}, Школа: {data.get('school', '')}")
-        print(f"Уровень: {data['testLevel']}, Баллы: {data['score']}")
+        if not result['created']:
+            return jsonify({
+                'status': 'exists',
+                'message': f'Вы уже проходили этот тест! Ваш результат: {result["score"]} из {result["max_score"]}'
+            }), 409
+        
+        test_id = result['test_id']
+        logger.info("Тест успешно сохранен", extra={
+            'test_id': test_id,
+            'student': f"{data['firstName']} {data['lastName']}",
+            'class_name': data['className'],
+            'city': data.get('city', ''),
+            'school': data.get('school', ''),
+            'test_level': data['testLevel'],
+            'score': score,
+            'max_score': max_score
+        })
+        
+        # Место среди всех прошедших уровень, в городе и в школе - из распределения в памяти
+        rank = score_ranks.rank(data['testLevel'], normalize_key(data.get('city', '')),
+                                normalize_key(data.get('school', '')), score)
         
         return jsonify({
             'status': 'success',
             'message': 'Результаты теста успешно сохранены',
-            'test_id': test_id
+            'test_id': test_id,
+            'score': score,
+            'max_score': max_score,
+            'answers': answers,
+            'rank': rank
         }), 200
         
     except Exception as e:
-        print(f"Ошибка при сохранении результатов теста: {str(e)}")
+        logger.error("Ошибка при сохранении результатов теста", extra={'error': str(e)})
         return jsonify({
             'status': 'error',
             'message': 'Ошибка сервера при сохранении данных'
@@ -196,16 +679,62 @@ def submit_test():
 
 @app.route('/api/tests', methods=['GET'])
 def get_tests():
-    """Получение всех результатов тестов"""
+    """Получение всех результатов тестов.
+
+    ?limit=&after= - постраничная выдача по курсору, ?format=ndjson - потоковая выдача;
+    ?city=&school= - фильтр для обоих режимов; ?season=2024-2025 - попытки из архива сезона;
+    ?format=columnar - колонки со словарями повторяющихся строк, со сжатием (полная выдача и страницы).
+    """
     try:
+        city = request.args.get('city') or None
+        school = request.args.get('school') or None
+        paged = 'limit' in request.args or 'after' in request.args
+        try:
+            season = parse_season_arg(request.args)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 404
+        
+        if paged or season or request.args.get('format') == 'ndjson':
+            try:
+                limit, after = parse_page_args(request.args)
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+            
+            if request.args.get('format') == 'ndjson':
+                return ndjson_response(iter_tests(city=city, school=school, after=after,
+                                                  limit=limit if paged else None, season=season))
+            
+            page = get_tests_page(city=city, school=school, after=after, limit=limit, season=season)
+            if request.args.get('format') == 'columnar':
+                return columnar_response({
+                    'status': 'success',
+                    'format': 'columnar',
+                    'data': columnar.encode_rows(page['items']),
+                    'count': len(page['items']),
+                    'next_cursor': page['next_cursor']
+                })
+            return jsonify({
+                'status': 'success',
+                'data': page['items'],
+                'count': len(page['items']),
+                'next_cursor': page['next_cursor']
+            }), 200
+        
         tests = get_all_tests()
+        if request.args.get('format') == 'columnar':
+            return columnar_response({
+                'status': 'success',
+                'format': 'columnar',
+                'data': columnar.encode_rows(tests),
+                'count': len(tests)
+            })
         return jsonify({
             'status': 'success',
             'data': tests,
             'count': len(tests)
         }), 200
     except Exception as e:
-        print(f"Ошибка при получении тестов: {str(e)}")
+        logger.error("Ошибка при получении тестов", extra={'error': str(e)})
         return jsonify({
             'status': 'error',
             'message': 'Ошибка сервера при получении данных'
@@ -216,19 +745,20 @@ def get_tests():
 def get_test(test_id):
     """Получение конкретного результата теста"""
     try:
-        test = get_test_by_id(test_id)
-        if test:
-            return jsonify({
-                'status': 'success',
-                'data': test
-            }), 200
+        def build():
+            test = get_test_by_id(test_id)
+            return {'status': 'success', 'data': test} if test else None
+        
+        response = cached_json(('test', test_id), build)
+        if response is not None:
+            return response
         else:
             return jsonify({
                 'status': 'error',
                 'message': 'Тест не найден'
             }), 404
     except Exception as e:
-        print(f"Ошибка при получении теста: {str(e)}")
+        logger.error("Ошибка при получении теста", extra={'error': str(e)})
         return jsonify({
             'status': 'error',
             'message': 'Ошибка сервера при получении данных'
@@ -237,18 +767,156 @@ def get_test(test_id):
 
 @app.route('/api/statistics', methods=['GET'])
 def get_stats():
-    """Получение статистики по тестам"""
+    """Получение статистики по тестам; ?by=city|school|class добавляет разрез (с фильтром city/school),
+    ?season=2024-2025 - статистика архива сезона"""
+    try:
+        by = request.args.get('by')
+        city = request.args.get('city') or None
+        school = request.args.get('school') or None
+        if by and by not in STATS_DIMENSIONS:
+            return jsonify({'status': 'error', 'message': f'Неизвестный разрез: {by}'}), 400
+        try:
+            season = parse_season_arg(request.args)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 404
+        
+        def build():
+            stats = get_statistics(season=season)
+            if by:
+                stats['breakdown'] = get_statistics_breakdown(by, city=city, school=school, season=season)
+            return {'status': 'success', 'data': stats}
+        
+        return cached_json(('statistics', by, normalize_key(city), normalize_key(school), season), build)
+    except Exception as e:
+        logger.error("Ошибка при получении статистики", extra={'error': str(e)})
+        return jsonify({
+            'status': 'error',
+            'message': 'Ошибка сервера при получении статистики'
+        }), 500
+
+
+@app.route('/api/db-stats', methods=['GET'])
+def get_db_stats():
+    """Счётчики пула соединений с базой данных"""
+    return jsonify({
+        'status': 'success',
+        'data': get_connection_stats(),
+        'write_behind': write_behind.get_stats(),
+        'response_cache': get_cache_info(),
+        'pages': page_cache.get_page_info(),
+        'teacher_auth': teacher_auth.get_auth_stats(),
+        'live_feed': live_feed.get_stats(),
+        'score_ranks': score_ranks.get_stats(),
+        'latency': metrics.registry.quantiles('webhistory_http_request_duration_seconds'),
+        'queries': metrics.registry.quantiles('webhistory_db_query_seconds')
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/item-analysis', methods=['GET'])
+def item_analysis():
+    """Анализ вопросов уровня: трудность, дискриминативность, частоты вариантов, время"""
     try:
-        stats = get_statistics()
+        level = request.args.get('level')
+        if not level:
+            return jsonify({'status': 'error', 'message': 'Не указан уровень теста'}), 400
+        city = request.args.get('city') or None
+        school = request.args.get('school') or None
+        
+        # Кэш действителен до следующей записи в БД (поколение данных)
+        return cached_json(
+            ('item-analysis', level, normalize_key(city), normalize_key(school)),
+            lambda: {
+                'status': 'success',
+                'data': get_item_analysis(level, city=city, school=school)
+            }
+        )
+    except Exception as e:
+        logger.error("Ошибка при анализе вопросов", extra={'error': str(e)})
         return jsonify({
+            'status': 'error',
+            'message': 'Ошибка сервера при анализе вопросов'
+        }), 500
+
+
+# Размер тела запроса: общий предел для JSON API и отдельный - только для импорта результатов.
+# Ограничение действует и на тело без Content-Length (chunked): чтение сверх него - RequestEntityTooLarge
+MAX_REQUEST_BYTES = 1024 * 1024
+MAX_IMPORT_BYTES = 50 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+
+@app.route('/api/import-results', methods=['POST'])
+def import_results():
+    """Пакетный импорт результатов из NDJSON или CSV (тело запроса) с построчным отчётом.
+
+    Ключ учителя - заголовок X-Teacher-Key или токен X-Session-Token; формат - ?format=csv|ndjson
+    или Content-Type (text/csv, application/x-ndjson).
+    """
+    # Предел поднимается только для этого запроса и до первого обращения к request.stream
+    request.max_content_length = MAX_IMPORT_BYTES
+    try:
+        token = request.headers.get('X-Session-Token')
+        data = {'token': token} if token else {'key': request.headers.get('X-Teacher-Key', '')}
+        error = check_teacher_access(data)
+        if error:
+            return error
+        
+        fmt = request.args.get('format') or bulk_import.detect_format(request.content_type)
+        if fmt not in ('csv', 'ndjson'):
+            return jsonify({'status': 'error', 'message': 'Укажите формат: csv или ndjson'}), 400
+        
+        report = bulk_import.import_stream(request.stream, fmt)
+        return with_session_token(jsonify({'status': 'success', 'data': report}), data)
+    except RequestEntityTooLarge:
+        # Пачки, прочитанные до превышения, уже сохранены; при повторной загрузке они попадут в повторы
+        return jsonify({'status': 'error', 'message': f'Файл больше {MAX_IMPORT_BYTES // (1024 * 1024)} МБ'}), 413
+    except UnicodeDecodeError:
+        return jsonify({'status': 'error', 'message': 'Файл должен быть в кодировке UTF-8'}), 400
+    except Exception as e:
+        logger.error("Ошибка при импорте результатов", extra={'error': str(e)})
+        return jsonify({'status': 'error', 'message': 'Ошибка сервера при импорте'}), 500
+
+
+@app.route('/api/seasons', methods=['GET'])
+def get_seasons():
+    """Сезоны, попытки которых перенесены в архив (для ?season= в /api/tests и /api/statistics)"""
+    return jsonify({'status': 'success', 'data': list_seasons()}), 200
+
+
+@app.route('/api/archive-season', methods=['POST'])
+def archive_season():
+    """Перенос попыток прошлого сезона (season) или старше даты (before) в архив вместо очистки БД"""
+    try:
+        data = request.get_json()
+        
+        error = check_teacher_access(data)
+        if error:
+            return error
+        
+        try:
+            moved = archive.archive_tests(before=data.get('before'), season=data.get('season'))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        if moved:
+            # Ответы по перенесённым попыткам недействительны по поколению; память освобождаем сразу
+            clear_cache()
+        
+        return with_session_token(jsonify({
             'status': 'success',
-            'data': stats
-        }), 200
+            'data': moved,
+            'message': f'В архив перенесено попыток: {sum(moved.values())}'
+        }), data)
     except Exception as e:
-        print(f"Ошибка при получении статистики: {str(e)}")
+        logger.error("Ошибка при архивировании сезона", extra={'error': str(e)})
         return jsonify({
             'status': 'error',
-            'message': 'Ошибка сервера при получении статистики'
+            'message': 'Ошибка сервера при архивировании'
         }), 500
 
 
@@ -257,12 +925,14 @@ def clear_database():
     """Очистка базы данных"""
     try:
         clear_db()
+        # Записи кэша устарели по поколению, но занимали бы память до вытеснения
+        clear_cache()
         return jsonify({
             'status': 'success',
             'message': 'База данных успешно очищена'
         }), 200
     except Exception as e:
-        print(f"Ошибка при очистке базы данных: {str(e)}")
+        logger.error("Ошибка при очистке базы данных", extra={'error': str(e)})
         return jsonify({
             'status': 'error',
             'message': 'Ошибка сервера при очистке базы данных'
@@ -0,0 +1,183 @@
+"""Служебные команды: python manage.py <команда>"""
+import argparse
+import json
+import os
+import sys
+
+import DBmanager
+import answer_keys
+import archive
+import bulk_import
+import assets
+from app_logging import configure_logging, shutdown_logging
+
+
+def cmd_rebuild_stats(args):
+    """Пересчитать сводную статистику с нуля"""
+    DBmanager.rebuild_statistics()
+    return 0
+
+
+def cmd_check_stats(args):
+    """Сверить сводную статистику с таблицей Test"""
+    mismatches = DBmanager.check_statistics()
+    if not mismatches:
+        print("Сводная статистика согласована с таблицей Test")
+        return 0
+    print(f"Найдено расхождений: {len(mismatches)}")
+    for item in mismatches[:50]:
+        print(f"  {item}")
+    if args.fix:
+        DBmanager.rebuild_statistics()
+        return 0
+    return 1
+
+
+def cmd_migrate(args):
+    """Применить миграции схемы БД с заполнением существующих строк (сервер при старте его не ждёт)"""
+    # Миграции уже применены в main() через init_db; остаются отложенные заполнения
+    rows = DBmanager.run_backfills()
+    with DBmanager.get_connection() as conn:
+        version = DBmanager.get_schema_version(conn.cursor())
+    print(f"Схема БД: версия {version} (последняя {DBmanager.SCHEMA_VERSION}), заполнено строк: {rows}")
+    if DBmanager.enable_incremental_vacuum():
+        print("БД переведена в режим auto_vacuum=INCREMENTAL")
+    return 0
+
+
+def cmd_regrade(args):
+    """Пересчитать баллы попыток по ключам из answer_keys.json"""
+    answer_keys.load_answer_keys(args.keys)
+    levels = args.level or None
+    results = answer_keys.regrade(levels, batch_size=args.batch_size)
+    for level, result in results.items():
+        print(f"Уровень {level}: пересчитано {result['attempts']} попыток, "
+              f"изменился балл у {result['changed']} за {result['seconds']:.2f} с")
+    if not results:
+        print("Ключи в БД совпадают с answer_keys.json - пересчёт не требуется")
+    return 0
+
+
+def cmd_archive(args):
+    """Перенести попытки прошлого сезона или старше даты в архив сезона"""
+    moved = archive.archive_tests(before=args.before, season=args.season, batch_size=args.batch_size)
+    for season, rows in moved.items():
+        print(f"Сезон {season}: перенесено {rows} попыток в {DBmanager.archive_path(season)}")
+    if not moved:
+        print("Попыток для переноса в архив нет")
+    return 0
+
+
+def cmd_seasons(args):
+    """Показать архивы сезонов"""
+    for season in DBmanager.list_seasons():
+        size = os.path.getsize(DBmanager.archive_path(season)) // 1024
+        stats = DBmanager.get_statistics(season=season)
+        print(f"{season}: {stats.get('total_tests', 0)} попыток, {size} КБ")
+    return 0
+
+
+def cmd_import_results(args):
+    """Импортировать результаты из CSV или NDJSON (бумажные тесты)"""
+    fmt = args.format or bulk_import.detect_format(args.file)
+    if fmt is None:
+        print("Не удалось определить формат по расширению: укажите --format csv или ndjson")
+        return 2
+    answer_keys.load_answer_keys(args.keys)
+    with open(args.file, 'rb') as f:
+        report = bulk_import.import_stream(f, fmt, batch_size=args.batch_size)
+    print(f"Строк: {report['received']}, добавлено: {report['inserted']}, "
+          f"повторов: {report['duplicates']}, ошибок: {report['errors']}")
+    for item in report['rows'][:50]:
+        print(f"  строка {item['line']}: {item['error']}")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report['errors'] else 0
+
+
+def cmd_build_assets(args):
+    """Собрать варианты изображений (AVIF/WebP/JPEG/PNG по ширинам) и манифест"""
+    rebuilt = assets.build_assets(force=args.force)
+    manifest = assets.read_manifest()
+    for name in rebuilt:
+        entry = manifest[name]
+        sizes = ', '.join(
+            f"{fmt}: {' / '.join(str(variant['bytes'] // 1024) + ' КБ' for variant in variants)}"
+            for fmt, variants in entry['variants'].items()
+        )
+        original = os.path.getsize(os.path.join(assets.SOURCE_DIR, name)) // 1024
+        print(f"{name} ({original} КБ) -> {sizes}")
+    if not rebuilt:
+        print("Варианты изображений актуальны")
+    return 0
+
+
+def cmd_check_assets(args):
+    """Проверить, что варианты изображений соответствуют исходникам"""
+    stale = assets.check_assets()
+    if stale:
+        print(f"Устарели варианты: {', '.join(stale)}")
+        return 1
+    print("Варианты изображений актуальны")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Служебные команды WebHistory')
+    parser.add_argument('--db', default=DBmanager.DATABASE_PATH, help='путь к файлу базы данных')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('rebuild-stats', help=cmd_rebuild_stats.__doc__).set_defaults(func=cmd_rebuild_stats)
+
+    check = commands.add_parser('check-stats', help=cmd_check_stats.__doc__)
+    check.add_argument('--fix', action='store_true', help='пересчитать статистику при расхождениях')
+    check.set_defaults(func=cmd_check_stats)
+
+    commands.add_parser('migrate', help=cmd_migrate.__doc__).set_defaults(func=cmd_migrate)
+
+    regrade = commands.add_parser('regrade', help=cmd_regrade.__doc__)
+    regrade.add_argument('--level', action='append', help='пересчитать уровень даже без изменения ключа (можно повторять)')
+    regrade.add_argument('--keys', default=answer_keys.ANSWER_KEYS_PATH, help='файл с ключами ответов')
+    regrade.add_argument('--batch-size', type=int, default=answer_keys.REGRADE_BATCH_SIZE, help='строк в одной пачке')
+    regrade.set_defaults(func=cmd_regrade)
+
+    archive_parser = commands.add_parser('archive', help=cmd_archive.__doc__)
+    period = archive_parser.add_mutually_exclusive_group(required=True)
+    period.add_argument('--before', help='перенести попытки старше даты ГГГГ-ММ-ДД')
+    period.add_argument('--season', help='перенести сезон целиком, например 2024-2025')
+    archive_parser.add_argument('--batch-size', type=int, default=archive.ARCHIVE_BATCH_SIZE, help='строк в одной транзакции')
+    archive_parser.set_defaults(func=cmd_archive)
+
+    commands.add_parser('seasons', help=cmd_seasons.__doc__).set_defaults(func=cmd_seasons)
+
+    importer = commands.add_parser('import-results', help=cmd_import_results.__doc__)
+    importer.add_argument('file', help='файл .csv или .ndjson')
+    importer.add_argument('--format', choices=('csv', 'ndjson'), help='формат файла (по умолчанию по расширению)')
+    importer.add_argument('--keys', default=answer_keys.ANSWER_KEYS_PATH, help='файл с ключами ответов')
+    importer.add_argument('--batch-size', type=int, default=bulk_import.IMPORT_BATCH_SIZE, help='строк в одной транзакции')
+    importer.add_argument('--report', help='сохранить полный отчёт в JSON')
+    importer.set_defaults(func=cmd_import_results)
+
+    build = commands.add_parser('build-assets', help=cmd_build_assets.__doc__)
+    build.add_argument('--force', action='store_true', help='пересобрать все изображения')
+    build.set_defaults(func=cmd_build_assets)
+
+    commands.add_parser('check-assets', help=cmd_check_assets.__doc__).set_defaults(func=cmd_check_assets)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    configure_logging()
+    try:
+        DBmanager.DATABASE_PATH = args.db
+        DBmanager.init_db(backfill=True)
+        return args.func(args)
+    finally:
+        shutdown_logging()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
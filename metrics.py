@@ -0,0 +1,151 @@
+import bisect
+import threading
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (как histogram в Prometheus)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины (как histogram_quantile)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class MetricsRegistry:
+    """Счётчики и гистограммы с метками; выдача в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._series = {}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        # Гистограммы обновляются на каждый запрос к БД: ищем по меткам в порядке вызова,
+        # а сортируем их только при создании ряда
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            histogram = self._series.get(key)
+            if histogram is None:
+                histogram = self._histograms.setdefault((name, tuple(sorted(labels.items()))), Histogram())
+                self._series[key] = histogram
+            histogram.observe(value)
+
+    def total(self, name):
+        """Сумма счётчика name по всем меткам"""
+        with self._lock:
+            return sum(value for (metric, _), value in self._counters.items() if metric == name)
+
+    def register_collector(self, collect):
+        """collect() возвращает [(имя, тип, значение, {метки})] - значения снимаются в момент выдачи"""
+        self._collectors.append(collect)
+
+    def quantiles(self, name):
+        """p50/p95/p99 по каждому набору меток гистограммы name"""
+        with self._lock:
+            return [
+                dict(labels, count=histogram.count, **{
+                    f'p{int(q * 100)}': None if histogram.quantile(q) is None else round(histogram.quantile(q), 6)
+                    for q in QUANTILES
+                })
+                for (metric, labels), histogram in sorted(self._histograms.items()) if metric == name
+            ]
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in sorted(self._histograms.items())]
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{_labels_text(labels)} {value}')
+
+        for (name, labels), counts, total, count, buckets in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_labels_text(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_bucket{_labels_text(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{_labels_text(labels)} {total}')
+            lines.append(f'{name}_count{_labels_text(labels)} {count}')
+
+        for collect in self._collectors:
+            for name, kind, value, labels in collect():
+                header(name, kind)
+                lines.append(f'{name}{_labels_text(tuple(sorted(labels.items())))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+registry.describe('webhistory_http_requests_total', 'Число HTTP-запросов по маршруту, методу и статусу')
+registry.describe('webhistory_http_request_duration_seconds', 'Время обработки HTTP-запроса')
+registry.describe('webhistory_db_query_seconds', 'Время execute/executemany запроса к SQLite')
+registry.describe('webhistory_db_fetch_seconds', 'Время fetchall по запросу к SQLite')
+registry.describe('webhistory_db_lock_wait_seconds', 'Ожидание блокировки записи (BEGIN IMMEDIATE/EXCLUSIVE)')
+registry.describe('webhistory_db_lock_errors_total', 'Запросы, завершившиеся ошибкой database is locked')
+registry.describe('webhistory_db_retries_total', 'Повторы записи после ошибки')
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+import os
+import threading
+
+from flask import Response, current_app, render_template_string, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Браузер хранит страницу PAGE_MAX_AGE секунд, затем перепроверяет её по ETag
+PAGE_MAX_AGE = 600
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+def content_hash(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def compress_variants(body, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+    """Варианты тела по кодировкам; сжатый вариант хранится, только если он действительно меньше"""
+    variants = {'identity': body}
+    compressed = gzip.compress(body, compresslevel=gzip_level, mtime=0)
+    if len(compressed) < len(body):
+        variants['gzip'] = compressed
+    if brotli is not None:
+        compressed = brotli.compress(body, quality=brotli_quality)
+        if len(compressed) < len(body):
+            variants['br'] = compressed
+    return variants
+
+
+class CompiledPage:
+    """Отрендеренная страница: исходный HTML и сжатые варианты с общим хэшем содержимого"""
+
+    def __init__(self, html, stamp):
+        body = html.encode('utf-8')
+        self.stamp = stamp
+        self.etag = content_hash(body)
+        self.variants = compress_variants(body)
+
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class PageCache:
+    """Страницы без данных запроса: рендерятся один раз и пересобираются при изменении шаблона
+    или файлов, от которых зависит рендеринг (watch)"""
+
+    def __init__(self):
+        self._pages = {}
+        self._dependencies = []
+        self._lock = threading.Lock()
+        self.stats = {'builds': 0, 'hits': 0, 'not_modified': 0}
+
+    def _template_path(self, template):
+        return os.path.join(current_app.root_path, current_app.template_folder, template)
+
+    def watch(self, path):
+        self._dependencies.append(path)
+
+    def _stamp(self, template):
+        # Время изменения и размер шаблона и всех зависимостей
+        return tuple(_file_stamp(path) for path in [self._template_path(template), *self._dependencies])
+
+    def get(self, template):
+        stamp = self._stamp(template)
+        page = self._pages.get(template)
+        if page is not None and page.stamp == stamp:
+            return page
+        with self._lock:
+            page = self._pages.get(template)
+            if page is None or page.stamp != stamp:
+                page = self._build(template, stamp)
+        return page
+
+    def _build(self, template, stamp):
+        with open(self._template_path(template), 'r', encoding='utf-8') as f:
+            source = f.read()
+        page = CompiledPage(render_template_string(source), stamp)
+        self._pages[template] = page
+        self.stats['builds'] += 1
+        return page
+
+    def info(self):
+        return dict(self.stats, pages={
+            template: {encoding: len(body) for encoding, body in page.variants.items()}
+            for template, page in self._pages.items()
+        })
+
+
+_pages = PageCache()
+
+
+def watch(path):
+    """Пересобирать страницы при изменении файла path (например, манифеста изображений)"""
+    _pages.watch(path)
+
+
+def precompile(templates):
+    """Сборка страниц заранее (при старте приложения, внутри app_context)"""
+    for template in templates:
+        _pages.get(template)
+
+
+def _best_encoding(variants):
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepted[encoding] > 0:
+            return encoding
+    return 'identity'
+
+
+def send_variants(variants, etag, mimetype, cache_control):
+    """Ответ в лучшей поддерживаемой клиентом кодировке, с ETag и ответом 304"""
+    encoding = _best_encoding(variants)
+
+    response = Response(variants[encoding], mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    # У каждого варианта свой ETag: кэш не должен выдать gzip клиенту без его поддержки
+    response.set_etag(etag if encoding == 'identity' else f'{etag}-{encoding}')
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+
+def serve_page(template):
+    """Готовая страница из кэша страниц"""
+    page = _pages.get(template)
+    response = send_variants(page.variants, page.etag, 'text/html', f'public, max-age={PAGE_MAX_AGE}')
+    _pages.stats['not_modified' if response.status_code == 304 else 'hits'] += 1
+    return response
+
+
+def get_page_info():
+    return _pages.info()
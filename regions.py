@@ -0,0 +1,179 @@
+import bisect
+import hashlib
+import json
+
+# Справочник регионов и городов России: код региона -> название и города.
+# Один экземпляр на сервере; страницы загружают его через /api/regions/<версия>.json
+REGIONS = {
+    1: {'name': 'Республика Адыгея', 'cities': ['Майкоп', 'Адыгейск']},
+    2: {'name': 'Республика Башкортостан', 'cities': ['Уфа', 'Стерлитамак', 'Салават', 'Нефтекамск', 'Октябрьский']},
+    3: {'name': 'Республика Бурятия', 'cities': ['Улан-Удэ', 'Северобайкальск', 'Гусиноозёрск']},
+    4: {'name': 'Республика Алтай', 'cities': ['Горно-Алтайск']},
+    5: {'name': 'Республика Дагестан', 'cities': ['Махачкала', 'Хасавюрт', 'Дербент', 'Каспийск', 'Буйнакск']},
+    6: {'name': 'Республика Ингушетия', 'cities': ['Магас', 'Назрань', 'Карабулак', 'Малгобек']},
+    7: {'name': 'Кабардино-Балкарская Республика', 'cities': ['Нальчик', 'Прохладный', 'Баксан']},
+    8: {'name': 'Республика Калмыкия', 'cities': ['Элиста', 'Лагань', 'Городовиковск']},
+    9: {'name': 'Карачаево-Черкесская Республика', 'cities': ['Черкесск', 'Карачаевск', 'Усть-Джегута']},
+    10: {'name': 'Республика Карелия', 'cities': ['Петрозаводск', 'Кондопога', 'Сегежа', 'Костомукша']},
+    11: {'name': 'Республика Коми', 'cities': ['Сыктывкар', 'Ухта', 'Воркута', 'Печора', 'Усинск']},
+    12: {'name': 'Республика Марий Эл', 'cities': ['Йошкар-Ола', 'Волжск', 'Козьмодемьянск']},
+    13: {'name': 'Республика Мордовия', 'cities': ['Саранск', 'Рузаевка', 'Ковылкино']},
+    14: {'name': 'Республика Саха (Якутия)', 'cities': ['Якутск', 'Нерюнгри', 'Мирный', 'Алдан']},
+    15: {'name': 'Республика Северная Осетия', 'cities': ['Владикавказ', 'Моздок', 'Беслан']},
+    16: {'name': 'Республика Татарстан', 'cities': ['Казань', 'Набережные Челны', 'Нижнекамск', 'Альметьевск', 'Зеленодольск']},
+    17: {'name': 'Республика Тыва', 'cities': ['Кызыл', 'Ак-Довурак']},
+    18: {'name': 'Удмуртская Республика', 'cities': ['Ижевск', 'Сарапул', 'Воткинск', 'Глазов']},
+    19: {'name': 'Республика Хакасия', 'cities': ['Абакан', 'Черногорск', 'Саяногорск']},
+    20: {'name': 'Чеченская Республика', 'cities': ['Грозный', 'Урус-Мартан', 'Шали', 'Гудермес']},
+    21: {'name': 'Чувашская Республика', 'cities': ['Чебоксары', 'Новочебоксарск', 'Канаш', 'Алатырь']},
+    22: {'name': 'Алтайский край', 'cities': ['Барнаул', 'Бийск', 'Рубцовск', 'Новоалтайск', 'Заринск']},
+    23: {'name': 'Краснодарский край', 'cities': ['Краснодар', 'Сочи', 'Новороссийск', 'Армавир', 'Ейск', 'Анапа', 'Геленджик']},
+    24: {'name': 'Красноярский край', 'cities': ['Красноярск', 'Норильск', 'Ачинск', 'Канск', 'Железногорск', 'Минусинск']},
+    25: {'name': 'Приморский край', 'cities': ['Владивосток', 'Уссурийск', 'Находка', 'Артём', 'Арсеньев']},
+    26: {'name': 'Ставропольский край', 'cities': ['Ставрополь', 'Пятигорск', 'Кисловодск', 'Невинномысск', 'Ессентуки', 'Минеральные Воды']},
+    27: {'name': 'Хабаровский край', 'cities': ['Хабаровск', 'Комсомольск-на-Амуре', 'Амурск', 'Советская Гавань']},
+    28: {'name': 'Амурская область', 'cities': ['Благовещенск', 'Белогорск', 'Свободный', 'Тында']},
+    29: {'name': 'Архангельская область', 'cities': ['Архангельск', 'Северодвинск', 'Котлас', 'Новодвинск']},
+    30: {'name': 'Астраханская область', 'cities': ['Астрахань', 'Ахтубинск', 'Знаменск', 'Харабали']},
+    31: {'name': 'Белгородская область', 'cities': ['Белгород', 'Старый Оскол', 'Губкин', 'Шебекино', 'Алексеевка']},
+    32: {'name': 'Брянская область', 'cities': ['Брянск', 'Клинцы', 'Новозыбков', 'Дятьково']},
+    33: {'name': 'Владимирская область', 'cities': ['Владимир', 'Ковров', 'Муром', 'Александров', 'Гусь-Хрустальный']},
+    34: {'name': 'Волгоградская область', 'cities': ['Волгоград', 'Волжский', 'Камышин', 'Михайловка', 'Урюпинск']},
+    35: {'name': 'Вологодская область', 'cities': ['Вологда', 'Череповец', 'Сокол', 'Великий Устюг']},
+    36: {'name': 'Воронежская область', 'cities': ['Воронеж', 'Борисоглебск', 'Россошь', 'Лиски', 'Острогожск']},
+    37: {'name': 'Ивановская область', 'cities': ['Иваново', 'Кинешма', 'Шуя', 'Вичуга', 'Фурманов']},
+    38: {'name': 'Иркутская область', 'cities': ['Иркутск', 'Братск', 'Ангарск', 'Усть-Илимск', 'Усолье-Сибирское']},
+    39: {'name': 'Калининградская область', 'cities': ['Калининград', 'Советск', 'Черняховск', 'Балтийск', 'Гусев']},
+    40: {'name': 'Калужская область', 'cities': ['Калуга', 'Обнинск', 'Людиново', 'Киров', 'Малоярославец']},
+    41: {'name': 'Камчатский край', 'cities': ['Петропавловск-Камчатский', 'Елизово', 'Вилючинск']},
+    42: {'name': 'Кемеровская область', 'cities': ['Кемерово', 'Новокузнецк', 'Прокопьевск', 'Междуреченск', 'Ленинск-Кузнецкий']},
+    43: {'name': 'Кировская область', 'cities': ['Киров', 'Кирово-Чепецк', 'Вятские Поляны', 'Слободской']},
+    44: {'name': 'Костромская область', 'cities': ['Кострома', 'Буй', 'Шарья', 'Нерехта', 'Мантурово']},
+    45: {'name': 'Курганская область', 'cities': ['Курган', 'Шадринск', 'Шумиха', 'Далматово']},
+    46: {'name': 'Курская область', 'cities': ['Курск', 'Железногорск', 'Курчатов', 'Льгов', 'Щигры']},
+    47: {'name': 'Ленинградская область', 'cities': ['Гатчина', 'Выборг', 'Сосновый Бор', 'Всеволожск', 'Тихвин', 'Кириши']},
+    48: {'name': 'Липецкая область', 'cities': ['Липецк', 'Елец', 'Грязи', 'Данков', 'Лебедянь']},
+    49: {'name': 'Магаданская область', 'cities': ['Магадан', 'Сусуман', 'Ягодное']},
+    50: {'name': 'Московская область', 'cities': ['Балашиха', 'Подольск', 'Химки', 'Мытищи', 'Королёв', 'Люберцы', 'Красногорск', 'Одинцово', 'Домодедово', 'Щёлково', 'Серпухов', 'Орехово-Зуево', 'Раменское', 'Долгопрудный', 'Жуковский', 'Пушкино', 'Реутов', 'Сергиев Посад', 'Ногинск', 'Коломна']},
+    51: {'name': 'Мурманская область', 'cities': ['Мурманск', 'Апатиты', 'Североморск', 'Мончегорск', 'Кандалакша']},
+    52: {'name': 'Нижегородская область', 'cities': ['Нижний Новгород', 'Дзержинск', 'Арзамас', 'Саров', 'Бор', 'Кстово', 'Павлово', 'Выкса', 'Балахна', 'Заволжье', 'Городец', 'Кулебаки', 'Богородск', 'Семёнов', 'Лысково']},
+    53: {'name': 'Новгородская область', 'cities': ['Великий Новгород', 'Боровичи', 'Старая Русса', 'Валдай']},
+    54: {'name': 'Новосибирская область', 'cities': ['Новосибирск', 'Бердск', 'Искитим', 'Куйбышев', 'Обь', 'Барабинск']},
+    55: {'name': 'Омская область', 'cities': ['Омск', 'Исилькуль', 'Калачинск', 'Тара', 'Тюкалинск']},
+    56: {'name': 'Оренбургская область', 'cities': ['Оренбург', 'Орск', 'Новотроицк', 'Бузулук', 'Бугуруслан', 'Гай']},
+    57: {'name': 'Орловская область', 'cities': ['Орёл', 'Ливны', 'Мценск', 'Болхов']},
+    58: {'name': 'Пензенская область', 'cities': ['Пенза', 'Кузнецк', 'Заречный', 'Каменка', 'Сердобск']},
+    59: {'name': 'Пермский край', 'cities': ['Пермь', 'Березники', 'Соликамск', 'Чайковский', 'Лысьва', 'Кунгур', 'Краснокамск']},
+    60: {'name': 'Псковская область', 'cities': ['Псков', 'Великие Луки', 'Остров', 'Невель', 'Опочка']},
+    61: {'name': 'Ростовская область', 'cities': ['Ростов-на-Дону', 'Таганрог', 'Шахты', 'Волгодонск', 'Новочеркасск', 'Батайск', 'Новошахтинск', 'Каменск-Шахтинский']},
+    62: {'name': 'Рязанская область', 'cities': ['Рязань', 'Касимов', 'Скопин', 'Сасово', 'Ряжск']},
+    63: {'name': 'Самарская область', 'cities': ['Самара', 'Тольятти', 'Сызрань', 'Новокуйбышевск', 'Чапаевск', 'Жигулёвск', 'Отрадный']},
+    64: {'name': 'Саратовская область', 'cities': ['Саратов', 'Энгельс', 'Балаково', 'Балашов', 'Вольск', 'Пугачёв']},
+    65: {'name': 'Сахалинская область', 'cities': ['Южно-Сахалинск', 'Корсаков', 'Холмск', 'Оха', 'Поронайск']},
+    66: {'name': 'Свердловская область', 'cities': ['Екатеринбург', 'Нижний Тагил', 'Каменск-Уральский', 'Первоуральск', 'Серов', 'Асбест', 'Новоуральск', 'Полевской', 'Краснотурьинск', 'Ревда', 'Верхняя Пышма', 'Лесной', 'Качканар', 'Алапаевск', 'Берёзовский']},
+    67: {'name': 'Смоленская область', 'cities': ['Смоленск', 'Вязьма', 'Рославль', 'Ярцево', 'Сафоново', 'Десногорск']},
+    68: {'name': 'Тамбовская область', 'cities': ['Тамбов', 'Мичуринск', 'Рассказово', 'Моршанск', 'Котовск']},
+    69: {'name': 'Тверская область', 'cities': ['Тверь', 'Ржев', 'Вышний Волочёк', 'Кимры', 'Торжок', 'Конаково', 'Удомля']},
+    70: {'name': 'Томская область', 'cities': ['Томск', 'Северск', 'Стрежевой', 'Асино', 'Колпашево']},
+    71: {'name': 'Тульская область', 'cities': ['Тула', 'Новомосковск', 'Донской', 'Алексин', 'Щёкино', 'Узловая', 'Ефремов']},
+    72: {'name': 'Тюменская область', 'cities': ['Тюмень', 'Тобольск', 'Ишим', 'Ялуторовск', 'Заводоуковск']},
+    73: {'name': 'Ульяновская область', 'cities': ['Ульяновск', 'Димитровград', 'Инза', 'Барыш', 'Новоульяновск']},
+    74: {'name': 'Челябинская область', 'cities': ['Челябинск', 'Магнитогорск', 'Златоуст', 'Миасс', 'Копейск', 'Озёрск', 'Троицк', 'Снежинск', 'Сатка', 'Чебаркуль', 'Кыштым', 'Южноуральск', 'Коркино', 'Трёхгорный', 'Аша']},
+    75: {'name': 'Забайкальский край', 'cities': ['Чита', 'Краснокаменск', 'Борзя', 'Нерчинск', 'Петровск-Забайкальский']},
+    76: {'name': 'Ярославская область', 'cities': ['Ярославль', 'Рыбинск', 'Переславль-Залесский', 'Тутаев', 'Углич', 'Ростов']},
+    77: {'name': 'Москва', 'cities': ['Москва']},
+    78: {'name': 'Санкт-Петербург', 'cities': ['Санкт-Петербург']},
+    79: {'name': 'Еврейская автономная область', 'cities': ['Биробиджан', 'Облучье']},
+    83: {'name': 'Ненецкий автономный округ', 'cities': ['Нарьян-Мар']},
+    86: {'name': 'Ханты-Мансийский автономный округ', 'cities': ['Ханты-Мансийск', 'Сургут', 'Нижневартовск', 'Нефтеюганск', 'Когалым', 'Нягань', 'Мегион', 'Лангепас', 'Пыть-Ях', 'Урай', 'Югорск', 'Радужный', 'Покачи', 'Лянтор']},
+    87: {'name': 'Чукотский автономный округ', 'cities': ['Анадырь', 'Билибино', 'Певек']},
+    89: {'name': 'Ямало-Ненецкий автономный округ', 'cities': ['Салехард', 'Новый Уренгой', 'Ноябрьск', 'Надым', 'Муравленко', 'Губкинский', 'Лабытнанги', 'Тарко-Сале']},
+    91: {'name': 'Республика Крым', 'cities': ['Симферополь', 'Керчь', 'Евпатория', 'Ялта', 'Феодосия', 'Джанкой', 'Алушта', 'Бахчисарай', 'Красноперекопск', 'Саки', 'Армянск', 'Судак', 'Белогорск']},
+    92: {'name': 'Севастополь', 'cities': ['Севастополь']},
+    93: {'name': 'Республика Крым (альт.)', 'cities': ['Симферополь', 'Керчь', 'Евпатория', 'Ялта', 'Феодосия']},
+    94: {'name': 'Байконур', 'cities': ['Байконур']},
+    95: {'name': 'Чеченская Республика (альт.)', 'cities': ['Грозный', 'Урус-Мартан', 'Шали', 'Гудермес', 'Аргун']}
+}
+
+# Номер школы - как в поле формы теста
+MAX_SCHOOL_NUMBER = 9999
+SEARCH_LIMIT = 20
+
+
+def _search_key(value):
+    """Ключ для поиска и сравнения: без учёта регистра, лишних пробелов и различия е/ё"""
+    return ' '.join(str(value).split()).casefold().replace('ё', 'е')
+
+
+def _build_catalog():
+    body = json.dumps({'regions': REGIONS}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return body, hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+# Тело ответа и его версия (хэш содержимого) вычисляются один раз при импорте
+CATALOG_BODY, CATALOG_VERSION = _build_catalog()
+CATALOG_URL = f'/api/regions/{CATALOG_VERSION}.json'
+
+
+def _build_index():
+    """Отсортированный список (ключ, город, код региона) для поиска по префиксу.
+
+    Кроме полного названия индексируется начало каждого слова: «новг» находит «Нижний Новгород».
+    """
+    index = []
+    cities = {}
+    for code, region in REGIONS.items():
+        for city in region['cities']:
+            key = _search_key(city)
+            cities.setdefault(key, city)
+            words = key.replace('-', ' ').split()
+            tokens = {key} | {' '.join(words[i:]) for i in range(1, len(words))}
+            for token in tokens:
+                index.append((token, token != key, city, code))
+    index.sort()
+    return index, cities
+
+
+_index, _cities_by_key = _build_index()
+_index_keys = [entry[0] for entry in _index]
+
+
+def search_cities(prefix, limit=SEARCH_LIMIT):
+    """Города, название которых (или одно из слов названия) начинается с prefix"""
+    key = _search_key(prefix)
+    if not key:
+        return []
+    matches = []
+    seen = set()
+    start = bisect.bisect_left(_index_keys, key)
+    for token, partial, city, code in _index[start:]:
+        if not token.startswith(key):
+            break
+        if (city, code) not in seen:
+            seen.add((city, code))
+            matches.append((partial, city, code))
+    # Совпадения с начала названия - раньше совпадений по слову
+    matches.sort(key=lambda match: (match[0], _search_key(match[1]), match[2]))
+    return [
+        {'city': city, 'region_code': code, 'region': REGIONS[code]['name']}
+        for _, city, code in matches[:limit]
+    ]
+
+
+def validate_location(city, school):
+    """Проверка города по справочнику и номера школы; возвращает значения в каноническом виде.
+
+    Пустые значения допустимы; ValueError при неизвестном городе или некорректном номере школы.
+    """
+    city = city.strip() if city else ''
+    school = school.strip() if isinstance(school, str) else ('' if school is None else str(school))
+    if city:
+        canonical = _cities_by_key.get(_search_key(city))
+        if canonical is None:
+            raise ValueError(f'Город не найден в справочнике: {city}')
+        city = canonical
+    if school:
+        if not school.isdigit() or not 1 <= int(school) <= MAX_SCHOOL_NUMBER:
+            raise ValueError(f'Некорректный номер школы: {school}')
+        school = str(int(school))
+    return city, school
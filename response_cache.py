@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from DBmanager import get_generation
+from page_cache import compress_variants, send_variants
+
+# Границы кэша ответов
+CACHE_MAX_ENTRIES = 512
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Ответы с данными сжимаются при каждой смене поколения - быстрые уровни, а не максимальные, как у страниц
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+
+
+class ResponseCache:
+    """LRU-кэш готовых JSON-ответов, ограниченный числом записей и суммарным размером.
+
+    Запись действительна, пока не сменилось поколение данных (DBmanager.get_generation).
+    Запись - варианты тела по кодировкам ({'identity': ..., 'gzip': ...}), размер - их сумма.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1], entry[2]
+
+    def put(self, key, generation, variants, etag):
+        size = _variants_size(variants)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= _variants_size(old[1])
+            self._entries[key] = (generation, variants, etag)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= _variants_size(evicted[1])
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._size)
+
+
+def _variants_size(variants):
+    return sum(len(body) for body in variants.values())
+
+
+_cache = ResponseCache()
+
+
+def json_variants(payload, dumps=None, compress=False):
+    """Тело JSON-ответа и его ETag; compress - ещё и сжатые варианты (gzip, br) для больших выдач"""
+    body = (dumps or current_app.json.dumps)(payload).encode('utf-8')
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    variants = compress_variants(body, GZIP_LEVEL, BROTLI_QUALITY) if compress else {'identity': body}
+    return variants, etag
+
+
+def send_json(variants, etag):
+    # Клиент хранит ответ, но перепроверяет его при каждом опросе
+    return send_variants(variants, etag, 'application/json', 'no-cache')
+
+
+def cached_json(key, build, dumps=None, compress=False):
+    """JSON-ответ из кэша или построенный build(); с ETag и ответом 304 на If-None-Match.
+
+    key - кортеж (имя эндпоинта, аргументы фильтра); build возвращает словарь для ответа
+    или None, если отдавать нечего (тогда и cached_json возвращает None, а в кэш ничего не попадает).
+    dumps - сериализация вместо jsonify; compress - сжатые варианты хранятся в кэше вместе с исходным.
+    """
+    generation = get_generation()
+    cached = _cache.get(key, generation)
+    if cached is None:
+        payload = build()
+        if payload is None:
+            return None
+        variants, etag = json_variants(payload, dumps, compress)
+        _cache.put(key, generation, variants, etag)
+    else:
+        variants, etag = cached
+
+    return send_json(variants, etag)
+
+
+def get_cache_info():
+    return _cache.info()
+
+
+def clear_cache():
+    _cache.clear()
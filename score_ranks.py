@@ -0,0 +1,163 @@
+import threading
+
+# Области сравнения: все попытки уровня, уровень в городе, уровень в школе города
+SCOPES = ('level', 'city', 'school')
+
+
+def _scope_keys(level, city_key, school_key):
+    # None - «любой»: пустой город не смешивается с областью всего уровня
+    return (
+        (level, None, None),
+        (level, city_key, None),
+        (level, city_key, school_key),
+    )
+
+
+class ScoreIndex:
+    """Распределение баллов в памяти: для каждой области - число попыток с каждым баллом.
+
+    Баллы - небольшие целые (не больше числа вопросов), поэтому место и процентиль
+    считаются по массиву счётчиков длиной max_score + 1, без запросов к БД.
+    Вместе с распределением хранится, по какому состоянию БД оно построено (наибольший id
+    и версия ключей), чтобы заметить изменения, сделанные другими процессами.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._counts = {}
+        self._loaded_id = 0     # попытки с id не больше этого уже учтены при загрузке
+        self._max_id = 0        # наибольший учтённый id
+        self._version = None
+        self._pending = None    # попытки, учтённые во время чтения БД при пересборке
+
+    @staticmethod
+    def _add(all_counts, level, city_key, school_key, score, count):
+        score = max(int(score), 0)
+        for key in _scope_keys(level, city_key, school_key):
+            counts = all_counts.get(key)
+            if counts is None:
+                counts = all_counts[key] = []
+            if len(counts) <= score:
+                counts.extend([0] * (score + 1 - len(counts)))
+            counts[score] += count
+
+    def _apply(self, attempts):
+        for level, city_key, school_key, score, test_id in attempts:
+            # Попытку, сохранённую до пересборки, уже посчитала загрузка из БД
+            if test_id <= self._loaded_id:
+                continue
+            self._add(self._counts, level, city_key, school_key, score, 1)
+            self._max_id = max(self._max_id, test_id)
+
+    def add_many(self, attempts):
+        """Учёт пачки попыток [(уровень, город, школа, балл, id)] одной блокировкой"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(attempts)
+            self._apply(attempts)
+
+    def reload(self, fetch):
+        """Пересборка по fetch() -> ([(уровень, город, школа, балл, число попыток)], наибольший id, версия).
+
+        БД читается без блокировки распределения, поэтому rank не ждёт пересборку.
+        Попытки, учтённые во время чтения, после замены распределения применяются
+        к новому заново; уже попавшие в снимок отсекаются по id.
+        """
+        with self._reload_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                rows, max_id, version = fetch()
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            all_counts = {}
+            total = 0
+            for level, city_key, school_key, score, count in rows:
+                self._add(all_counts, level, city_key, school_key, score, count)
+                total += count
+            with self._lock:
+                pending, self._pending = self._pending, None
+                self._counts = all_counts
+                self._loaded_id = self._max_id = max_id
+                self._version = version
+                self._apply(pending)
+        return total
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+            self._loaded_id = self._max_id = 0
+            self._version = None
+
+    def matches(self, level_totals, max_id, version):
+        """Совпадает ли распределение с БД: число попыток по уровням, наибольший id и версия"""
+        with self._lock:
+            totals = {
+                key[0]: sum(counts) for key, counts in self._counts.items()
+                if key[1] is None and sum(counts)
+            }
+            return totals == level_totals and self._max_id == max_id and self._version == version
+
+    def max_id(self):
+        with self._lock:
+            return self._max_id
+
+    def rank(self, level, city_key, school_key, score):
+        """Место и процентиль балла в каждой области (попытка уже учтена в распределении).
+
+        percentile - доля остальных участников с меньшим баллом (равные считаются наполовину);
+        None, если участник в области единственный.
+        """
+        score = max(int(score), 0)
+        result = {}
+        with self._lock:
+            for scope, key in zip(SCOPES, _scope_keys(level, city_key, school_key)):
+                counts = self._counts.get(key, [])
+                below = sum(counts[:score])
+                equal = counts[score] if score < len(counts) else 0
+                total = sum(counts)
+                others = total - 1
+                result[scope] = {
+                    'place': total - below - equal + 1,
+                    'total': total,
+                    'percentile': round((below + max(equal - 1, 0) / 2) * 100 / others, 1) if others > 0 else None
+                }
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            return {'series': len(self._counts)}
+
+
+_index = ScoreIndex()
+
+
+def add_many(attempts):
+    _index.add_many(attempts)
+
+
+def reload(fetch):
+    return _index.reload(fetch)
+
+
+def reset():
+    _index.reset()
+
+
+def matches(level_totals, max_id, version):
+    return _index.matches(level_totals, max_id, version)
+
+
+def max_id():
+    return _index.max_id()
+
+
+def rank(level, city_key, school_key, score):
+    return _index.rank(level, city_key, school_key, score)
+
+
+def get_stats():
+    return _index.get_stats()
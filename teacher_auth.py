@@ -0,0 +1,92 @@
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+from app_logging import get_logger
+
+# Путь к файлу с ключом
+KEY_FILE_PATH = 'key.txt'
+# Сколько действует токен сессии учителя, секунд
+TOKEN_MAX_AGE = 8 * 60 * 60
+# Секрет подписи токенов; без TEACHER_TOKEN_SECRET токены действуют до перезапуска сервера
+TOKEN_SECRET = os.environ.get('TEACHER_TOKEN_SECRET') or secrets.token_hex(32)
+
+logger = get_logger('teacher_auth')
+
+
+class TeacherKey:
+    """Ключ учителя из файла: читается один раз и перечитывается только при изменении файла"""
+
+    def __init__(self, path=KEY_FILE_PATH):
+        self.path = path
+        self._stamp = None
+        self._key = None
+        self._lock = threading.Lock()
+        self.stats = {'reads': 0}
+
+    def get(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            logger.error("Ошибка при чтении ключа", extra={'error': str(e)})
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    try:
+                        with open(self.path, 'r', encoding='utf-8') as f:
+                            self._key = f.read().strip()
+                    except Exception as e:
+                        logger.error("Ошибка при чтении ключа", extra={'error': str(e)})
+                        return None
+                    self._stamp = stamp
+                    self.stats['reads'] += 1
+        return self._key
+
+
+_teacher_key = TeacherKey()
+_serializer = URLSafeTimedSerializer(TOKEN_SECRET, salt='teacher-session')
+
+
+def get_teacher_key():
+    """Получение ключа учителя (из кэша, пока файл не менялся)"""
+    return _teacher_key.get()
+
+
+def _key_fingerprint(key):
+    # Токен привязан к ключу: после смены key.txt старые токены недействительны
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def check_key(candidate):
+    """Сравнение ключа за постоянное время; None - ключ не удалось прочитать"""
+    key = get_teacher_key()
+    if key is None:
+        return None
+    return hmac.compare_digest(str(candidate).strip().encode('utf-8'), key.encode('utf-8'))
+
+
+def issue_token():
+    """Подписанный токен сессии учителя"""
+    return _serializer.dumps({'sid': secrets.token_urlsafe(9), 'kf': _key_fingerprint(get_teacher_key())})
+
+
+def check_token(token):
+    """Проверка подписи и срока токена; возвращает id сессии или None"""
+    try:
+        payload = _serializer.loads(token, max_age=TOKEN_MAX_AGE)
+    except (BadSignature, SignatureExpired):
+        return None
+    key = get_teacher_key()
+    if key is None or not hmac.compare_digest(payload.get('kf', ''), _key_fingerprint(key)):
+        return None
+    return payload.get('sid')
+
+
+def get_auth_stats():
+    return dict(_teacher_key.stats)
@@ -0,0 +1,200 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import DBmanager
+import metrics
+from app_logging import get_logger
+from DBmanager import INSERT_TEST_SQL, attempts_saved, bump_generation, get_connection, prepare_test_row, saving_attempts
+
+# Режим отложенной записи: включается переменной окружения WRITE_BEHIND=1
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND', '0') == '1'
+BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '200'))
+BATCH_MAX_WAIT = float(os.environ.get('WRITE_BEHIND_MAX_WAIT_MS', '20')) / 1000
+RESULT_TIMEOUT = 10  # сколько обработчик запроса ждёт записи своей пачки, секунд
+
+logger = get_logger('write_behind')
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Очередь отправок с отдельным потоком-писателем, который фиксирует их пачками"""
+
+    def __init__(self, batch_size=BATCH_SIZE, max_wait=BATCH_MAX_WAIT):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+        self.stats = {'batches': 0, 'rows': 0, 'max_batch': 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Остановка с дозаписью всего, что уже стоит в очереди"""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopped = True
+            thread = self._thread
+            self._thread = None
+            self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def submit(self, row):
+        """Поставить подготовленную строку (prepare_test_row) в очередь; возвращает Future"""
+        future = Future()
+        # Под блокировкой: всё, что принято, окажется в очереди раньше маркера остановки
+        with self._lock:
+            if self._stopped or self._thread is None:
+                future.set_exception(RuntimeError('Очередь отложенной записи не запущена'))
+                return future
+            self._queue.put((row, future))
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            # Пачка закрывается по размеру или по времени
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # Дозаписываем всё, что успели положить до остановки
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        for start in range(0, len(leftover), self.batch_size):
+            self._flush(leftover[start:start + self.batch_size])
+
+    def _flush(self, batch):
+        try:
+            results = write_batch([row for row, _ in batch])
+        except Exception as e:
+            logger.error("Ошибка при пакетной записи результатов тестов", extra={'error': str(e), 'rows': len(batch)})
+            if len(batch) > 1:
+                # Одна некорректная строка не должна ронять всю пачку - пишем по одной
+                metrics.inc('webhistory_db_retries_total', len(batch), operation='write_batch')
+                for item in batch:
+                    self._flush([item])
+                return
+            batch[0][1].set_exception(e)
+            return
+        self.stats['batches'] += 1
+        self.stats['rows'] += len(batch)
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+def _identity(row):
+    # (фамилия, имя, класс, уровень) в нормализованном виде - см. prepare_test_row
+    return (row[11], row[10], row[12], row[8])
+
+
+def write_batch(rows):
+    """Запись пачки строк одной транзакцией; для каждой строки - результат как у submit_test_result"""
+    with saving_attempts():
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM Test')
+            max_before = cursor.fetchone()[0]
+
+            cursor.executemany(INSERT_TEST_SQL + '''
+                ON CONFLICT (last_name_key, first_name_key, class_key, level)
+                DO UPDATE SET repeat_attempts = repeat_attempts + 1
+            ''', rows)
+
+            identities = list(dict.fromkeys(_identity(row) for row in rows))
+            saved = {}
+            for start in range(0, len(identities), 200):
+                chunk = identities[start:start + 200]
+                placeholders = ', '.join(['(?, ?, ?, ?)'] * len(chunk))
+                cursor.execute(f'''
+                    SELECT id, score, max_score, created_at, last_name_key, first_name_key, class_key, level
+                    FROM Test
+                    WHERE (last_name_key, first_name_key, class_key, level) IN (VALUES {placeholders})
+                ''', [value for identity in chunk for value in identity])
+                for found in cursor.fetchall():
+                    saved[(found['last_name_key'], found['first_name_key'], found['class_key'], found['level'])] = found
+            conn.commit()
+        bump_generation()
+
+        results = []
+        inserted = {}
+        for row in rows:
+            identity = _identity(row)
+            found = saved[identity]
+            # Новой считается только первая строка пачки, попавшая в свежевставленную запись
+            created = found['id'] > max_before and identity not in inserted
+            if created:
+                inserted[identity] = (row, found['id'], found['created_at'])
+            results.append({
+                'created': created,
+                'test_id': found['id'],
+                'score': found['score'],
+                'max_score': found['max_score'],
+                'created_at': found['created_at']
+            })
+        attempts_saved(list(inserted.values()))
+    return results
+
+
+_writer = WriteBehindQueue()
+
+
+def start():
+    """Запуск потока-писателя (без уникального индекса пакетная вставка невозможна)"""
+    if not DBmanager._unique_student_index:
+        logger.warning("Отложенная запись отключена: нет уникального индекса uq_test_student")
+        return False
+    _writer.start()
+    return True
+
+
+def stop():
+    """Остановка потока-писателя с дозаписью очереди"""
+    _writer.stop()
+
+
+def is_running():
+    return _writer._thread is not None
+
+
+def get_stats():
+    return dict(_writer.stats, queued=_writer._queue.qsize(), running=is_running())
+
+
+def submit_test_result(first_name, last_name, class_name, city, school, answers, score, level, time=0):
+    """То же, что DBmanager.submit_test_result, но через очередь с групповой фиксацией"""
+    row = prepare_test_row(first_name, last_name, class_name, city, school, answers, score, level, time)
+    return _writer.submit(row).result(timeout=RESULT_TIMEOUT)